@@ -1,4 +1,5 @@
 import yaml
+import os
 import argparse
 import torch 
 import matplotlib.pyplot as plt
@@ -7,7 +8,8 @@ from PIL import Image
 
 from itertools import islice
 from src import (get_standard_sde, PSNR, SSIM, get_standard_dataset, get_data_from_ground_truth, get_standard_ray_trafo,  
-	get_standard_score, get_standard_configs, get_standard_path, get_standard_adapted_sampler) 
+	get_standard_score, get_standard_configs, get_standard_path, get_standard_adapted_sampler, 
+	get_standard_adaptation_session, get_standard_adapter_key, get_standard_calibrated_adapter, AdapterBank) 
 
 parser = argparse.ArgumentParser(description='conditional sampling')
 parser.add_argument('--dataset', default='walnut', help='test-dataset', choices=['walnut', 'lodopab', 'ellipses', 'mayo', 'aapm'])
@@ -27,16 +29,52 @@ parser.add_argument('--sde', default='vesde', choices=['vpsde', 'vesde', 'ddpm']
 parser.add_argument('--adaptation', default='lora', choices=['decoder', 'full', 'vdkl', 'lora'])
 parser.add_argument('--num_optim_step', default=10, help='num. of optimization steps taken per sampl. step')
 parser.add_argument('--adapt_freq', default=1, help='freq. of adaptation step in sampl.')
+parser.add_argument('--adapt_rel_tol', default=None, help='stop the optimization of an adaptation step once the rel. loss improvement falls below it.')
+parser.add_argument('--adapt_skip_tol', default=None, help='skip adaptation steps whose loss moved less than it (rel.) since the last adaptation.')
+parser.add_argument('--adapt_max_skip', default=None, help='max. num. of adaptation steps skipped in a row.')
+parser.add_argument('--adapt_window', default=None, nargs=2, help='adapt only for t/T in [t_min, t_max] (t/T = 1 is pure noise).')
 parser.add_argument('--lora_include_blocks', default=['input_blocks','middle_block','output_blocks','out'], nargs='+', help='lora kwargs impl. of arch. blocks included')
+parser.add_argument('--lora_biases_in_blocks_only', action='store_true', help='retrain biases in ``lora_include_blocks'' only (otherwise in all blocks), e.g. LoRA on the decoder then leaves the encoder frozen and its activations cached.')
 parser.add_argument('--lr', default=1e-3, help='learning rate for adaptation')
+parser.add_argument('--adapt_optim', default='adam', choices=['adam', 'adafactor'], help='optimizer used for adaptation (adafactor keeps factored moments only).')
+parser.add_argument('--adapt_step_in_backward', action='store_true', help='update each parameter during the backward pass and free its gradient right away.')
+parser.add_argument('--keep_optim_state', action='store_true', help='keep one optimizer (and its moments) for the whole chain.')
 parser.add_argument('--lora_rank', default=4, help='lora kwargs impl. of rank')
+parser.add_argument('--lora_target_rank', default=None, help='prune LoRA ranks during adaptation down to this avg. rank.')
+parser.add_argument('--lora_prune_freq', default=1, help='prune every ``lora_prune_freq'' adaptation steps.')
+parser.add_argument('--lora_prune_pct', default=0.25, help='fraction of the remaining LoRA ranks pruned at a time.')
+parser.add_argument('--merge_lora', action='store_true', help='fold LoRA into the base weights on steps without adaptation.')
+parser.add_argument('--adapter_bank', default=None, help='dir. of the adapter bank.')
+parser.add_argument('--adapter_domain', default=None, help='domain the adapter is stored under (defaults to ``dataset'').')
+parser.add_argument('--warm_start', action='store_true', help='start adaptation from the banked adapter of the domain.')
+parser.add_argument('--save_adapter', action='store_true', help='store the adapter in the bank after every reconstruction (``batch_size'' 1 only).')
+parser.add_argument('--calib_num_samples', default=0, help='num. of samples of the amortised adapter pre-pass (0 disables it).')
+parser.add_argument('--calib_num_steps', default=None, help='num. of sampl. steps of the pre-pass (defaults to ``num_steps'').')
+parser.add_argument('--calib_num_optim_step', default=None, help='num. of optimization steps of the pre-pass (defaults to ``num_optim_step'').')
 parser.add_argument('--add_cg', action='store_true', help='do DDS steps after adaptation.')
 parser.add_argument('--cg_iter', default=1, help='Number of CG steps for DDS update.')
 parser.add_argument('--gamma', default=0.01, help='reg. used for ``dds''.')
 parser.add_argument('--load_path', help='path to ddpm model.')
 parser.add_argument('--dc_type', default="cg", choices=["cg", "gd", "none"], help="use cg/gd in adaptation (or none at all)")
 parser.add_argument('--stddev', default=None, help="noise_level")
+parser.add_argument('--time_grid', default='linear', choices=['linear', 'uniform'], help="``uniform'' takes num_steps + 1 equispaced points ending on eps, as progressively distilled models do.")
 parser.add_argument('--early_stopping_pct', default=1.0)
+parser.add_argument('--pct_chain_elapsed', default=0, help='skip this fraction of the chain, starting from the FBP diffused to the starting noise level.')
+parser.add_argument('--es_tol', default=None, help='stop once the rel. change of ``es_criterion'' stays below ``es_tol''.')
+parser.add_argument('--es_patience', default=5, help='num. of consecutive converged steps before stopping.')
+parser.add_argument('--es_criterion', default='xhat0', choices=['xhat0', 'residual'], help='monitor the Tweedy estimate or the data residual.')
+parser.add_argument('--es_check_freq', default=1, help='check convergence every ``es_check_freq'' steps (each check syncs with the host).')
+parser.add_argument('--checkpoint_freq', default=None, help='snapshot the sampling state every ``checkpoint_freq'' steps.')
+parser.add_argument('--resume', action='store_true', help='skip finished samples and resume from the last snapshot.')
+parser.add_argument('--num_img_in_log', default=1, help='log the reco. every ``num_img_in_log'' steps.')
+parser.add_argument('--num_scalar_in_log', default=1, help='log the PSNR every ``num_scalar_in_log'' steps.')
+parser.add_argument('--batch_size', default=1, help='num. of observations reconstructed jointly, each with its own LoRA adapter.')
+parser.add_argument('--grad_checkpoint_blocks', default=None, nargs='+', help='recompute activations of these blocks in backward passes, e.g. of DPS or adaptation (openai_unet only).')
+parser.add_argument('--compile', action='store_true', help='compile the sampling step (falls back to compiling the score model only).')
+parser.add_argument('--compile_mode', default=None, choices=['default', 'max-autotune-no-cudagraphs'], help='``torch.compile'' mode.')
+parser.add_argument('--compile_cache_dir', default=None, help='dir. of compiled artifacts, reused across runs.')
+parser.add_argument('--sync_free', action='store_true', help='keep per-step scalars on device and defer logging.')
+parser.add_argument('--count_syncs', action='store_true', help='debug: count device-to-host syncs per sampling step (CUDA only, nothing is counted on CPU).')
 
 def coordinator(args):
 	config, dataconfig = get_standard_configs(args, base_path=args.base_path)
@@ -56,6 +94,16 @@ def coordinator(args):
 	sde = get_standard_sde(config=config)
 	score = get_standard_score(config=config, sde=sde, use_ema=args.ema, model_type=args.model)
 	score = score.to(config.device).eval()
+	if args.grad_checkpoint_blocks is not None:
+		score.enable_checkpointing(blocks=args.grad_checkpoint_blocks)
+	bank, adapter_key, warm_start = None, None, None
+	assert not (args.save_adapter and int(args.batch_size) > 1), 'the bank stores single adapters'
+	if args.adapter_bank is not None:
+		bank = AdapterBank(args.adapter_bank)
+		adapter_key = get_standard_adapter_key(args=args, config=config)
+		if args.warm_start and adapter_key in bank:
+			print(f'warm start from adapter {adapter_key}')
+			warm_start = bank.load(adapter_key)
 	ray_trafo = get_standard_ray_trafo(config=dataconfig)
 	ray_trafo = ray_trafo.to(device=config.device)
 	
@@ -64,9 +112,7 @@ def coordinator(args):
 
 	dataset = get_standard_dataset(config=dataconfig, ray_trafo=ray_trafo)
 
-	dataconfig.data.validation.num_images = len(dataset)
-	_psnr, _ssim = [], []
-	for i, data_sample in enumerate(islice(dataset, dataconfig.data.validation.num_images)):
+	def _load_sample(i, data_sample):
 		if config.seed is not None:
 			torch.manual_seed(config.seed + i)  # for reproducible noise in simulate
 		if len(data_sample) == 3:
@@ -82,8 +128,50 @@ def coordinator(args):
 				ray_trafo=ray_trafo,
 				white_noise_rel_stddev=dataconfig.data.stddev
 				)
+		return ground_truth, observation, filtbackproj
+
+	if int(args.calib_num_samples) > 0 and warm_start is None:
+		# amortised pre-pass: one adapter shared by the first ``calib_num_samples'' observations, 
+		# per-sample adaptation below warm-starts from it
+		observation = torch.cat([_load_sample(i, data_sample)[1] 
+			for i, data_sample in enumerate(islice(dataset, int(args.calib_num_samples)))], dim=0)
+		warm_start = get_standard_calibrated_adapter(args=args, config=config, score=score, sde=sde, 
+			ray_trafo=ray_trafo, observation=observation, bank=bank, device=config.device, 
+			extra={'dataset': args.dataset, 'part': getattr(dataconfig.data, 'part', None), 
+				'stddev': dataconfig.data.stddev, 'forward_op': dict(dataconfig.forward_op.items())})
+	# base weights are snapshot once and restored in place before every sample
+	session = get_standard_adaptation_session(args=args, score=score, warm_start=warm_start)
+
+	dataconfig.data.validation.num_images = len(dataset)
+	_psnr, _ssim = [], []
+	batch = []
+	for i, data_sample in enumerate(islice(dataset, dataconfig.data.validation.num_images)):
+		ground_truth, observation, filtbackproj = _load_sample(i, data_sample)
+
+		batch.append((i, ground_truth, observation, filtbackproj))
+		if len(batch) < int(args.batch_size) and i < dataconfig.data.validation.num_images - 1:
+			continue
 
-		logg_kwargs = {'log_dir': save_root, 'num_img_in_log': 1, 'sample_num': i, 'ground_truth': ground_truth, 'filtbackproj': filtbackproj}
+		# observations in ``batch'' are reconstructed jointly, each with its own LoRA adapter
+		indices = [idx for idx, *_ in batch]
+		ground_truth, observation, filtbackproj = [torch.cat(data, dim=0) for data in list(zip(*batch))[1:]]
+		batch = []
+		sample_num = indices[0] if len(indices) == 1 else f'{indices[0]}-{indices[-1]}'
+		if args.resume and all([(save_root / f'recon_{idx}_info.pt').exists() for idx in indices]):
+			print(f'skip finished sample(s) {sample_num}')
+			for idx in indices:
+				info = torch.load(str(save_root / f'recon_{idx}_info.pt'))
+				_psnr.append(PSNR(info['recon'].numpy(), info['ground_truth'].numpy()))
+				_ssim.append(SSIM(info['recon'].numpy(), info['ground_truth'].numpy()))
+			continue
+		checkpoint_path = None
+		if args.checkpoint_freq is not None:
+			checkpoint_path = str(save_root / f'sampling_state_{sample_num}.pt')
+			if not args.resume and os.path.exists(checkpoint_path):
+				os.remove(checkpoint_path)
+
+		logg_kwargs = {'log_dir': save_root, 'num_img_in_log': int(args.num_img_in_log), 'num_scalar_in_log': int(args.num_scalar_in_log), 
+			'sample_num': sample_num, 'ground_truth': ground_truth, 'filtbackproj': filtbackproj}
 		sampler = get_standard_adapted_sampler(
 				args=args,
 				config=config,
@@ -91,27 +179,29 @@ def coordinator(args):
 				sde=sde,
 				device=config.device,
 				observation = observation,
-				ray_trafo = ray_trafo
+				filtbackproj = filtbackproj,
+				ray_trafo = ray_trafo,
+				session = session
 				)
-		recon = sampler.sample(logg_kwargs=logg_kwargs, logging=True)
+		recon = sampler.sample(logg_kwargs=logg_kwargs, logging=True, checkpoint_path=checkpoint_path)
 		recon = torch.clamp(recon, 0)
-		torch.save(		{'recon': recon.cpu().squeeze(), 'ground_truth': ground_truth.cpu().squeeze()}, 
-		str(save_root / f'recon_{i}_info.pt')	)
-		im = Image.fromarray(recon.cpu().squeeze().numpy()*255.).convert("L")
-		im.save(str(save_root / f'recon_{i}.png'))
+		if bank is not None and args.save_adapter:
+			bank.save(adapter_key, score, meta={'dataset': args.dataset, 'sample': sample_num})
+		for j, idx in enumerate(indices):
+			torch.save(		{'recon': recon[j].cpu().squeeze(), 'ground_truth': ground_truth[j].cpu().squeeze()}, 
+			str(save_root / f'recon_{idx}_info.pt')	)
+			im = Image.fromarray(recon[j].cpu().squeeze().numpy()*255.).convert("L")
+			im.save(str(save_root / f'recon_{idx}.png'))
 
-		
-		score = get_standard_score(config=config, sde=sde, use_ema=args.ema, model_type=args.model)
-		score = score.to(config.device)
-		score.eval() 
-		
-		print(f'reconstruction of sample {i}')
-		psnr = PSNR(recon[0, 0].cpu().numpy(), ground_truth[0, 0].cpu().numpy())
-		ssim = SSIM(recon[0, 0].cpu().numpy(), ground_truth[0, 0].cpu().numpy())
-		_psnr.append(psnr)
-		_ssim.append(ssim)
-		print('PSNR:', psnr)
-		print('SSIM:', ssim)
+			print(f'reconstruction of sample {idx}')
+			psnr = PSNR(recon[j, 0].cpu().numpy(), ground_truth[j, 0].cpu().numpy())
+			ssim = SSIM(recon[j, 0].cpu().numpy(), ground_truth[j, 0].cpu().numpy())
+			_psnr.append(psnr)
+			_ssim.append(ssim)
+			print('PSNR:', psnr)
+			print('SSIM:', ssim)
+		if checkpoint_path is not None and os.path.exists(checkpoint_path):
+			os.remove(checkpoint_path)
 		"""
 		_, (ax1, ax2, ax3) = plt.subplots(1,3)
 		ax1.imshow(ground_truth[0,0,:,:].detach().cpu(), cmap='gray')
@@ -138,4 +228,6 @@ def coordinator(args):
 
 if __name__ == '__main__':
 	args = parser.parse_args()
+	if args.grad_checkpoint_blocks is not None and args.model != 'openai_unet':
+		parser.error('--grad_checkpoint_blocks requires --model openai_unet (dds_unet has no gradient checkpointing)')
 	coordinator(args)
\ No newline at end of file
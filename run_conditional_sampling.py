@@ -1,3 +1,4 @@
+import os
 import argparse
 import yaml 
 import torch 
@@ -15,19 +16,39 @@ parser.add_argument('--model', default='openai_unet', help='select unet arch.',
 parser.add_argument('--base_path', default='/localdata/AlexanderDenker/score_based_baseline', help='path to model configs')
 parser.add_argument('--model_learned_on', default='lodopab', help='model-checkpoint to load', choices=['lodopab', 'ellipses', 'aapm', "knee"])
 parser.add_argument('--version', default=1, help="version of the model")
-parser.add_argument('--method',  default='naive', choices=['naive', 'dps', 'dds'])
+parser.add_argument('--method',  default='naive', choices=['naive', 'dps', 'dds', 'dpms'])
 parser.add_argument('--add_corrector_step', action='store_true')
 parser.add_argument('--ema', action='store_true')
 parser.add_argument('--num_steps', default=1000)
 parser.add_argument('--penalty', default=1, help='reg. penalty used for ``naive'' and ``dps'' only.')
+parser.add_argument('--jacobian_free', action='store_true', help='``dps'' without backprop. through the score model (Tweedy Jacobian approx. by a scaled identity).')
 parser.add_argument('--gamma', default=0.01, help='reg. used for ``dds''.')
 parser.add_argument('--eta', default=0.15, help='reg. used for ``dds'' weighting stochastic and deterministic noise.')
 parser.add_argument('--pct_chain_elapsed', default=0,  help='``pct_chain_elapsed'' actives init of chain')
 parser.add_argument('--sde', default='vesde', choices=['vpsde', 'vesde', 'ddpm'])
 parser.add_argument('--cg_iter', default=5)
+parser.add_argument('--solver_order', default=2, help='order of the multistep solver used for ``dpms''.')
 parser.add_argument('--load_path', help='path to ddpm model.')
 parser.add_argument('--stddev', default=None, help="noise_level")
-parser.add_argument('--early_stopping_pct', default=1.0, help="early stop sampling. Only used for DDPM and DPS.")
+parser.add_argument('--time_grid', default='linear', choices=['linear', 'uniform'], help="``uniform'' takes num_steps + 1 equispaced points ending on eps, as progressively distilled models do.")
+parser.add_argument('--early_stopping_pct', default=1.0, help="early stop sampling at a fixed fraction of the chain.")
+parser.add_argument('--es_tol', default=None, help='stop once the rel. change of ``es_criterion'' stays below ``es_tol''.')
+parser.add_argument('--es_patience', default=5, help='num. of consecutive converged steps before stopping.')
+parser.add_argument('--es_criterion', default='xhat0', choices=['xhat0', 'residual'], help='monitor the Tweedy estimate or the data residual.')
+parser.add_argument('--es_check_freq', default=1, help='check convergence every ``es_check_freq'' steps (each check syncs with the host).')
+parser.add_argument('--checkpoint_freq', default=None, help='snapshot the sampling state every ``checkpoint_freq'' steps.')
+parser.add_argument('--resume', action='store_true', help='skip finished samples and resume from the last snapshot.')
+parser.add_argument('--num_img_in_log', default=1, help='log the reco. every ``num_img_in_log'' steps.')
+parser.add_argument('--num_scalar_in_log', default=1, help='log the PSNR every ``num_scalar_in_log'' steps.')
+parser.add_argument('--grad_checkpoint_blocks', default=None, nargs='+', help='recompute activations of these blocks in backward passes, e.g. of DPS or adaptation (openai_unet only).')
+parser.add_argument('--compile', action='store_true', help='compile the sampling step (falls back to compiling the score model only).')
+parser.add_argument('--compile_mode', default=None, choices=['default', 'max-autotune-no-cudagraphs'], help='``torch.compile'' mode.')
+parser.add_argument('--compile_cache_dir', default=None, help='dir. of compiled artifacts, reused across runs.')
+parser.add_argument('--picard_window', default=None, help='num. of time steps solved in parallel by Picard iterations (``dds'' only).')
+parser.add_argument('--picard_tol', default=1e-3, help='rel. change below which a step of the Picard window is accepted.')
+parser.add_argument('--sync_free', action='store_true', help='keep per-step scalars on device and defer logging.')
+parser.add_argument('--count_syncs', action='store_true', help='debug: count device-to-host syncs per sampling step (CUDA only, nothing is counted on CPU).')
+parser.add_argument('--batch_size', default=1, help='num. of observations reconstructed jointly in one chain.')
 
 def coordinator(args):
 	config, dataconfig = get_standard_configs(args, base_path=args.base_path)
@@ -46,11 +67,14 @@ def coordinator(args):
 	sde = get_standard_sde(config=config)
 	score = get_standard_score(config=config, sde=sde, use_ema=args.ema, model_type=args.model)
 	score = score.to(config.device).eval()
+	if args.grad_checkpoint_blocks is not None:
+		score.enable_checkpointing(blocks=args.grad_checkpoint_blocks)
 	ray_trafo = get_standard_ray_trafo(config=dataconfig)
 	ray_trafo = ray_trafo.to(device=config.device)
 	dataset = get_standard_dataset(config=dataconfig, ray_trafo=ray_trafo)
 	print("Number of parameters: ", sum([p.numel() for p in score.parameters()]))
 	_psnr, _ssim = [], []
+	batch = []
 	for i, data_sample in enumerate(islice(dataset, dataconfig.data.validation.num_images)):
 		if config.seed is not None:
 			torch.manual_seed(config.seed + i)  # for reproducible noise in simulate
@@ -67,9 +91,30 @@ def coordinator(args):
 				ray_trafo=ray_trafo,
 				white_noise_rel_stddev=dataconfig.data.stddev
 				)
+		batch.append((i, ground_truth, observation, filtbackproj))
+		if len(batch) < int(args.batch_size) and i < min(len(dataset), dataconfig.data.validation.num_images) - 1:
+			continue
+		
+		# observations in ``batch'' are reconstructed jointly
+		indices = [idx for idx, *_ in batch]
+		ground_truth, observation, filtbackproj = [torch.cat(data, dim=0) for data in list(zip(*batch))[1:]]
+		batch = []
+		sample_num = indices[0] if len(indices) == 1 else f'{indices[0]}-{indices[-1]}'
+		if args.resume and all([(save_root / f'recon_{idx}_info.pt').exists() for idx in indices]):
+			print(f'skip finished sample(s) {sample_num}')
+			for idx in indices:
+				info = torch.load(str(save_root / f'recon_{idx}_info.pt'))
+				_psnr.append(PSNR(info['recon'].numpy(), info['ground_truth'].numpy()))
+				_ssim.append(SSIM(info['recon'].numpy(), info['ground_truth'].numpy()))
+			continue
+		checkpoint_path = None
+		if args.checkpoint_freq is not None:
+			checkpoint_path = str(save_root / f'sampling_state_{sample_num}.pt')
+			if not args.resume and os.path.exists(checkpoint_path):
+				os.remove(checkpoint_path)
 
-		logg_kwargs = {'log_dir': save_root, 'num_img_in_log': 1,
-			'sample_num':i, 'ground_truth': ground_truth, 'filtbackproj': filtbackproj}
+		logg_kwargs = {'log_dir': save_root, 'num_img_in_log': int(args.num_img_in_log), 'num_scalar_in_log': int(args.num_scalar_in_log),
+			'sample_num': sample_num, 'ground_truth': ground_truth, 'filtbackproj': filtbackproj}
 		sampler = get_standard_sampler(
 			args=args,
 			config=config,
@@ -81,20 +126,23 @@ def coordinator(args):
 			device=config.device
 			)
 		
-		recon = sampler.sample(logg_kwargs=logg_kwargs)
+		recon = sampler.sample(logg_kwargs=logg_kwargs, checkpoint_path=checkpoint_path)
 		recon = torch.clamp(recon, 0)
-		torch.save(		{'recon': recon.cpu().squeeze(), 'ground_truth': ground_truth.cpu().squeeze()}, 
-			str(save_root / f'recon_{i}_info.pt')	)
-		im = Image.fromarray(recon.cpu().squeeze().numpy()*255.).convert("L")
-		im.save(str(save_root / f'recon_{i}.png'))
+		for j, idx in enumerate(indices):
+			torch.save(		{'recon': recon[j].cpu().squeeze(), 'ground_truth': ground_truth[j].cpu().squeeze()}, 
+				str(save_root / f'recon_{idx}_info.pt')	)
+			im = Image.fromarray(recon[j].cpu().squeeze().numpy()*255.).convert("L")
+			im.save(str(save_root / f'recon_{idx}.png'))
 
-		print(f'reconstruction of sample {i}'	)
-		psnr = PSNR(recon[0, 0].cpu().numpy(), ground_truth[0, 0].cpu().numpy())
-		ssim = SSIM(recon[0, 0].cpu().numpy(), ground_truth[0, 0].cpu().numpy())	
-		print('PSNR:', psnr)
-		print('SSIM:', ssim)
-		_psnr.append(psnr)
-		_ssim.append(ssim)
+			print(f'reconstruction of sample {idx}'	)
+			psnr = PSNR(recon[j, 0].cpu().numpy(), ground_truth[j, 0].cpu().numpy())
+			ssim = SSIM(recon[j, 0].cpu().numpy(), ground_truth[j, 0].cpu().numpy())	
+			print('PSNR:', psnr)
+			print('SSIM:', ssim)
+			_psnr.append(psnr)
+			_ssim.append(ssim)
+		if checkpoint_path is not None and os.path.exists(checkpoint_path):
+			os.remove(checkpoint_path)
 		
 		#fig, (ax1, ax2, ax3) = plt.subplots(1,3)
 		#im = ax1.imshow(ground_truth[0,0,:,:].detach().cpu(), cmap='gray')
@@ -123,4 +171,6 @@ def coordinator(args):
 
 if __name__ == '__main__':
 	args = parser.parse_args()
+	if args.grad_checkpoint_blocks is not None and args.model != 'openai_unet':
+		parser.error('--grad_checkpoint_blocks requires --model openai_unet (dds_unet has no gradient checkpointing)')
 	coordinator(args)
\ No newline at end of file
@@ -3,19 +3,30 @@ import yaml
 import argparse
 from omegaconf import OmegaConf
 
-from src import (get_standard_sde, score_model_simple_trainer, get_standard_score, 
-		 get_standard_train_dataset)
+from src import (get_standard_sde, score_model_simple_trainer, score_model_distillation_trainer, 
+		 get_standard_score, get_standard_train_dataset)
 
 parser = argparse.ArgumentParser(description='training')
 parser.add_argument('--sde', default='vesde', choices=['vpsde', 'vesde', 'ddpm'])
 parser.add_argument('--base_path', default='/localdata/AlexanderDenker/score_based_baseline')
 parser.add_argument('--train_model_on', default='ellipses', help='training datasets', choices=['lodopab', 'lodopab_dival', 'ellipses'])
 parser.add_argument("--model_type", default="openai_unet", choices=["openai_unet", "dds_unet"])
+parser.add_argument('--grad_checkpoint_blocks', default=None, nargs='+', help='recompute activations of these blocks in the backward pass (openai_unet only).')
+parser.add_argument('--distill_from', default=None, help='dir. of a trained model (``report.yaml'', ``model.pt'') to progressively distill.')
+parser.add_argument('--distill_use_ema', action='store_true', help='distill the ema weights (``ema_model.pt'').')
+parser.add_argument('--distill_num_steps', default=256, help='num. of sampl. steps of the first student (its teacher takes twice as many).')
+parser.add_argument('--distill_final_steps', default=8, help='distill until the student takes this num. of sampl. steps.')
+parser.add_argument('--distill_num_iters', default=10000, help='num. of optimization steps per distillation round.')
 
 def coordinator(args):
 
 	# different configs formats for different models, ugly but works for now 
-	if args.model_type == "openai_unet":
+	if args.distill_from is not None: # the student inherits the config of the teacher
+		assert args.model_type == "openai_unet"
+		with open(os.path.join(args.distill_from, 'report.yaml'), 'r') as stream:
+			config = yaml.load(stream, Loader=yaml.UnsafeLoader)
+			config.sampling.load_model_from_path = args.distill_from
+	elif args.model_type == "openai_unet":
 		if args.train_model_on == 'ellipses': 
 			from configs.disk_ellipses_configs import get_config
 			config = get_config(args)
@@ -36,7 +47,8 @@ def coordinator(args):
 			raise NotImplementedError
 	print(config)
 	sde = get_standard_sde(config=config)
-	score = get_standard_score(config=config, sde=sde, use_ema=False, load_model=False, model_type=args.model_type)
+	score = get_standard_score(config=config, sde=sde, use_ema=args.distill_use_ema, 
+		load_model=args.distill_from is not None, model_type=args.model_type)
 
 	print("Number of parameters: ", sum([p.numel() for p in score.parameters()]))
 
@@ -73,6 +85,31 @@ def coordinator(args):
 			yaml.dump(OmegaConf.to_container(config, resolve=True), file)
 
 	train_dl = get_standard_train_dataset(config)
+	if args.distill_from is not None:
+		with open(os.path.join(log_dir,'distillation.yaml'), 'w') as file:
+			yaml.dump({'teacher': args.distill_from, 'use_ema': args.distill_use_ema, 
+				'num_steps': int(args.distill_num_steps), 'final_num_steps': int(args.distill_final_steps), 
+				'time_grid': 'uniform'}, file)
+		score_model_distillation_trainer(
+				teacher=score.to(config.device),
+				sde=sde,
+				train_dl=train_dl,
+				optim_kwargs={
+						'lr': float(config.training.lr),
+						'log_freq': config.training.log_freq,
+						'ema_decay': config.training.ema_decay
+					},
+				distill_kwargs={
+						'num_steps': int(args.distill_num_steps),
+						'final_num_steps': int(args.distill_final_steps),
+						'num_iters': int(args.distill_num_iters),
+						'eps': config.sampling.eps
+					},
+			device=config.device,
+			grad_checkpoint_blocks=args.grad_checkpoint_blocks,
+			log_dir=log_dir
+			)
+		return
 	score_model_simple_trainer(
 			score=score.to(config.device),
 			sde=sde,
@@ -93,9 +130,12 @@ def coordinator(args):
 					'sample_freq' : config.validation.sample_freq
 				},
 		device=config.device,
+		grad_checkpoint_blocks=args.grad_checkpoint_blocks,
 		log_dir=log_dir
 		)
 
 if __name__ == '__main__':
 	args = parser.parse_args()
+	if args.grad_checkpoint_blocks is not None and args.model_type != 'openai_unet':
+		parser.error('--grad_checkpoint_blocks requires --model_type openai_unet (dds_unet has no gradient checkpointing)')
 	coordinator(args)
@@ -2,12 +2,13 @@ from .dataset import (EllipseDatasetFromDival, LoDoPabDatasetFromDival, MayoData
     get_disk_dist_ellipses_dataset, get_walnut_data, get_one_ellipses_dataset, LoDoPabChallenge, SubsetLoDoPab)
 from .utils import (VESDE, VPSDE, DDPM, SDE, _SCORE_PRED_CLASSES, _EPSILON_PRED_CLASSES, 
     score_based_loss_fn, epsilon_based_loss_fn, PSNR, SSIM, ExponentialMovingAverage,
-    score_model_simple_trainer, get_standard_dataset, get_data_from_ground_truth, get_standard_score,
+    score_model_simple_trainer, score_model_distillation_trainer, get_standard_dataset, get_data_from_ground_truth, get_standard_score,
     get_standard_ray_trafo, get_standard_sampler, get_standard_path, 
     get_standard_configs, get_standard_sde, get_standard_train_dataset,
-    get_standard_adapted_sampler, get_standard_dataset_configs)
+    get_standard_adapted_sampler, get_standard_dataset_configs, get_standard_adaptation_session, 
+    get_standard_adapter_key, get_standard_calibrated_adapter, load_score_checkpoint)
 from .third_party_models import OpenAiUNetModel, UNetModel
 from .samplers import (BaseSampler, Euler_Maruyama_sde_predictor, 
         Langevin_sde_corrector, wrapper_ddim, adapted_ddim_sde_predictor, 
-        tv_loss, _adapt, _score_model_adpt, Ancestral_Sampling)
+        tv_loss, _adapt, _score_model_adpt, Ancestral_Sampling, AdaptationSession, AdapterBank, AdaptationScheduler, LoraRankPruner, CompiledPredictor, PicardSampler)
 from .physics import SimpleTrafo, SimulatedDataset, simulate, get_walnut_2d_ray_trafo, LoDoPabTrafo, ReSize
\ No newline at end of file
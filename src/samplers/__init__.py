@@ -1,5 +1,8 @@
 from .base_sampler import BaseSampler
-from .adaptation import tv_loss, _score_model_adpt
+from .picard_sampler import PicardSampler
+from .compiled_step import CompiledPredictor
+from .adaptation import tv_loss, _score_model_adpt, AdaptationSession, AdapterBank, AdaptationScheduler, LoraRankPruner
 from .utils import (Euler_Maruyama_sde_predictor, Langevin_sde_corrector, chain_simple_init, apTweedy,
     decomposed_diffusion_sampling_sde_predictor, adapted_ddim_sde_predictor, 
-    _adapt, _schedule_jump, ddim, wrapper_ddim, Ancestral_Sampling)
\ No newline at end of file
+    _adapt, _schedule_jump, ddim, wrapper_ddim, Ancestral_Sampling, 
+    dpm_solver_sde_predictor, _get_adaptation_optimizer)
\ No newline at end of file
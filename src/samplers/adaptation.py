@@ -1,14 +1,21 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, Sequence
 
+import json
+import hashlib
 import torch 
 import torch.nn as nn
-from src.third_party_models import inject_trainable_lora_extended
 
-def tv_loss(x):
+from pathlib import Path
+from src.utils.checkpoint import get_trainable_state, load_trainable_state, save_sampling_state
+from src.third_party_models import (inject_trainable_lora_extended, get_lora_registry, BatchedLoraInjected, 
+    inject_batched_bias_offsets, set_lora_rank, match_lora_ranks)
+
+def tv_loss(x, per_sample: bool = False):
 
     dh = torch.abs(x[..., :, 1:] - x[..., :, :-1])
     dw = torch.abs(x[..., 1:, :] - x[..., :-1, :])
-    return torch.sum(dh[..., :-1, :] + dw[..., :, :-1])
+    tv = dh[..., :-1, :] + dw[..., :, :-1]
+    return tv.flatten(1).sum(dim=1) if per_sample else torch.sum(tv)
 
 def _score_model_adpt(
     score: nn.Module, 
@@ -36,10 +43,23 @@ def _score_model_adpt(
          + retraining all biases (only a negligible number of parameters)
         """
         score.requires_grad_(False)
-        for name, param in score.named_parameters():
-            if "bias" in name and not "emb_layers" in name:
-                param.requires_grad = True
+        adpt_kwargs = dict(adpt_kwargs)
+        biases_in_blocks_only = adpt_kwargs.pop('biases_in_blocks_only', False)
         inject_trainable_lora_extended(score, **adpt_kwargs)
+        # with ``biases_in_blocks_only'' biases are retrained in the LoRA blocks only (the timestep embedding 
+        # counts as encoder), i.e. LoRA restricted to ``output_blocks'' and ``out'' leaves the encoder frozen
+        include_blocks = list(adpt_kwargs.get('include_blocks', ['input_blocks', 'middle_block', 'output_blocks', 'out']))
+        if 'input_blocks' in include_blocks or 'middle_block' in include_blocks:
+            include_blocks.append('time_embed')
+        biases = [(name, param) for name, param in score.named_parameters() if "bias" in name and not "emb_layers" in name 
+            and (not biases_in_blocks_only or name.split('.')[0] in include_blocks)]
+        num_adapters = adpt_kwargs.get('num_adapters', 1)
+        if num_adapters == 1:
+            for name, param in biases:
+                param.requires_grad = True
+        else: # per-sample adapters retrain per-sample offsets of the shared (frozen) biases
+            inject_batched_bias_offsets(score, [score.get_submodule(name.rsplit('.', 1)[0]) for name, _ in biases], 
+                num_adapters=num_adapters)
     elif impl == 'dif-fit':
         raise NotImplementedError
     else: 
@@ -49,3 +69,268 @@ def _score_model_adpt(
         num_params = sum([p.numel() for p in score.parameters()])
         trainable_params = sum([p.numel() for p in score.parameters() if p.requires_grad])
         print(f'% of trainable params: {trainable_params/num_params*100}')
+
+class AdaptationSession:
+    """
+    Adapts ``score'' in place, sample after sample. The base weights made trainable by ``_score_model_adpt'' 
+    are snapshot once in memory; ``reset'' restores them and re-initialises the injected LoRA modules, 
+    instead of rebuilding the model from its checkpoint before every sample.
+    """
+    def __init__(self, 
+        score: nn.Module, 
+        impl: str = 'full', 
+        adpt_kwargs: Optional[Dict] = None,
+        verbose: bool = True,
+        warm_start: Optional[Dict] = None
+        ) -> None:
+
+        self.score = score
+        self.impl = impl
+        _score_model_adpt(score, impl=impl, adpt_kwargs=adpt_kwargs, verbose=verbose)
+        self._base_params = {name: param.detach().clone() 
+            for name, param in score.named_parameters() if param.requires_grad and not 'lora_' in name}
+        # adapter (e.g. from an ``AdapterBank'') swapped in by every ``reset'', instead of starting LoRA from zero
+        self.warm_start = warm_start
+        registry = get_lora_registry(score)
+        self._ranks = [module.r for module in registry.modules] if registry is not None else []
+
+    @torch.no_grad()
+    def reset(self) -> nn.Module:
+
+        params = dict(self.score.named_parameters())
+        for name, value in self._base_params.items():
+            params[name].copy_(value)
+        registry = get_lora_registry(self.score)
+        if registry is not None:
+            for module, r in zip(registry.modules, self._ranks):
+                if module.r != r: # pruned by a ``LoraRankPruner''
+                    set_lora_rank(module, r=r)
+                module.reset_lora_parameters()
+                module.unmerge() # subtracts the update folded into the base weight by ``merge_lora''
+            registry.scale = 1.
+        if self.warm_start is not None:
+            AdapterBank.swap(self.score, self.warm_start)
+        self.score.eval()
+
+        return self.score
+
+class AdapterBank:
+    """
+    Trained adapters, i.e. the trainable parameters after ``_score_model_adpt'' (LoRA factors and biases for LoRA), 
+    stored as small standalone files in ``root''. Adapters are keyed by base checkpoint, domain and adaptation 
+    setting, see ``AdapterBank.key'', and can be swapped into a live model without touching its frozen weights.
+    """
+    def __init__(self, root: str) -> None:
+
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(
+        base_ckpt: str, 
+        domain: str, 
+        impl: str = 'lora', 
+        rank: Optional[int] = None, 
+        include_blocks: Optional[Sequence[str]] = None,
+        extra: Optional[Dict] = None
+        ) -> str:
+        """``extra'' holds further (json-serialisable) settings the adapter depends on, e.g. the forward operator"""
+        desc = json.dumps([str(base_ckpt), impl, rank, sorted(include_blocks) if include_blocks is not None else None, 
+            extra], sort_keys=True, default=str)
+        return f'{domain}_{impl}_{hashlib.sha1(desc.encode()).hexdigest()[:12]}'
+
+    def path(self, key: str) -> Path:
+        return self.root / f'{key}.pt'
+
+    def __contains__(self, key: str) -> bool:
+        return self.path(key).exists()
+
+    def save(self, key: str, score: nn.Module, meta: Optional[Dict] = None) -> None:
+        save_sampling_state(str(self.path(key)), {'params': get_trainable_state(score), 'meta': meta or {}})
+
+    def load(self, key: str) -> Dict:
+        return torch.load(str(self.path(key)))['params']
+
+    @staticmethod
+    def swap(score: nn.Module, params: Dict) -> None:
+        """
+        hot-swaps ``params'' into ``score'' in place, the adapter has to cover the live model's trainable parameters. 
+        Only these are written, i.e. entries for parameters frozen in ``score'' (e.g. biases of a batched LoRA, 
+        which ``AdaptationSession'' does not restore) are skipped. A single adapter is broadcast to all adapters 
+        of a batched LoRA, its retrained biases to the ``bias_offsets'' from the frozen ones.
+        """
+        match_lora_ranks(score, params)
+        live = dict(score.named_parameters())
+        trainable = {name for name, param in live.items() if param.requires_grad}
+        params = dict(params)
+        for name in trainable - set(params):
+            bias_name = name[:-len('bias_offsets')] + 'bias'
+            if name.endswith('bias_offsets') and bias_name in params:
+                params[name] = params[bias_name].to(live[bias_name].device) - live[bias_name].detach()
+        assert trainable <= set(params), 'adapter does not match the adapted score model'
+        load_trainable_state(score, {name: value for name, value in params.items() if name in trainable})
+
+class AdaptationScheduler:
+    """
+    Decides when, and for how many iterations, ``_adapt'' runs, from the adaptation loss instead of a fixed stride:
+        ``window'': adapt only for ``t/T'' in [``window[0]'', ``window[1]''] (``t/T = 1'' is pure noise).
+        ``rel_tol'': stop the inner iterations once the relative improvement of the loss falls below ``rel_tol''.
+        ``skip_tol'': skip an adaptation call if its initial loss differs by less than ``skip_tol'' (relative) 
+            from the final loss of the last adaptation, at most ``max_skip'' times in a row.
+    Losses are tracked per adapter (i.e. per sample of a batched LoRA). The adapters of a batch share the calls 
+    and iterations, hence a call is only skipped if every adapter may skip it, and the iterations only stop 
+    once every adapter has converged; an adapter is never stopped by the losses of the others.
+    Monitoring the loss syncs with the host once per inner iteration.
+    """
+    def __init__(self, 
+        rel_tol: Optional[float] = None, 
+        skip_tol: Optional[float] = None, 
+        window: Optional[Sequence[float]] = None,
+        max_skip: Optional[int] = None
+        ) -> None:
+
+        self.rel_tol = rel_tol
+        self.skip_tol = skip_tol
+        self.window = window
+        self.max_skip = max_skip
+        self.last_loss = None
+        self.num_skipped = 0 # in a row
+        self.num_calls = 0
+        self.num_optim_steps = 0
+
+    def is_active(self, t: float) -> bool:
+        return self.window is None or self.window[0] <= t <= self.window[1]
+
+    def skip(self, loss: Sequence[float]) -> bool:
+        
+        if self.skip_tol is None or self.last_loss is None or len(loss) != len(self.last_loss) or (
+                self.max_skip is not None and self.num_skipped >= self.max_skip):
+            return False
+        if all([abs(l - l_last) < self.skip_tol * abs(l_last) for l, l_last in zip(loss, self.last_loss)]):
+            self.num_skipped += 1
+            return True
+        return False
+
+    def converged(self, loss: Sequence[float], loss_prev: Sequence[float]) -> bool:
+        return self.rel_tol is not None and all(
+            [(l_prev - l) < self.rel_tol * abs(l_prev) for l, l_prev in zip(loss, loss_prev)])
+
+    def update(self, loss: Sequence[float], num_optim_steps: int) -> None:
+
+        self.last_loss = list(loss)
+        self.num_skipped = 0
+        self.num_calls += 1
+        self.num_optim_steps += num_optim_steps
+
+    def state_dict(self) -> Dict:
+        return {'last_loss': self.last_loss, 'num_skipped': self.num_skipped, 
+            'num_calls': self.num_calls, 'num_optim_steps': self.num_optim_steps}
+
+    def load_state_dict(self, state: Dict) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+
+class LoraRankPruner:
+    """
+    Adaptive LoRA rank, cf. AdaLoRA (https://arxiv.org/abs/2303.10512). The importance of each rank component 
+    (``lora_up[:, j]'', ``lora_down[j]'') is an EMA of its sensitivity ``|w * grad|'', accumulated by ``_adapt''. 
+    Every ``prune_freq'' adaptation calls the least important ``prune_pct'' of all remaining components are pruned, 
+    globally over the modules and down to an average rank of ``target_rank''. The LoRA factors are physically shrunk 
+    (modules losing all components are switched off), so later forward and backward passes get cheaper. 
+    ``optim'' is re-pointed to the shrunk factors, with its moment estimates sliced accordingly.
+    """
+    def __init__(self, 
+        score: nn.Module, 
+        target_rank: float, 
+        prune_freq: int = 1, 
+        prune_pct: float = 0.25, 
+        beta: float = 0.85,
+        optim: Optional[torch.optim.Optimizer] = None
+        ) -> None:
+
+        self.registry = get_lora_registry(score)
+        assert self.registry is not None and not any(
+            [isinstance(module, BatchedLoraInjected) for module in self.registry.modules])
+        self.target_rank = target_rank
+        self.prune_freq = prune_freq
+        self.prune_pct = prune_pct
+        self.beta = beta
+        self.optim = optim
+        self.importance = [None for _ in self.registry.modules]
+        self.num_calls = 0
+
+    @torch.no_grad()
+    def accumulate(self) -> None:
+        """called after every backward pass of ``_adapt''"""
+        for k, module in enumerate(self.registry.modules):
+            down, up = module.lora_down.weight, module.lora_up.weight
+            if module.r == 0 or down.grad is None or up.grad is None:
+                continue
+            sensitivity = (down * down.grad).abs().flatten(1).sum(dim=1) + (
+                up * up.grad).abs().transpose(0, 1).flatten(1).sum(dim=1)
+            self.importance[k] = sensitivity if self.importance[k] is None else (
+                self.beta * self.importance[k] + (1 - self.beta) * sensitivity)
+
+    def step(self, optim: Optional[torch.optim.Optimizer] = None) -> None:
+        """called once per adaptation call"""
+        self.num_calls += 1
+        if self.num_calls % self.prune_freq == 0:
+            self.prune(optim=optim if optim is not None else self.optim)
+
+    @torch.no_grad()
+    def prune(self, optim: Optional[torch.optim.Optimizer] = None) -> None:
+
+        modules = self.registry.modules
+        ranks = [module.r for module in modules]
+        budget = max(int(self.target_rank * len(modules)), int(sum(ranks) * (1 - self.prune_pct)))
+        if budget >= sum(ranks) or any([self.importance[k] is None for k, r in enumerate(ranks) if r > 0]):
+            return
+        importance = torch.cat([self.importance[k] for k, r in enumerate(ranks) if r > 0])
+        keep_mask = torch.zeros_like(importance, dtype=torch.bool)
+        keep_mask[importance.topk(budget).indices] = True
+        keep_masks = iter(keep_mask.split([r for r in ranks if r > 0]))
+        for k, module in enumerate(modules):
+            if module.r == 0:
+                continue
+            mask = next(keep_masks)
+            if not mask.all():
+                self._resize(k, keep=mask.nonzero().squeeze(1), optim=optim)
+
+    def _resize(self, 
+        k: int, 
+        keep: Optional[torch.Tensor] = None, 
+        r: Optional[int] = None, 
+        optim: Optional[torch.optim.Optimizer] = None
+        ) -> None:
+
+        module = self.registry.modules[k]
+        old = [module.lora_down.weight, module.lora_up.weight]
+        set_lora_rank(module, keep=keep, r=r)
+        new = [module.lora_down.weight, module.lora_up.weight]
+        self.importance[k] = self.importance[k][keep] if (keep is not None and self.importance[k] is not None) else None
+        if optim is None:
+            return
+        for dim, (param_old, param_new) in enumerate(zip(old, new)): # ranks are dim. 0 of ``lora_down'', 1 of ``lora_up''
+            for group in optim.param_groups:
+                group['params'] = [param_new if param is param_old else param for param in group['params']]
+            state = optim.state.pop(param_old, None)
+            if state and keep is not None:
+                # moments shaped as the parameter (Adam) as well as factored ones (Adafactor's ``row_var'' of 
+                # ``lora_down'' and ``col_var'' of ``lora_up'') hold one entry per rank
+                optim.state[param_new] = {name: value.index_select(dim, keep) if (
+                    isinstance(value, torch.Tensor) and value.ndim == param_old.ndim 
+                    and value.shape[dim] == param_old.shape[dim]) else value 
+                    for name, value in state.items()}
+
+    def state_dict(self) -> Dict:
+        return {'ranks': [module.r for module in self.registry.modules], 'num_calls': self.num_calls, 
+            'importance': [value.cpu() if value is not None else None for value in self.importance]}
+
+    def load_state_dict(self, state: Dict) -> None:
+        # re-creates the factors at the pruned ranks, their values and the state of ``optim'' are restored afterwards
+        for k, (module, r) in enumerate(zip(self.registry.modules, state['ranks'])):
+            if module.r != r:
+                self._resize(k, r=r, optim=self.optim)
+        device = self.registry.modules[0].lora_down.weight.device
+        self.importance = [value.to(device) if value is not None else None for value in state['importance']]
+        self.num_calls = state['num_calls']
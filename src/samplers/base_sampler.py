@@ -4,16 +4,17 @@ Inspired to https://github.com/yang-song/score_sde_pytorch/blob/main/sampling.py
 from typing import Optional, Any, Dict, Tuple
 
 import os
-import torchvision
+import warnings
 import numpy as np
 import torch
 
 from tqdm import tqdm
 from torch import Tensor
-from torch.utils.tensorboard import SummaryWriter
 
-from .utils import _schedule_jump
-from ..utils import SDE, _EPSILON_PRED_CLASSES, _SCORE_PRED_CLASSES, PSNR
+from .utils import _schedule_jump, _relative_change
+from ..utils import (SDE, NoiseSchedule, SyncCounter, get_logsnr_time_steps, _EPSILON_PRED_CLASSES, _SCORE_PRED_CLASSES, 
+    PSNR_on_device, AsyncSummaryWriter, get_rng_state, set_rng_state, get_trainable_state, load_trainable_state, 
+    save_sampling_state, load_sampling_state)
 from ..third_party_models import OpenAiUNetModel
 
 class BaseSampler:
@@ -35,58 +36,140 @@ class BaseSampler:
         self.corrector = corrector
         self.device = device
     
-    def sample(self,
-        logg_kwargs: Dict = {},
-        logging: bool = True 
-        ) -> Tensor:
-
-        if logging:
-            writer = SummaryWriter(log_dir=os.path.join(logg_kwargs['log_dir'], str(logg_kwargs['sample_num'])))
-        
+    def _time_grid(self) -> Tuple[np.ndarray, list, Any]:
+        """
+        The time steps, the ``(t, tminus1)'' pairs of the steps and the sequence iterated over, i.e. 
+        ``time_steps'' for score-prediction and ``time_pairs'' for epsilon-prediction classes. 
+        With ``time_grid'' set to ``uniform'' the steps run over ``num_steps + 1'' equispaced points from ``t = 1'' 
+        to ``eps'' (from ``T - 1'' to ``-1'' for epsilon-prediction classes), i.e. the grid of ``num_steps / 2'' steps 
+        is every other point of it, as taken by progressively distilled students (see ``distillation_loss_fn'').
+        """
         num_steps = self.sample_kwargs['num_steps']
+        time_grid = self.sample_kwargs.get('time_grid', 'linear')
         __iter__ = None
         if any([isinstance(self.sde, classname) for classname in _SCORE_PRED_CLASSES]):
-            time_steps = np.linspace(
-                1., self.sample_kwargs['eps'], self.sample_kwargs['num_steps'])
+            if time_grid in ['logsnr', 'uniform']:
+                if time_grid == 'logsnr':
+                    # only meaningful for predictors relying on ``coeffs'' (e.g. ``dpm_solver_sde_predictor'')
+                    time_steps = get_logsnr_time_steps(
+                        self.sde, num_steps=self.sample_kwargs['num_steps'], t_min=self.sample_kwargs['eps'])
+                else:
+                    time_steps = np.linspace(1., self.sample_kwargs['eps'], num_steps + 1)
+                time_pairs = list(zip(time_steps[:-1], time_steps[1:]))
+                time_steps = time_steps[:-1]
+            else:
+                time_steps = np.linspace(
+                    1., self.sample_kwargs['eps'], self.sample_kwargs['num_steps'])
+                time_pairs = [(t, t - (time_steps[0] - time_steps[1])) for t in time_steps]
             __iter__ = time_steps
+            if self.sample_kwargs.get('early_stopping_pct', 1.) < 1.:
+                __iter__ = time_steps[:int(self.sample_kwargs['early_stopping_pct']*len(time_steps))]
+                time_pairs = time_pairs[:len(__iter__)]
+                print('Use early stopping. Run for ', len(__iter__), ' timesteps. Stop at time step ', __iter__[-1])
         elif any([isinstance(self.sde, classname) for classname in _EPSILON_PRED_CLASSES]):
             assert self.sde.num_steps >= num_steps
-            skip = self.sde.num_steps // num_steps
-            # if ``self.sample_kwargs['travel_length']'' is 1. and ''self.sample_kwargs['travel_repeat']'' is 1. 
-            # ``_schedule_jump'' behaves as ``np.arange(-1. num_steps, 1)[::-1]''
-            time_steps = _schedule_jump(num_steps, self.sample_kwargs['travel_length'], self.sample_kwargs['travel_repeat']) 
-            time_pairs = list((i*skip, j*skip if j>0 else -1)  for i, j in zip(time_steps[:-1], time_steps[1:]))            
-            try:
+            if time_grid == 'uniform':
+                time_steps = np.round(np.linspace(self.sde.num_steps - 1, -1, num_steps + 1)).astype(int)
+                time_pairs = list((int(i), int(j)) for i, j in zip(time_steps[:-1], time_steps[1:]))
+            else:
+                skip = self.sde.num_steps // num_steps
+                # if ``self.sample_kwargs['travel_length']'' is 1. and ''self.sample_kwargs['travel_repeat']'' is 1. 
+                # ``_schedule_jump'' behaves as ``np.arange(-1. num_steps, 1)[::-1]''
+                time_steps = _schedule_jump(num_steps, self.sample_kwargs['travel_length'], self.sample_kwargs['travel_repeat']) 
+                time_pairs = list((i*skip, j*skip if j>0 else -1)  for i, j in zip(time_steps[:-1], time_steps[1:]))            
+            if self.sample_kwargs.get('early_stopping_pct', 1.) < 1.:
                 time_pairs = time_pairs[:int(self.sample_kwargs['early_stopping_pct']*len(time_pairs))]
                 print('Use early stopping. Run for ', len(time_pairs), ' timesteps. Stop at time step ', time_pairs[-1])
-            except KeyError:
-                pass
 
             __iter__= time_pairs
         else:
             raise NotImplementedError(self.sde.__class__ )
 
-        step_size = time_steps[0] - time_steps[1]
-        if self.sample_kwargs['start_time_step'] == 0:
+        return time_steps, time_pairs, __iter__
+
+    def _init_chain(self, time_pairs: list, num_iter: int) -> Tensor:
+        start_time_step = self.sample_kwargs['start_time_step']
+        if start_time_step == 0:
             init_x = self.sde.prior_sampling([self.sample_kwargs['batch_size'], *self.sample_kwargs['im_shape']]).to(self.device)
         else:
-            assert not any([isinstance(self.sde, classname) for classname in _EPSILON_PRED_CLASSES])
-            init_x = self.init_chain_fn(time_steps=time_steps)
+            # truncated chain, the first ``start_time_step'' steps are skipped; ``time_pairs[i][0]'' is the 
+            # time (index) the i-th step starts from, for score- and epsilon-prediction classes alike
+            assert start_time_step < num_iter
+            init_x = self.init_chain_fn(time_steps=np.array([pair[0] for pair in time_pairs]))
+
+        return init_x
+
+    def sample(self,
+        logg_kwargs: Dict = {},
+        logging: bool = True,
+        checkpoint_path: Optional[str] = None
+        ) -> Tensor:
+
+        if logging:
+            # TensorBoard I/O, host copies and metrics run in a background thread, see ``AsyncSummaryWriter''
+            writer = AsyncSummaryWriter(log_dir=os.path.join(logg_kwargs['log_dir'], str(logg_kwargs['sample_num'])), 
+                max_queue=logg_kwargs.get('max_log_queue', 100))
+        
+        time_steps, time_pairs, __iter__ = self._time_grid()
+        step_size = time_steps[0] - time_steps[1]
+        # coefficients of every step are computed once and looked up by step index
+        schedule = NoiseSchedule(sde=self.sde, time_pairs=time_pairs, device=self.device)
+        start_time_step = self.sample_kwargs['start_time_step']
+        init_x = self._init_chain(time_pairs=time_pairs, num_iter=len(__iter__))
         
         if logging:
-            writer.add_image('init_x', torchvision.utils.make_grid(init_x, 
-                normalize=True, scale_each=True), global_step=0)
-            if logg_kwargs['ground_truth'] is not None: writer.add_image(
-                'ground_truth', torchvision.utils.make_grid(logg_kwargs['ground_truth'].squeeze(), 
-                    normalize=True, scale_each=True), global_step=0)
-            if logg_kwargs['filtbackproj'] is not None: writer.add_image(
-                'filtbackproj', torchvision.utils.make_grid(logg_kwargs['filtbackproj'].squeeze(), 
-                    normalize=True, scale_each=True), global_step=0)
+            writer.add_image_grid('init_x', init_x, global_step=0, block=True)
+            if logg_kwargs['ground_truth'] is not None: writer.add_image_grid(
+                'ground_truth', logg_kwargs['ground_truth'], global_step=0, block=True)
+            if logg_kwargs['filtbackproj'] is not None: writer.add_image_grid(
+                'filtbackproj', logg_kwargs['filtbackproj'], global_step=0, block=True)
         
+        # with ``sync_free'' per-step scalars stay on device and are written once the chain has finished
+        sync_free = self.sample_kwargs.get('sync_free', False)
+        sync_counter = None
+        if self.sample_kwargs.get('count_syncs', False):
+            if torch.cuda.is_available():
+                sync_counter = SyncCounter()
+            else:
+                warnings.warn("``count_syncs'' only counts CUDA syncs, CUDA is unavailable and nothing is counted")
+        self.syncs_per_step, _psnrs = [], []
+
+        # the chain terminates once the relative change of ``x_mean'' (or of ``residual_fn(x_mean)'') 
+        # has been below ``tol'' for ``patience'' consecutive steps, for every sample in the batch
+        early_stopping = self.sample_kwargs.get('early_stopping', None)
+        if early_stopping is not None:
+            residual_fn = early_stopping.get('residual_fn', None)
+            converged_steps = torch.zeros(self.sample_kwargs['batch_size'], device=self.device)
+            tracked_prev = None
+        self.stopped_at_step = None
+
+        if 'history' in self.sample_kwargs['predictor']: # multistep predictors start each chain afresh
+            self.sample_kwargs['predictor']['history'] = []
+
         x = init_x
-        i = 0
-        pbar = tqdm(__iter__)
+        i = start_time_step
+        # resumable state is snapshotted to ``checkpoint_path'' every ``checkpoint_freq'' steps, without the 
+        # frozen base weights; objects in ``stateful'' (e.g. optimisers) only need ``state_dict''/``load_state_dict''
+        checkpoint_freq = self.sample_kwargs.get('checkpoint_freq', None)
+        stateful = self.sample_kwargs.get('stateful', {})
+        state = load_sampling_state(checkpoint_path) if checkpoint_path is not None else None
+        if state is not None:
+            i, x, x_mean = state['step'], state['x'].to(self.device), state['x_mean'].to(self.device)
+            set_rng_state(state['rng'])
+            # ``stateful'' objects may resize the model (e.g. pruned LoRA ranks), hence go first
+            for name, obj in stateful.items():
+                obj.load_state_dict(state['stateful'][name])
+            load_trainable_state(self.score, state['trainable'])
+            if 'history' in self.sample_kwargs['predictor']:
+                self.sample_kwargs['predictor']['history'] = [
+                    tuple(v.to(self.device) for v in item) for item in state['history']]
+            if early_stopping is not None:
+                converged_steps, tracked_prev = [v.to(self.device) if v is not None else None 
+                    for v in state['early_stopping']]
+            print('Resume from step ', i, ' of ', len(__iter__))
+        pbar = tqdm(__iter__[i:])
         for step in pbar:
+            if sync_counter is not None: sync_counter.start()
             ones_vec = torch.ones(self.sample_kwargs['batch_size'], device=self.device)
             if isinstance(step, float): 
                 time_step = ones_vec * step # t,
@@ -111,6 +194,7 @@ class BaseSampler:
                 time_step=time_step,
                 step_size=step_size,
                 datafitscale=step/self.sample_kwargs['num_steps'] if not isinstance(step, Tuple) else 1.,
+                coeffs=schedule[i],
                 **self.sample_kwargs['predictor']
                 )
 
@@ -124,19 +208,58 @@ class BaseSampler:
                     **self.sample_kwargs['corrector']
                     )
 
-            if logging:
-                if (i - self.sample_kwargs['start_time_step']) % logg_kwargs['num_img_in_log'] == 0:
-                    writer.add_image('reco', torchvision.utils.make_grid(x_mean.squeeze(), normalize=True, scale_each=True), i)
-                
-                    psnr = PSNR(x_mean[0, 0].cpu().numpy(), logg_kwargs['ground_truth'][0, 0].cpu().numpy())
-                
-                writer.add_scalar('PSNR', psnr, i)
-                pbar.set_postfix({'psnr': psnr})
+            if early_stopping is not None:
+                tracked = x_mean if residual_fn is None else residual_fn(x_mean)
+                if tracked_prev is not None:
+                    converged_steps = (converged_steps + 1) * (
+                        _relative_change(tracked, tracked_prev) < early_stopping['tol'])
+                tracked_prev = tracked
+
+            if logging and sync_free:
+                _psnrs.append(PSNR_on_device(x_mean, logg_kwargs['ground_truth']).mean())
+            elif logging:
+                if (i - start_time_step) % logg_kwargs['num_img_in_log'] == 0:
+                    writer.add_image_grid('reco', x_mean, i)
+                if i % logg_kwargs.get('num_scalar_in_log', 1) == 0:
+                    writer.add_psnr('PSNR', x_mean, logg_kwargs['ground_truth'], i)
+                if 'PSNR' in writer.latest: pbar.set_postfix({'psnr': writer.latest['PSNR']})
+            if sync_counter is not None:
+                self.syncs_per_step.append(sync_counter.stop())
+                pbar.set_postfix({'syncs': self.syncs_per_step[-1]}) 
             i += 1
 
+            if checkpoint_path is not None and checkpoint_freq is not None and i % checkpoint_freq == 0:
+                save_sampling_state(checkpoint_path, {
+                    'step': i, 
+                    'x': x.cpu(), 
+                    'x_mean': x_mean.cpu(),
+                    'rng': get_rng_state(),
+                    # weights only change when the score is adapted during sampling
+                    'trainable': get_trainable_state(self.score) if self.sample_kwargs.get(
+                        'adapt_freq', None) is not None else {},
+                    'stateful': {name: obj.state_dict() for name, obj in stateful.items()},
+                    'history': [tuple(v.cpu() for v in item) for item in self.sample_kwargs['predictor'].get('history', [])],
+                    'early_stopping': [v.cpu() if v is not None else None 
+                        for v in (converged_steps, tracked_prev)] if early_stopping is not None else None
+                    })
+
+            # checking convergence syncs with the host, ``check_freq'' > 1 amortises it
+            if early_stopping is not None and i % early_stopping.get('check_freq', 1) == 0 and bool(
+                    (converged_steps >= early_stopping['patience']).all()):
+                self.stopped_at_step = i
+                print('Converged. Stop after ', i, ' of ', len(__iter__), ' timesteps.')
+                break
+
+        if logging and sync_free:
+            for j, psnr in enumerate(torch.stack(_psnrs).cpu().tolist() if _psnrs else []):
+                writer.add_scalar('PSNR', psnr, j, block=True)
+        if logging and self.stopped_at_step is not None:
+            writer.add_scalar('stopped_at_step', self.stopped_at_step, 0, block=True)
+        if logging and sync_counter is not None:
+            for j, syncs in enumerate(self.syncs_per_step):
+                writer.add_scalar('syncs_per_step', syncs, j, block=True)
         if logging:
-            writer.add_image(
-                'final_reco', torchvision.utils.make_grid(x_mean.squeeze(),
-                normalize=True, scale_each=True), global_step=0)
+            writer.add_image_grid('final_reco', x_mean, global_step=0, block=True)
+            writer.close()
 
         return x_mean 
\ No newline at end of file
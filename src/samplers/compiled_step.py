@@ -0,0 +1,93 @@
+from typing import Optional, Dict
+
+import os
+import warnings
+import functools
+import torch
+import torch.nn as nn
+
+# predictors (and the types of their forward operators) whose step could not be captured, these are not traced again
+_NOT_CAPTURABLE = set()
+
+def _compile_errors() -> tuple:
+    # failures to trace or to compile, other errors (e.g. shape mismatches found while tracing) are raised
+    return (torch._dynamo.exc.Unsupported, torch._dynamo.exc.BackendCompilerFailed)
+
+def _configure_compile_cache(cache_dir: str) -> None:
+    from torch._inductor import config as inductor_config # slow to import, only needed once compiling
+
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = str(cache_dir)
+    inductor_config.fx_graph_cache = True
+
+class _CompiledScore:
+    """
+    ``torch.compile(score)'', which runs ``score'' eagerly once compiling fails. Any other attribute (e.g. ``eval'', 
+    ``parameters'' or the LoRA registry) is the one of ``score''.
+    """
+    def __init__(self, score: nn.Module, mode: Optional[str] = None) -> None:
+        self.score = score
+        self.failed = False
+        self._compiled = torch.compile(score, mode=mode)
+
+    def __call__(self, *args, **kwargs):
+        if not self.failed:
+            try:
+                return self._compiled(*args, **kwargs)
+            except _compile_errors() as e: # raised before the forward is run
+                warnings.warn(f'compiling the score model failed, it runs eagerly: {type(e).__name__}')
+                self.failed = True
+        return self.score(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.score, name)
+
+class CompiledPredictor:
+    """
+    Opt-in ``torch.compile'' of a whole sampling step, e.g. for DDS the UNet forward, ``apTweedy'', the ``cg''
+    iterations through ``ray_trafo'' and ``ddim''. Capturing the step as one graph fuses the pointwise math and
+    removes the Python dispatch of the CG loop. If the step cannot be captured (``whole_step'' is ``False'', or
+    tracing fails, e.g. for ODL ``OperatorModule''s or the optimisation in adapted predictors), only the score
+    model is compiled and the rest of the step runs eagerly (as does the score model if it fails to compile).
+    Compiled artifacts are cached in ``cache_dir'' and reused across process restarts.
+    Be aware that noise drawn in compiled code differs from the eager one (for the same seed).
+    """
+    def __init__(self,
+        predictor: callable,
+        score: nn.Module,
+        whole_step: bool = True,
+        mode: Optional[str] = None,
+        cache_dir: Optional[str] = None
+        ) -> None:
+
+        if cache_dir is not None:
+            _configure_compile_cache(cache_dir)
+        self.predictor = predictor
+        self.score = score
+        self.mode = mode
+        self._compiled_score = None
+        self._key = (getattr(predictor, 'func', predictor), 
+            type(getattr(predictor, 'keywords', {}).get('ray_trafo', None)))
+        self.whole_step = whole_step and self._key not in _NOT_CAPTURABLE
+        self._compiled_step = torch.compile(predictor, fullgraph=True, mode=mode) if self.whole_step else None
+
+    def _with_compiled_score(self, kwargs: Dict) -> Dict:
+        # the predictor and the callables bound to it with the score model (e.g. ``adapt_fn'') run the compiled one
+        if self._compiled_score is None:
+            self._compiled_score = _CompiledScore(self.score, mode=self.mode)
+        kwargs = {**kwargs, 'score': self._compiled_score}
+        for name, value in getattr(self.predictor, 'keywords', {}).items():
+            if isinstance(value, functools.partial) and value.keywords.get('score', None) is self.score:
+                kwargs[name] = functools.partial(value, score=self._compiled_score)
+        return kwargs
+
+    def __call__(self, **kwargs):
+
+        if self.whole_step:
+            try:
+                return self._compiled_step(**kwargs)
+            except _compile_errors() as e: # tracing fails before the step is run
+                warnings.warn(f'whole-step capture failed, compiling the score model only: {type(e).__name__}')
+                self.whole_step = False
+                _NOT_CAPTURABLE.add(self._key)
+        return self.predictor(**self._with_compiled_score(kwargs))
@@ -0,0 +1,139 @@
+'''
+Parallel-in-time sampling via Picard iterations, inspired to ``ParaDiGMS''
+    @article{shih2023parallel,
+        title={Parallel Sampling of Diffusion Models},
+        author={Shih, Andy and Belkhale, Suneel and Ermon, Stefano and Sadigh, Dorsa and Anari, Nima},
+        journal={arXiv preprint arXiv:2305.16317},
+        year={2023}
+    }, available at https://arxiv.org/pdf/2305.16317.pdf.
+'''
+from typing import Optional, Any, Dict, Tuple, List
+
+import os
+import torch
+
+from tqdm import tqdm
+from torch import Tensor
+
+from .base_sampler import BaseSampler
+from .utils import _relative_change
+from ..utils import SDE, NoiseSchedule, StepCoeffs, AsyncSummaryWriter
+from ..third_party_models import OpenAiUNetModel
+
+class PicardSampler(BaseSampler):
+    """
+    Solves the chain ``x_{k+1} = F_k(x_k)'' for a sliding window of ``window'' steps at once. Each sweep evaluates
+    the steps of the window in a single batched predictor call (i.e. one UNet forward of batch ``window * batch_size''),
+    and updates the window by the Picard iteration ``x_{k+1} = x_lo + sum_{j=lo}^{k} (F_j(x_j) - x_j)''.
+    The window slides past the steps whose state changed (rel.) less than ``tol'' in the sweep, and by at least
+    one step, i.e. it never takes more sweeps than the sequential chain takes steps. The noise of all steps is drawn
+    up front (in the order the sequential chain draws it), hence the fixed point is the trajectory of ``BaseSampler''.
+    It pays off when a batch of one does not saturate the device (e.g. a many-core CPU host).
+    Predictors need a ``noise'' kwarg (e.g. ``decomposed_diffusion_sampling_sde_predictor''); tensors bound to
+    the predictor with a leading batch dimension (e.g. ``rhs'') are passed in ``per_sample_kwargs''.
+    """
+    def __init__(self,
+        score: OpenAiUNetModel,
+        sde: SDE,
+        predictor: callable,
+        sample_kwargs: Dict,
+        window: int = 8,
+        tol: float = 1e-3,
+        per_sample_kwargs: Optional[Dict[str, Tensor]] = None,
+        init_chain_fn: Optional[callable] = None,
+        device: Optional[Any] = None
+        ) -> None:
+
+        super().__init__(score=score, sde=sde, predictor=predictor, sample_kwargs=sample_kwargs,
+            init_chain_fn=init_chain_fn, corrector=None, device=device)
+        self.window = window
+        self.tol = tol
+        self.per_sample_kwargs = per_sample_kwargs or {}
+
+    def _batched_time_step(self, steps: List, batch_size: int) -> Any:
+        if isinstance(steps[0], Tuple): # (t, tminus1)
+            return tuple(self._batched_time_step([step[j] for step in steps], batch_size) for j in range(2))
+
+        return torch.tensor(steps, dtype=torch.float32, device=self.device).repeat_interleave(batch_size)
+
+    def sample(self,
+        logg_kwargs: Dict = {},
+        logging: bool = True,
+        checkpoint_path: Optional[str] = None
+        ) -> Tensor:
+
+        # steps are not taken one at a time, there is no sequential state to snapshot
+        assert checkpoint_path is None or self.sample_kwargs.get('checkpoint_freq', None) is None
+        if logging:
+            writer = AsyncSummaryWriter(log_dir=os.path.join(logg_kwargs['log_dir'], str(logg_kwargs['sample_num'])),
+                max_queue=logg_kwargs.get('max_log_queue', 100))
+
+        time_steps, time_pairs, __iter__ = self._time_grid()
+        step_size = time_steps[0] - time_steps[1]
+        schedule = NoiseSchedule(sde=self.sde, time_pairs=time_pairs, device=self.device)
+        start_time_step = self.sample_kwargs['start_time_step']
+        init_x = self._init_chain(time_pairs=time_pairs, num_iter=len(__iter__))
+
+        if logging:
+            writer.add_image_grid('init_x', init_x, global_step=0, block=True)
+            if logg_kwargs['ground_truth'] is not None: writer.add_image_grid(
+                'ground_truth', logg_kwargs['ground_truth'], global_step=0, block=True)
+            if logg_kwargs['filtbackproj'] is not None: writer.add_image_grid(
+                'filtbackproj', logg_kwargs['filtbackproj'], global_step=0, block=True)
+
+        batch_size, num = init_x.shape[0], len(__iter__) - start_time_step
+        noise = torch.stack([torch.randn_like(init_x) for _ in range(num)])
+        # ``xs[k]'' is the state the k-th step starts from, the initial guess of a state is the latest one in the window
+        xs = init_x[None].repeat(num + 1, *[1] * init_x.ndim)
+        lo, x_mean = 0, None
+        self.num_sweeps = 0
+        pbar = tqdm(total=num)
+        while lo < num:
+            hi = min(lo + self.window, num)
+            w = hi - lo
+            coeffs = StepCoeffs(*[coeff.repeat_interleave(batch_size, dim=0) if coeff is not None else None
+                for coeff in schedule[start_time_step + lo:start_time_step + hi]])
+            x_next, xhat0 = self.predictor(
+                score=self.score,
+                sde=self.sde,
+                x=xs[lo:hi].flatten(0, 1),
+                time_step=self._batched_time_step(
+                    [__iter__[start_time_step + k] for k in range(lo, hi)], batch_size=batch_size),
+                step_size=step_size,
+                datafitscale=1.,
+                coeffs=coeffs,
+                noise=noise[lo:hi].flatten(0, 1),
+                **{name: v.repeat(w, *[1] * (v.ndim - 1)) for name, v in self.per_sample_kwargs.items()},
+                **self.sample_kwargs['predictor']
+                )
+            x_next, xhat0 = x_next.view(w, *init_x.shape), xhat0.view(w, *init_x.shape)
+            update = xs[lo] + torch.cumsum(x_next - xs[lo:hi], dim=0)
+            change = _relative_change(update.flatten(0, 1), xs[lo + 1:hi + 1].flatten(0, 1)).view(w, batch_size)
+            xs[lo + 1:hi + 1] = update
+            self.num_sweeps += 1
+
+            # the first step of the window is exact, the following ones are accepted up to the first unconverged one
+            unconverged = (change.amax(dim=1) >= self.tol).nonzero().flatten().tolist()
+            stride = max(1, unconverged[0] if len(unconverged) > 0 else w)
+            if logging:
+                for k in range(lo, lo + stride):
+                    if k % logg_kwargs['num_img_in_log'] == 0:
+                        writer.add_image_grid('reco', xhat0[k - lo], start_time_step + k)
+                    if k % logg_kwargs.get('num_scalar_in_log', 1) == 0:
+                        writer.add_psnr('PSNR', xhat0[k - lo], logg_kwargs['ground_truth'], start_time_step + k)
+            if lo + stride == num:
+                x_mean = xhat0[-1]
+            # steps entering the window start from the latest state
+            xs[hi + 1:min(lo + stride + self.window, num) + 1] = xs[hi]
+            lo += stride
+            pbar.update(stride)
+            pbar.set_postfix({'sweeps': self.num_sweeps})
+        pbar.close()
+        print('Picard sampling took ', self.num_sweeps, ' sweeps for ', num, ' timesteps.')
+
+        if logging:
+            writer.add_scalar('picard_sweeps', self.num_sweeps, 0, block=True)
+            writer.add_image_grid('final_reco', x_mean, global_step=0, block=True)
+            writer.close()
+
+        return x_mean
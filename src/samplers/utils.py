@@ -1,13 +1,14 @@
-from typing import Optional, Any, Dict, Tuple, Union
+from typing import Optional, Any, Dict, List, Tuple, Union
 
 import torch
+import contextlib
 import numpy as np
 import torch.nn as nn
 
 from torch import Tensor
 from src.utils.cg import cg
-from src.utils import SDE, VESDE, VPSDE, DDPM, _EPSILON_PRED_CLASSES, _SCORE_PRED_CLASSES
-from src.third_party_models import OpenAiUNetModel, UNetModel
+from src.utils import SDE, VESDE, VPSDE, DDPM, _EPSILON_PRED_CLASSES, _SCORE_PRED_CLASSES, StepCoeffs, get_step_coeffs
+from src.third_party_models import OpenAiUNetModel, UNetModel, merge_lora, unmerge_lora, get_lora_registry
 
 def Euler_Maruyama_sde_predictor(
     score: Union[OpenAiUNetModel, UNetModel],
@@ -18,7 +19,9 @@ def Euler_Maruyama_sde_predictor(
     nloglik: Optional[callable] = None,
     datafitscale: Optional[float] = None,
     penalty: Optional[float] = None,
-    aTweedy: bool = False
+    aTweedy: bool = False,
+    coeffs: Optional[StepCoeffs] = None,
+    jacobian_free: bool = False
     ) -> Tuple[Tensor, Tensor]:
     '''
     Implements the predictor step using Euler-Maruyama for VE/VP-SDE models
@@ -48,23 +51,33 @@ def Euler_Maruyama_sde_predictor(
             journal={arXiv preprint arXiv:2209.14687},
             year={2022}
         }, available at https://arxiv.org/pdf/2209.14687.pdf.
+    With ``jacobian_free'' (and ``aTweedy''), the gradient of ``nloglik(xhat0)'' is taken w.r.t. ``xhat0'' and mapped 
+    back by the Jacobian of Tweedy's estimate without the one of the score model (see ``_jacobian_free_nloglik_grad''), 
+    i.e. the score model is not backpropagated through.
     '''
     assert not any([isinstance(sde,classname) for classname in _EPSILON_PRED_CLASSES])
     if nloglik is not None: assert (datafitscale is not None) and (penalty is not None)
-    x.requires_grad_()
-    s = score(x, time_step).detach() if not aTweedy else score(x, time_step)
+    assert aTweedy or not jacobian_free
+    x.requires_grad_(not jacobian_free)
+    with torch.set_grad_enabled(not jacobian_free):
+        s = score(x, time_step).detach() if not aTweedy else score(x, time_step)
     if nloglik is not None:
-        if aTweedy: xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=time_step)
-        loss = nloglik(x if not aTweedy else xhat0)
-        nloglik_grad = torch.autograd.grad(outputs=loss, inputs=x)[0]
+        if aTweedy: xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=time_step, coeffs=coeffs)
+        if jacobian_free:
+            nloglik_grad, loss = _jacobian_free_nloglik_grad(
+                nloglik=nloglik, xhat0=xhat0, sde=sde, time_step=time_step, coeffs=coeffs)
+        else:
+            loss = nloglik(x if not aTweedy else xhat0) # per-sample losses, samples in the batch are independent
+            nloglik_grad = torch.autograd.grad(outputs=loss.sum(), inputs=x)[0]
     drift, diffusion = sde.sde(x, time_step)
+    diffusion = diffusion[:, None, None, None] if coeffs is None else coeffs.diffusion_t
     _s = s
     # if ``penalty == 1/σ2'' and ``aTweedy'' is False : recovers Eq.4 in 1.
-    if aTweedy and nloglik is not None: datafitscale = loss.pow(-1)
+    if aTweedy and nloglik is not None: datafitscale = loss.pow(-1).view(-1, 1, 1, 1)
 
     if nloglik is not None and not aTweedy: _s = _s - penalty*nloglik_grad*datafitscale # minus for negative log-lik.
-    x_mean = x - (drift - diffusion[:, None, None, None].pow(2)*_s)*step_size
-    noise = torch.sqrt(diffusion[:, None, None, None].pow(2)*step_size)*torch.randn_like(x)
+    x_mean = x - (drift - diffusion.pow(2)*_s)*step_size
+    noise = torch.sqrt(diffusion.pow(2)*step_size)*torch.randn_like(x)
 
     x = x_mean + noise # Algo.1  in 3. line 6
     if aTweedy: x = x - penalty*nloglik_grad*datafitscale # Algo.1 sin 3. line 7
@@ -79,14 +92,16 @@ def Ancestral_Sampling(
     step_size: float,
     nloglik: Optional[callable] = None,
     datafitscale: Optional[float] = None,
-    penalty: Optional[float] = None) -> Tuple[Tensor, Tensor]:
+    penalty: Optional[float] = None,
+    coeffs: Optional[StepCoeffs] = None,
+    jacobian_free: bool = False) -> Tuple[Tensor, Tensor]:
     """
     Implements the ancestral sampling used for DPS in the discrete DDPM framework.
 
     We are using the formulation of 
         "Diffusion Posterior Sampling for General Noisy Inverse Problems" (2023) 
     Algortithm 1, however with a fixed standard deviation sigma_i
-
+    With ``jacobian_free'' the score model is not backpropagated through, see ``_jacobian_free_nloglik_grad''.
     """
 
     assert any([isinstance(sde,classname) for classname in _EPSILON_PRED_CLASSES])
@@ -97,22 +112,29 @@ def Ancestral_Sampling(
     if nloglik is not None: assert penalty is not None
 
     phase = 'uncond' if nloglik is None else 'cond'
-    with torch.set_grad_enabled(phase == 'cond'):
+    with torch.set_grad_enabled(phase == 'cond' and not jacobian_free):
     
-        if nloglik is not None:
+        if nloglik is not None and not jacobian_free:
             x.requires_grad_()
     
         s = score(x, t)
 
-        xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=t)
+        xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=t, coeffs=coeffs)
 
         if nloglik is not None:
-            loss = nloglik(xhat0)
-            nloglik_grad = torch.autograd.grad(outputs=loss, inputs=x)[0]
-            datafitscale = loss.pow(-1)
+            if jacobian_free:
+                nloglik_grad, loss = _jacobian_free_nloglik_grad(
+                    nloglik=nloglik, xhat0=xhat0, sde=sde, time_step=t, coeffs=coeffs)
+            else:
+                loss = nloglik(xhat0) # per-sample losses
+                nloglik_grad = torch.autograd.grad(outputs=loss.sum(), inputs=x)[0]
+            datafitscale = loss.pow(-1).view(-1, 1, 1, 1)
 
-        std_t = sde.marginal_prob_std(t=t)[:, None, None, None] # sqrt(1 - alphabr)
-        alpha_t = sde.alphas[int(t[0].item())]
+        if coeffs is None:
+            std_t = sde.marginal_prob_std(t=t)[:, None, None, None] # sqrt(1 - alphabr)
+            alpha_t = sde.alphas.to(t.device).index_select(0, t.long())[:, None, None, None].to(torch.float32)
+        else:
+            std_t, alpha_t = coeffs.std_t, coeffs.alpha_t
 
         x_mean = 1/torch.sqrt(alpha_t)*(x - (1 - alpha_t)/std_t*s)
 
@@ -124,6 +146,25 @@ def Ancestral_Sampling(
 
     return x.detach(), xhat0.detach()
 
+def _jacobian_free_nloglik_grad(
+    nloglik: callable,
+    xhat0: Tensor,
+    sde: SDE,
+    time_step: Tensor,
+    coeffs: Optional[StepCoeffs] = None
+    ) -> Tuple[Tensor, Tensor]:
+    """
+    Approximates ``nabla_x nloglik(xhat0(x))'' for Tweedy's estimate ``xhat0 = (x + std_t^2 s(x)) / mean_t'' by 
+    dropping the Jacobian of the score model, i.e. ``d xhat0 / d x ~ I / mean_t''. Only ``nloglik'' (e.g. the 
+    forward operator) is backpropagated through. Returns the gradient and the per-sample losses.
+    """
+    mean_t = sde.marginal_prob_mean(time_step)[:, None, None, None] if coeffs is None else coeffs.mean_t
+    with torch.enable_grad():
+        xhat0 = xhat0.detach().requires_grad_()
+        loss = nloglik(xhat0)
+        grad = torch.autograd.grad(outputs=loss.sum(), inputs=xhat0)[0]
+
+    return grad / mean_t, loss.detach()
 
 def Langevin_sde_corrector(
     score: Union[OpenAiUNetModel, UNetModel],
@@ -146,11 +187,12 @@ def Langevin_sde_corrector(
     for _ in range(corrector_steps):
         x.requires_grad_()
         s = score(x, time_step).detach()
-        if nloglik is not None: nloglik_grad = torch.autograd.grad(outputs=nloglik(x), inputs=x)[0]
+        if nloglik is not None: nloglik_grad = torch.autograd.grad(outputs=nloglik(x).sum(), inputs=x)[0]
         overall_grad = s - penalty*nloglik_grad*datafitscale if nloglik is not None else s
+        # per-sample step size, so that samples in the batch do not interact
         overall_grad_norm = torch.norm(
                 overall_grad.reshape(overall_grad.shape[0], -1), 
-                dim=-1  ).mean()
+                dim=-1  )[:, None, None, None]
         noise_norm = np.sqrt(np.prod(x.shape[1:]))
         langevin_step_size = 2 * (snr * noise_norm / overall_grad_norm)**2
         x = x + langevin_step_size * overall_grad + torch.sqrt(2 * langevin_step_size) * torch.randn_like(x)
@@ -168,7 +210,9 @@ def decomposed_diffusion_sampling_sde_predictor(
     cg_kwargs: Dict,
     datafitscale: Optional[float] = None, # pylint: disable=unused-variable
     use_simplified_eqn: bool = False,
-    ray_trafo: callable = None
+    ray_trafo: callable = None,
+    coeffs: Optional[StepCoeffs] = None,
+    noise: Optional[Tensor] = None
     ) -> Tuple[Tensor, Tensor]:
 
     '''
@@ -192,7 +236,7 @@ def decomposed_diffusion_sampling_sde_predictor(
     t = time_step if not isinstance(time_step, Tuple) else time_step[0]
     with torch.no_grad():
         s = score(x, t)
-        xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=t) # Tweedy denoising step
+        xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=t, coeffs=coeffs) # Tweedy denoising step
 
         _noise_rhs = xhat0 + gamma*rhs
         xhat = cg(op=op, x=xhat0, rhs=_noise_rhs, n_iter=cg_kwargs['max_iter'])
@@ -213,10 +257,142 @@ def decomposed_diffusion_sampling_sde_predictor(
             step_size=step_size, 
             eta=eta, 
             use_simplified_eqn=use_simplified_eqn,
+            coeffs=coeffs,
+            noise=noise
             )
 
     return x.detach(), xhat0.detach()
 
+def dpm_solver_sde_predictor(
+    score: Union[OpenAiUNetModel, UNetModel],
+    sde: SDE,
+    x: Tensor,
+    rhs: Tensor,
+    time_step: Union[Tensor, Tuple[Tensor,Tensor]],
+    gamma: float,
+    step_size: float,
+    cg_kwargs: Dict,
+    history: List,
+    order: int = 2,
+    datafitscale: Optional[float] = None, # pylint: disable=unused-variable
+    ray_trafo: callable = None,
+    coeffs: Optional[StepCoeffs] = None
+    ) -> Tuple[Tensor, Tensor]:
+
+    '''
+    It implements the multistep (data-prediction) ODE solver ``DPM-Solver++(2M)'' for the VE/VP-SDE and DDPM models
+        presented in 
+            1. @article{lu2022dpm,
+                title={DPM-Solver++: Fast Solver for Guided Sampling of Diffusion Probabilistic Models},
+                author={Lu, Cheng and Zhou, Yuhao and Bao, Fan and Chen, Jianfei and Li, Chongxuan and Zhu, Jun},
+                journal={arXiv preprint arXiv:2211.01095},
+                year={2022}
+            }, available at https://arxiv.org/pdf/2211.01095.pdf. See Algorithm 2.
+    The data prediction is the Tweedy estimate after the CG data-consistency step of ``Decomposed Diffusion Sampling''. 
+    ``history'' holds the data prediction and log-SNR step of the previous step, it is emptied by ``BaseSampler'' 
+    at the start of each chain. The last step (to zero noise) is always first order.
+    '''
+    def op(x):
+        return x + gamma*ray_trafo.trafo_adjoint(ray_trafo(x))
+
+    t = time_step if not isinstance(time_step, Tuple) else time_step[0]
+    if coeffs is None:
+        tminus1 = time_step-step_size if not isinstance(time_step,Tuple) else time_step[1]
+        coeffs = get_step_coeffs(sde=sde, t=t, tminus1=tminus1)
+    with torch.no_grad():
+        s = score(x, t)
+        xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=t, coeffs=coeffs)
+
+        _noise_rhs = xhat0 + gamma*rhs
+        xhat = cg(op=op, x=xhat0, rhs=_noise_rhs, n_iter=cg_kwargs['max_iter'])
+
+        mean_t, std_t = coeffs.mean_t, coeffs.std_t
+        # for VP-SDE the last step overshoots ``t = 0'', clip it to zero noise
+        mean_tminus1 = coeffs.mean_tminus1.clamp(max=1.)
+        std_tminus1 = torch.nan_to_num(coeffs.std_tminus1, nan=0.)
+        h = torch.log(mean_tminus1/std_tminus1) - torch.log(mean_t/std_t) # step in log-SNR, ``inf'' for the last step
+        xpred = xhat
+        if order == 2 and len(history) > 0:
+            xhat_prev, h_prev = history[-1]
+            r = h_prev / h
+            xpred = torch.where(torch.isfinite(h), (1 + 1/(2*r))*xhat - 1/(2*r)*xhat_prev, xhat)
+        elif order > 2:
+            raise NotImplementedError(order)
+        x = std_tminus1/std_t*x - mean_tminus1*torch.expm1(-h)*xpred
+        history[:] = [(xhat, h)]
+
+    return x.detach(), xhat0.detach()
+
+class _StepInBackward:
+    """
+    Steps every parameter as soon as its gradient is accumulated in the backward pass, and frees the gradient right 
+    after, i.e. gradients of the whole model never live at the same time. ``step'' and ``zero_grad'' are no-ops, the 
+    update happens in ``loss.backward'' while ``hooked''. The gradient hooks are only registered inside ``hooked'', 
+    so that optimisers of finished chains do not keep stepping the model.
+    """
+    def __init__(self, params: List[Tensor], optim_cls: type, **optim_kwargs) -> None:
+        self.optims = [optim_cls([param], **optim_kwargs) for param in params]
+        self._optim_of_param = {id(param): optim for param, optim in zip(params, self.optims)}
+        self._params = params
+
+    def _step(self, param: Tensor) -> None:
+        self._optim_of_param[id(param)].step()
+        param.grad = None
+
+    @contextlib.contextmanager
+    def hooked(self):
+        handles = [param.register_post_accumulate_grad_hook(self._step) for param in self._params]
+        try:
+            yield self
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    @property
+    def param_groups(self) -> List[Dict]:
+        return [group for optim in self.optims for group in optim.param_groups]
+
+    def zero_grad(self, set_to_none: bool = True) -> None:
+        pass
+
+    def step(self) -> None:
+        pass
+
+    def state_dict(self) -> List[Dict]:
+        return [optim.state_dict() for optim in self.optims]
+
+    def load_state_dict(self, state: List[Dict]) -> None:
+        for optim, optim_state in zip(self.optims, state):
+            optim.load_state_dict(optim_state)
+
+def _get_adaptation_optimizer(
+    score: Union[OpenAiUNetModel, UNetModel], 
+    lr: float = 1e-3,
+    name: str = 'adam',
+    step_in_backward: bool = False
+    ) -> torch.optim.Optimizer:
+    """
+    Optimiser over the trainable (LoRA/bias/decoder) parameters only.
+        ``adam'': Adam with multi-tensor updates, two full-size moments per parameter.
+        ``adafactor'': factored second moments and no first moment, a fraction of Adam's state for full adaptation. 
+            Its ``lr'' is relative to the RMS of each parameter. 
+    With ``step_in_backward'' each parameter is updated (and its gradient freed) during the backward pass, 
+    see ``_StepInBackward''.
+    """
+    params = [param for param in score.parameters() if param.requires_grad]
+    if name == 'adam':
+        optim_cls, optim_kwargs = torch.optim.Adam, {'lr': lr}
+        if not step_in_backward: 
+            optim_kwargs.update({'fused': True} if all([param.is_cuda for param in params]) else {'foreach': True})
+    elif name == 'adafactor':
+        assert hasattr(torch.optim, 'Adafactor'), 'Adafactor requires torch >= 2.5'
+        optim_cls, optim_kwargs = torch.optim.Adafactor, {'lr': lr, 'foreach': not step_in_backward}
+    else:
+        raise NotImplementedError
+    if step_in_backward:
+        return _StepInBackward(params, optim_cls, **optim_kwargs)
+    return optim_cls(params, **optim_kwargs)
+
 def _adapt(
     x: Tensor, 
     score: Union[OpenAiUNetModel, UNetModel],
@@ -229,52 +405,107 @@ def _adapt(
     lr: float = 1e-3, 
     gamma: float = 1e-3, 
     n_iter: int = 1,
-    dc_type: str = "cg"
+    dc_type: str = "cg",
+    coeffs: Optional[StepCoeffs] = None,
+    optim: Optional[torch.optim.Optimizer] = None,
+    cache_encoder: bool = True,
+    scheduler: Optional[Any] = None,
+    pruner: Optional[Any] = None,
+    optim_kwargs: Optional[Dict] = None
     ) -> None:
     
     def op(x):
         return x + gamma*ray_trafo.trafo_adjoint(ray_trafo(x)) 
     
-    assert _has_lora_active(score=score)    
+    assert not _has_lora(score=score) or _has_lora_active(score=score)
+    # ``scheduler'' (see ``AdaptationScheduler'') may skip the call, or stop the inner iterations early
+    if scheduler is not None:
+        t = time_step[0].item() / (sde.num_steps if any(
+            [isinstance(sde, classname) for classname in _EPSILON_PRED_CLASSES]) else 1.)
+        if not scheduler.is_active(t):
+            return
     score.eval()
-    optim = torch.optim.Adam(score.parameters(), lr=lr)
-    for _ in range(num_steps):
-        optim.zero_grad()
-        s = score(x, time_step)
-        xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=time_step)
-
-        if dc_type == "cg":
-            _noise_rhs = xhat0 + gamma*rhs
-            xhat = cg(op=op, x=xhat0, rhs=_noise_rhs, n_iter=n_iter)
-        elif dc_type == "dc":
-            xhat = xhat0 - gamma * ray_trafo.trafo_adjoint(ray_trafo(xhat0)) + gamma*rhs
-        elif dc_type == "none":
-            xhat = xhat0
-        else:
-            raise NotImplementedError
+    # a persistent ``optim'' keeps its moment estimates across sampling steps
+    if optim is None:
+        optim = _get_adaptation_optimizer(score=score, lr=lr, **(optim_kwargs or {}))
+    # ``x'' and ``time_step'' are fixed, i.e. a frozen encoder gives the same activations in every iteration
+    encoded = None
+    if cache_encoder and hasattr(score, 'encoder_is_frozen') and score.encoder_is_frozen():
+        with torch.no_grad():
+            encoded = score.forward_encoder(x, time_step)
+    loss_prev, num_optim_steps = None, 0
+    # optimisers stepping in the backward pass only hook into ``score'' while adapting
+    with optim.hooked() if isinstance(optim, _StepInBackward) else contextlib.nullcontext():
+        for _ in range(num_steps):
+            optim.zero_grad()
+            if encoded is not None:
+                s = score.forward_decoder(*encoded, time_step, dtype=x.dtype)
+            else:
+                s = score(x, time_step)
+            xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=time_step, coeffs=coeffs)
 
-        loss = loss_fn(x=xhat)
-        loss.backward()
+            if dc_type == "cg":
+                _noise_rhs = xhat0 + gamma*rhs
+                xhat = cg(op=op, x=xhat0, rhs=_noise_rhs, n_iter=n_iter)
+            elif dc_type == "dc":
+                xhat = xhat0 - gamma * ray_trafo.trafo_adjoint(ray_trafo(xhat0)) + gamma*rhs
+            elif dc_type == "none":
+                xhat = xhat0
+            else:
+                raise NotImplementedError
 
-        optim.step()
+            # ``loss_fn'' may return one loss per sample (i.e. per adapter of a batched LoRA), these are summed
+            loss = loss_fn(x=xhat)
+            if scheduler is not None:
+                _loss = loss.detach().flatten().tolist()
+                if loss_prev is None and scheduler.skip(_loss):
+                    return
+                if loss_prev is not None and scheduler.converged(_loss, loss_prev):
+                    break
+                loss_prev = _loss
+            loss.sum().backward()
+            if pruner is not None: # see ``LoraRankPruner''
+                pruner.accumulate()
+
+            optim.step()
+            num_optim_steps += 1
+    if scheduler is not None and loss_prev is not None:
+        scheduler.update(_loss, num_optim_steps=num_optim_steps)
+    if pruner is not None and num_optim_steps > 0:
+        pruner.step(optim=optim)
 
 def _tune_lora_scale(
         score: Union[OpenAiUNetModel, UNetModel], 
         scale: float = 1.0
         ):
-    for _module in score.modules():
-        if _module.__class__.__name__ in ['LoraInjectedLinear', 'LoraInjectedConv2d', 'LoraInjectedConv1d']:
-            _module.scale = scale
+    registry = get_lora_registry(score)
+    if registry is not None:
+        registry.scale = scale
 
 def _has_lora(score: Union[OpenAiUNetModel, UNetModel]):
-    for _module in score.modules():
-        if _module.__class__.__name__ in ['LoraInjectedLinear', 'LoraInjectedConv2d', 'LoraInjectedConv1d']:
-            return True
+    registry = get_lora_registry(score)
+    return registry is not None and len(registry) > 0
 
 def _has_lora_active(score: Union[OpenAiUNetModel, UNetModel]):
-    for _module in score.modules():
-        if _module.__class__.__name__ in ['LoraInjectedLinear', 'LoraInjectedConv2d', 'LoraInjectedConv1d']:
-            return _module.scale != 0 
+    registry = get_lora_registry(score)
+    return registry is not None and registry.is_active
+
+def _dual_branch_score(
+        score: Union[OpenAiUNetModel, UNetModel],
+        x: Tensor, 
+        time_step: Tensor
+        ) -> Tuple[Tensor, Tensor]:
+    """
+    Adapted and unadapted score in one forward pass: ``x'' is stacked along the batch dimension 
+    and the LoRA modules get a per-sample scale (1 for the first, 0 for the second half).
+    """
+    batch_size = x.shape[0]
+    _tune_lora_scale(score=score, 
+        scale=torch.cat([torch.ones(batch_size, device=x.device), torch.zeros(batch_size, device=x.device)]))
+    s = score(torch.cat([x, x]), torch.cat([time_step, time_step]))
+    _tune_lora_scale(score=score, scale=1.0)
+
+    return s[:batch_size], s[batch_size:]
 
 def adapted_ddim_sde_predictor( 
     score: Union[OpenAiUNetModel, UNetModel],
@@ -292,18 +523,32 @@ def adapted_ddim_sde_predictor(
     dc_type: str = None,
     gamma: float = None,
     cg_kwargs: Dict = None, 
-    rhs: Tensor = None
+    rhs: Tensor = None,
+    coeffs: Optional[StepCoeffs] = None,
+    fuse_branches: bool = True,
+    use_merged_lora: bool = False
     ) -> Tuple[Tensor, Tensor]:
     
     t = time_step if not isinstance(time_step, Tuple) else time_step[0]
-    if use_adapt: adapt_fn(x=x, time_step=t, ray_trafo=ray_trafo, rhs=rhs, gamma=gamma, n_iter=cg_kwargs['max_iter'])
+    if use_adapt: 
+        # the folded update is stale once the factors are adapted, it is subtracted from the base weights first
+        if use_merged_lora and _has_lora(score=score): unmerge_lora(score)
+        adapt_fn(x=x, time_step=t, ray_trafo=ray_trafo, rhs=rhs, gamma=gamma, n_iter=cg_kwargs['max_iter'], coeffs=coeffs)
 
     def op(x):
         return x + gamma * ray_trafo.trafo_adjoint(ray_trafo(x))
 
     with torch.no_grad():
-        s = score(x, t) # adapted score
-        xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=t)
+        has_lora = _has_lora(score=score)
+        # on steps without adaptation the LoRA factors are folded into the base weights (re-folded only 
+        # if they changed since), both branches then run at the cost of the plain UNet
+        use_merged_lora = has_lora and use_merged_lora and not use_adapt
+        if use_merged_lora: merge_lora(score)
+        if has_lora and fuse_branches and not use_merged_lora: # trades twice the activation memory for one traversal
+            s, s_base = _dual_branch_score(score=score, x=x, time_step=t)
+        else:
+            s = score(x, t) # adapted score
+        xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=t, coeffs=coeffs)
 
         if add_cg:
             if dc_type == "cg":
@@ -316,19 +561,21 @@ def adapted_ddim_sde_predictor(
             else:
                 raise NotImplementedError
 
-        if _has_lora(score=score):
+        if has_lora and (use_merged_lora or not fuse_branches):
             _tune_lora_scale(score=score, scale=0)
-        s = score(x, t)
-        if _has_lora(score=score):
+            s_base = score(x, t)
             _tune_lora_scale(score=score, scale=1.0)     
+        elif not has_lora: # full/decoder adaptation leaves no unadapted branch
+            s_base = s
         
         x = ddim(sde=sde,
-            s=s,
+            s=s_base,
             xhat=xhat if add_cg else xhat0,
             time_step=time_step,
             step_size=step_size,
             eta=eta, 
             use_simplified_eqn=use_simplified_eqn, 
+            coeffs=coeffs
             )
 
     return x.detach(), xhat0.detach()
@@ -340,35 +587,42 @@ def ddim(
     time_step: Union[Tensor, Tuple[Tensor,Tensor]],
     step_size: Tensor, 
     eta: float, 
-    use_simplified_eqn: bool = False
+    use_simplified_eqn: bool = False,
+    coeffs: Optional[StepCoeffs] = None,
+    noise: Optional[Tensor] = None
     ) -> Tensor:
     
-    t = time_step if not isinstance(time_step, Tuple) else time_step[0]
-    tminus1 = time_step-step_size if not isinstance(time_step,Tuple) else time_step[1]
-    std_t = sde.marginal_prob_std(t=t)[:, None, None, None]
+    # a pre-sampled ``noise'' makes the step a deterministic function of ``xhat'' (see ``PicardSampler'')
+    noise = torch.randn_like(xhat) if noise is None else noise
+    if coeffs is None:
+        t = time_step if not isinstance(time_step, Tuple) else time_step[0]
+        tminus1 = time_step-step_size if not isinstance(time_step,Tuple) else time_step[1]
+        coeffs = get_step_coeffs(sde=sde, t=t, tminus1=tminus1)
+    std_t = coeffs.std_t
     if isinstance(sde, VESDE):
-        std_tminus1 = sde.marginal_prob_std(t=tminus1)[:, None, None, None]
-        tbeta = 1 - ( std_tminus1.pow(2) * std_t.pow(-2) ) if not use_simplified_eqn else torch.tensor(1.) 
+        std_tminus1 = coeffs.std_tminus1
+        tbeta = coeffs.tbeta if not use_simplified_eqn else torch.tensor(1.) 
         noise_deterministic = - std_tminus1*std_t*torch.sqrt( 1 - tbeta.pow(2)*eta**2 ) * s
-        noise_stochastic = std_tminus1 * eta*tbeta*torch.randn_like(xhat)
+        noise_stochastic = std_tminus1 * eta*tbeta*noise
     elif any([isinstance(sde, classname) for classname in [VPSDE, DDPM]]):
-        mean_tminus1 = sde.marginal_prob_mean(t=tminus1)[:, None, None, None]
-        mean_t = sde.marginal_prob_mean(t=t)[:, None, None, None]
-        tbeta = ((1 - mean_tminus1.pow(2)) / ( 1 - mean_t.pow(2) ) ).pow(.5) * (1 - mean_t.pow(2) * mean_tminus1.pow(-2) ).pow(.5)
-        if any(tbeta.isnan()): tbeta = torch.zeros(*tbeta.shape, device=s.device)
+        mean_tminus1 = coeffs.mean_tminus1
+        tbeta = coeffs.tbeta
         xhat = xhat*mean_tminus1
         eps_ = _eps_pred_from_s(s, std_t) if isinstance(sde, VPSDE) else s
         noise_deterministic = torch.sqrt( 1 - mean_tminus1.pow(2) - tbeta.pow(2)*eta**2 )*eps_
-        noise_stochastic = eta*tbeta*torch.randn_like(xhat)
+        noise_stochastic = eta*tbeta*noise
     else:
         raise NotImplementedError
 
     return xhat + noise_deterministic + noise_stochastic
 
-def apTweedy(s: Tensor, x: Tensor, sde: SDE, time_step:Tensor) -> Tensor:
+def apTweedy(s: Tensor, x: Tensor, sde: SDE, time_step:Tensor, coeffs: Optional[StepCoeffs] = None) -> Tensor:
 
-    div = sde.marginal_prob_mean(time_step)[:, None, None, None].pow(-1)
-    std_t = sde.marginal_prob_std(time_step)[:, None, None, None]
+    if coeffs is None:
+        div = sde.marginal_prob_mean(time_step)[:, None, None, None].pow(-1)
+        std_t = sde.marginal_prob_std(time_step)[:, None, None, None]
+    else:
+        div, std_t = coeffs.mean_t.pow(-1), coeffs.std_t
     if any([isinstance(sde, classname) for classname in _SCORE_PRED_CLASSES]):
         s = _eps_pred_from_s(s=s, std_t=std_t) # `s' here is `eps_.'
     update = x - s*std_t
@@ -380,15 +634,20 @@ def chain_simple_init(
     sde: SDE,
     filtbackproj: Tensor,
     start_time_step: int,
-    im_shape: Tuple[int, int],
+    im_shape: Tuple[int, int, int],
     batch_size: int,
     device: Any
     ) -> Tensor:
-
+    """
+    Starts a truncated chain at ``time_steps[start_time_step]'' by diffusing ``filtbackproj'' with the marginal 
+    of the SDE, i.e. ``mean_t * filtbackproj + std_t * z''. For epsilon-prediction classes (e.g. DDPM) 
+    ``time_steps'' are the discrete time indices of the chain.
+    """
     t = torch.ones(batch_size, device=device) * time_steps[start_time_step]
+    mean = sde.marginal_prob_mean(t)[:, None, None, None]
     std = sde.marginal_prob_std(t)[:, None, None, None]
 
-    return filtbackproj + torch.randn(batch_size, *im_shape, device=device) * std
+    return mean * filtbackproj.to(device) + torch.randn(batch_size, *im_shape, device=device) * std
 
 def _eps_pred_from_s(s, std_t):
     # based on score-matching = - epsilon-mathcing / std_t
@@ -396,6 +655,12 @@ def _eps_pred_from_s(s, std_t):
 
     return - std_t * s
 
+def _relative_change(x: Tensor, x_prev: Tensor) -> Tensor:
+    """per-sample ``||x - x_prev|| / ||x_prev||'', used for convergence-based early termination"""
+    x, x_prev = x.reshape(x.shape[0], -1), x_prev.reshape(x_prev.shape[0], -1)
+
+    return torch.linalg.norm(x - x_prev, dim=1) / torch.linalg.norm(x_prev, dim=1).clamp(min=1e-12)
+
 
 def _check_times(times, t_0, num_steps):
 
@@ -436,14 +701,15 @@ def wrapper_ddim(
     x: Tensor, 
     time_step: Tensor, 
     step_size: Tensor, 
-    datafitscale = 1. # pylint: disable=unused-variable
+    datafitscale = 1., # pylint: disable=unused-variable
+    coeffs: Optional[StepCoeffs] = None
     ) -> Tuple[Tensor, Tensor]:
 
     t = time_step if not isinstance(time_step, Tuple) else time_step[0]
     with torch.no_grad():
         s = score(x, t).detach()
-        xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=t)
+        xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=t, coeffs=coeffs)
     # setting ``eta'' equals to ``0'' turns ddim into ddpm
-    x = ddim(sde=sde, s=s, xhat=xhat0, time_step=time_step, step_size=step_size, eta=0.85, use_simplified_eqn=False)
+    x = ddim(sde=sde, s=s, xhat=xhat0, time_step=time_step, step_size=step_size, eta=0.85, use_simplified_eqn=False, coeffs=coeffs)
     
     return x.detach(), xhat0.detach()
\ No newline at end of file
@@ -1,3 +1,4 @@
 from .openai_unet import OpenAiUNetModel
 from .dds_unet import UNetModel
-from .lora_diffusion import inject_trainable_lora_extended
\ No newline at end of file
+from .lora_diffusion import (inject_trainable_lora_extended, merge_lora, unmerge_lora, 
+    LoraRegistry, get_lora_registry, BatchedLoraInjected, inject_batched_bias_offsets, set_lora_rank, match_lora_ranks)
\ No newline at end of file
@@ -1 +1,2 @@
-from .lora import inject_trainable_lora_extended
\ No newline at end of file
+from .lora import (inject_trainable_lora_extended, merge_lora, unmerge_lora, 
+    LoraRegistry, get_lora_registry, BatchedLoraInjected, inject_batched_bias_offsets, set_lora_rank, match_lora_ranks)
\ No newline at end of file
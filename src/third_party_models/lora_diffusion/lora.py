@@ -3,12 +3,108 @@ LoRA. Adapted from https://github.com/cloneofsimo/lora/tree/master/lora_diffusio
 """
 import torch 
 import torch.nn as nn 
-from typing import List, Optional, Set, Type
+import torch.nn.functional as F
+from typing import Dict, List, Optional, Set, Type
 import itertools
 
 UNET_EXTENDED_TARGET_REPLACE = {"AttentionBlock", "ResBlock"}
 
-class LoraInjectedLinear(nn.Module):
+def _is_off(scale):
+    return not isinstance(scale, torch.Tensor) and scale == 0
+
+def _expand_scale(scale, input):
+    # ``scale'' is either a float or a per-sample tensor of shape (batch_size,), 
+    # the latter lets adapted and unadapted samples share one forward pass
+    if isinstance(scale, torch.Tensor):
+        return scale.view(-1, *[1]*(input.dim() - 1)).to(input.dtype)
+    return scale
+
+def _merge_key(module, base):
+    # changes whenever the scale, the base weight or a LoRA factor is modified or replaced
+    if isinstance(module.scale, torch.Tensor) or not isinstance(module.selector, nn.Identity):
+        return None
+    return (module.scale, 
+        id(base.weight), base.weight._version, 
+        id(module.lora_up.weight), module.lora_up.weight._version, 
+        id(module.lora_down.weight), module.lora_down.weight._version)
+
+def _use_merged(module, base):
+    # the folded base weight carries no gradient to the LoRA factors, it is only used for inference; 
+    # any other forward (e.g. adaptation, or the unadapted branch at scale 0) unfolds it first
+    if module._merged is None:
+        return False
+    if not module.training and not torch.is_grad_enabled() and module._merged_key == _merge_key(module, base):
+        return True
+    _unmerge(module, base)
+    return False
+
+def _merge(module, base):
+    key = _merge_key(module, base)
+    assert key is not None and getattr(base, 'groups', 1) == 1 and base.weight.is_contiguous()
+    if module._merged is not None and module._merged_key == key:
+        return
+    _unmerge(module, base)
+    # the (rank-sized) factors are kept to subtract exactly the folded update, even if they are modified later on
+    up, down = module.lora_up.weight.detach().flatten(1).clone(), module.lora_down.weight.detach().flatten(1).clone()
+    with torch.no_grad():
+        base.weight.view(base.weight.shape[0], -1).addmm_(up, down, alpha=module.scale)
+    module._merged = (up, down, module.scale, base.weight)
+    module._merged_key = _merge_key(module, base)
+
+def _unmerge(module, base):
+    if module._merged is not None:
+        up, down, scale, weight = module._merged
+        if base.weight is weight: # a replaced base weight holds no folded update
+            with torch.no_grad():
+                base.weight.view(base.weight.shape[0], -1).addmm_(up, down, alpha=-scale)
+    module._merged, module._merged_key = None, None
+
+class LoraRegistry:
+    """
+    LoRA modules injected into a model by ``inject_trainable_lora_extended'', attached to it as ``_lora_registry''.
+    The registered modules share one scale, so toggling LoRA, checking whether it is active and collecting 
+    its parameters need no walk over all modules of the model.
+    """
+    def __init__(self, scale: float = 1.0):
+        self.modules = []
+        self.scale = scale
+        self.num_active = None # num. of adapters in use by ``BatchedLoraInjected'' modules (all if None)
+
+    def register(self, module: nn.Module) -> None:
+        module._registry = self
+        self.modules.append(module)
+
+    @property
+    def is_active(self) -> bool:
+        return isinstance(self.scale, torch.Tensor) or self.scale != 0
+
+    def parameters(self):
+        for module in self.modules:
+            yield module.lora_up.weight
+            yield module.lora_down.weight
+
+    def __len__(self) -> int:
+        return len(self.modules)
+
+def get_lora_registry(model: nn.Module) -> Optional[LoraRegistry]:
+    return getattr(model, '_lora_registry', None)
+
+class _SharedScale:
+    # modules attached to a ``LoraRegistry'' read and write the registry's scale
+    _registry = None
+
+    @property
+    def scale(self):
+        return self._scale if self._registry is None else self._registry.scale
+
+    @scale.setter
+    def scale(self, value):
+        if self._registry is None:
+            self._scale = value
+        else:
+            self._registry.scale = value
+
+class LoraInjectedLinear(_SharedScale, nn.Module):
     def __init__(
         self, in_features, out_features, bias=False, r=4, dropout_p=0.1, scale=1.0
     ):
@@ -26,17 +122,29 @@ class LoraInjectedLinear(nn.Module):
         self.scale = scale
         self.selector = nn.Identity()
 
-        nn.init.normal_(self.lora_down.weight, std=1 / r)
+        self._merged, self._merged_key = None, None
+        self.reset_lora_parameters()
+
+    def reset_lora_parameters(self):
+        nn.init.normal_(self.lora_down.weight, std=1 / self.r)
         nn.init.zeros_(self.lora_up.weight)
 
     def forward(self, input):
-        if self.scale == 0:
+        if _use_merged(self, self.linear) or _is_off(self.scale) or self.r == 0:
             return (self.linear(input))
         else:
             return (self.linear(input) 
                     + self.dropout(self.lora_up(self.selector(self.lora_down(input))))
-                    * self.scale)
+                    * _expand_scale(self.scale, input))
          
+    def merge(self):
+        """folds ``lora_up @ lora_down * scale'' into the base weight in place, the LoRA factors are left untouched"""
+        _merge(self, self.linear)
+
+    def unmerge(self):
+        """subtracts the folded update from the base weight again"""
+        _unmerge(self, self.linear)
+
     def realize_as_lora(self):
         return self.lora_up.weight.data * self.scale, self.lora_down.weight.data
 
@@ -50,7 +158,7 @@ class LoraInjectedLinear(nn.Module):
         ).to(self.lora_up.weight.dtype)
 
 
-class LoraInjectedConv2d(nn.Module):
+class LoraInjectedConv2d(_SharedScale, nn.Module):
     def __init__(
         self,
         in_channels: int,
@@ -104,16 +212,28 @@ class LoraInjectedConv2d(nn.Module):
         self.selector = nn.Identity()
         self.scale = scale
 
-        nn.init.normal_(self.lora_down.weight, std=1 / r)
+        self._merged, self._merged_key = None, None
+        self.reset_lora_parameters()
+
+    def reset_lora_parameters(self):
+        nn.init.normal_(self.lora_down.weight, std=1 / self.r)
         nn.init.zeros_(self.lora_up.weight)
 
     def forward(self, input):
-        if self.scale == 0: 
+        if _use_merged(self, self.conv) or _is_off(self.scale) or self.r == 0:
             return (self.conv(input))
         else: 
             return (self.conv(input)
                 + self.dropout(self.lora_up(self.selector(self.lora_down(input))))
-                * self.scale)
+                * _expand_scale(self.scale, input))
+
+    def merge(self):
+        """folds ``lora_up @ lora_down * scale'' into the base weight in place, the LoRA factors are left untouched"""
+        _merge(self, self.conv)
+
+    def unmerge(self):
+        """subtracts the folded update from the base weight again"""
+        _unmerge(self, self.conv)
 
     def realize_as_lora(self):
         return self.lora_up.weight.data * self.scale, self.lora_down.weight.data
@@ -137,7 +257,7 @@ class LoraInjectedConv2d(nn.Module):
         ).to(self.lora_up.weight.dtype)
 
 
-class LoraInjectedConv1d(nn.Module):
+class LoraInjectedConv1d(_SharedScale, nn.Module):
     def __init__(
         self,
         in_channels: int,
@@ -191,18 +311,30 @@ class LoraInjectedConv1d(nn.Module):
         self.selector = nn.Identity()
         self.scale = scale
 
-        nn.init.normal_(self.lora_down.weight, std=1 / r)
+        self._merged, self._merged_key = None, None
+        self.reset_lora_parameters()
+
+    def reset_lora_parameters(self):
+        nn.init.normal_(self.lora_down.weight, std=1 / self.r)
         nn.init.zeros_(self.lora_up.weight)
 
     def forward(self, input):
-        if self.scale == 0.:
+        if _use_merged(self, self.conv) or _is_off(self.scale) or self.r == 0:
             return (self.conv(input))
         else:    
             return (self.conv(input)
                 + self.dropout(self.lora_up(self.selector(self.lora_down(input))))
-                * self.scale)
+                * _expand_scale(self.scale, input))
             
 
+    def merge(self):
+        """folds ``lora_up @ lora_down * scale'' into the base weight in place, the LoRA factors are left untouched"""
+        _merge(self, self.conv)
+
+    def unmerge(self):
+        """subtracts the folded update from the base weight again"""
+        _unmerge(self, self.conv)
+
     def realize_as_lora(self):
         return self.lora_up.weight.data * self.scale, self.lora_down.weight.data
 
@@ -224,6 +356,138 @@ class LoraInjectedConv1d(nn.Module):
             self.lora_up.weight.device
         ).to(self.lora_up.weight.dtype)
 
+class _AdapterStack(nn.Module):
+    def __init__(self, *shape):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(*shape))
+
+def _stacked(weight, batch_size, registry=None):
+    # the per-adapter ``weight'' (stacked along dim. 0) of each batch element ``b'', i.e. of adapter ``b % num_active''
+    num_active = weight.shape[0] if registry is None or registry.num_active is None else registry.num_active
+    assert batch_size % num_active == 0, (batch_size, num_active)
+    weight = weight[:num_active]
+    return weight if batch_size == num_active else weight.repeat(batch_size // num_active, *[1]*(weight.dim() - 1))
+
+def _add_bias_offsets(module, input, output):
+    # the bias is added last by linear, conv and norm layers, i.e. its offset can be added to the output
+    offsets = _stacked(module.bias_offsets, output.shape[0], registry=module._registry).to(output.dtype)
+    if isinstance(module, nn.Linear):
+        return output + offsets.view(output.shape[0], *[1]*(output.dim() - 2), -1)
+    return output + offsets.view(*offsets.shape, *[1]*(output.dim() - 2))
+
+class BatchedLoraInjected(_SharedScale, nn.Module):
+    """
+    LoRA with one adapter per batch element for nn.Linear, nn.Conv1d and nn.Conv2d. ``lora_down''/``lora_up'' hold 
+    ``num_adapters'' stacked factors, each shaped as in the unbatched modules, applied with a grouped convolution 
+    (or einsum) and a batched 1x1 up-projection. The batch element ``b'' uses adapter ``b % num_active'', 
+    so stacked inputs (e.g. in ``_dual_branch_score'') reuse the adapters. The base layer is shared.
+    """
+    def __init__(self, base: nn.Module, r: int = 4, num_adapters: int = 1, dropout_p: float = 0.1, scale: float = 1.0):
+        super().__init__()
+        if isinstance(base, nn.Linear):
+            in_features, out_features, kernel_size = base.in_features, base.out_features, ()
+            self._base_name = 'linear'
+        else:
+            assert base.groups == 1 and base.padding_mode == 'zeros'
+            in_features, out_features, kernel_size = base.in_channels, base.out_channels, tuple(base.kernel_size)
+            self._base_name = 'conv'
+        if r > min(in_features, out_features):
+            raise ValueError(
+                f"LoRA rank {r} must be less or equal than {min(in_features, out_features)}"
+            )
+        self.r = r
+        self.num_adapters = num_adapters
+        setattr(self, self._base_name, base) # same parameter names as the unbatched modules
+        self.lora_down = _AdapterStack(num_adapters, r, in_features, *kernel_size)
+        self.dropout = nn.Dropout(dropout_p)
+        self.lora_up = _AdapterStack(num_adapters, out_features, r, *[1]*len(kernel_size))
+        self.selector = nn.Identity()
+        self.scale = scale
+
+        self.reset_lora_parameters()
+
+    def reset_lora_parameters(self):
+        nn.init.normal_(self.lora_down.weight, std=1 / self.r)
+        nn.init.zeros_(self.lora_up.weight)
+
+    def _stacked(self, weight, batch_size):
+        return _stacked(weight, batch_size, registry=self._registry)
+
+    def forward(self, input):
+        base = getattr(self, self._base_name)
+        if _is_off(self.scale):
+            return base(input)
+        batch_size = input.shape[0]
+        down = self._stacked(self.lora_down.weight, batch_size)
+        up = self._stacked(self.lora_up.weight, batch_size).flatten(2)
+        if isinstance(base, nn.Linear):
+            lora = torch.einsum('b...r,bor->b...o', torch.einsum('b...i,bri->b...r', input, down), up)
+        else:
+            conv = F.conv2d if isinstance(base, nn.Conv2d) else F.conv1d
+            # samples are folded into channels, one group per sample
+            h = conv(input.reshape(1, -1, *input.shape[2:]), down.flatten(0, 1), None, 
+                base.stride, base.padding, base.dilation, groups=batch_size)
+            lora = torch.einsum('br...,bor->bo...', h.view(batch_size, self.r, *h.shape[2:]), up)
+        return base(input) + self.dropout(lora) * _expand_scale(self.scale, input)
+
+    def merge(self):
+        pass # per-sample adapters cannot be folded into the shared base weight
+
+    def unmerge(self):
+        pass
+
+def inject_batched_bias_offsets(model: nn.Module, modules: List[nn.Module], num_adapters: int) -> None:
+    """
+    Gives each of ``modules'' (linear, conv or norm layers of ``model'' with a frozen bias) ``num_adapters'' trainable 
+    ``bias_offsets'', initialised to zero and added per batch element as the factors of ``BatchedLoraInjected'', 
+    i.e. each adapter retrains its own biases while the shared base bias stays untouched.
+    """
+    registry = get_lora_registry(model)
+    for module in modules:
+        assert not module.bias.requires_grad
+        module.bias_offsets = nn.Parameter(module.bias.new_zeros(num_adapters, *module.bias.shape))
+        module._registry = registry
+        module.register_forward_hook(_add_bias_offsets)
+
+def set_lora_rank(module: nn.Module, keep: Optional[torch.Tensor] = None, r: Optional[int] = None) -> None:
+    """
+    physically resizes the LoRA factors of ``module'': keeps the rank components ``keep'' (pruning), or re-creates 
+    factors of rank ``r'' to be initialised by ``reset_lora_parameters''. Rank 0 switches the LoRA branch off.
+    """
+    assert not isinstance(module, BatchedLoraInjected) and isinstance(module.selector, nn.Identity)
+    down, up = module.lora_down.weight, module.lora_up.weight
+    if keep is not None:
+        down_weight, up_weight = down.detach()[keep].clone(), up.detach()[:, keep].clone()
+    else:
+        down_weight, up_weight = down.new_empty(r, *down.shape[1:]), up.new_empty(up.shape[0], r, *up.shape[2:])
+    module.lora_down.weight = nn.Parameter(down_weight, requires_grad=down.requires_grad)
+    module.lora_up.weight = nn.Parameter(up_weight, requires_grad=up.requires_grad)
+    module.r = down_weight.shape[0]
+    if isinstance(module.lora_down, nn.Linear):
+        module.lora_down.out_features = module.lora_up.in_features = module.r
+    else:
+        module.lora_down.out_channels = module.lora_up.in_channels = module.r
+    module.unmerge()
+
+def match_lora_ranks(model: nn.Module, state: Dict) -> None:
+    """resizes the LoRA modules of ``model'' to the ranks of the factors in ``state'' (e.g. a pruned adapter)"""
+    for name, module in model.named_modules():
+        weight = state.get(f'{name}.lora_down.weight' if name else 'lora_down.weight', None)
+        if weight is not None and not isinstance(module, BatchedLoraInjected) and weight.shape[0] != module.r:
+            set_lora_rank(module, r=weight.shape[0])
+
+def merge_lora(model: nn.Module) -> None:
+    """
+    merged LoRA modules run at the cost of the plain layer under ``torch.no_grad'', see ``_use_merged''. 
+    Until unmerged, the base weights (e.g. in ``state_dict'') hold the folded update.
+    """
+    for module in get_lora_registry(model).modules:
+        module.merge()
+
+def unmerge_lora(model: nn.Module) -> None:
+    for module in get_lora_registry(model).modules:
+        module.unmerge()
+
 def _find_modules(
     model,
     ancestor_class: Optional[Set[str]] = None,
@@ -283,20 +547,30 @@ def inject_trainable_lora_extended(
     model: nn.Module,
     target_replace_module: Set[str] = UNET_EXTENDED_TARGET_REPLACE,
     include_blocks: Set[str] = ['input_blocks', 'middle_block', 'output_blocks', 'out'],
-    r: int = 4
-) -> None:
+    r: int = 4,
+    num_adapters: int = 1
+) -> LoraRegistry:
     """
-    inject lora into model, and returns lora parameter groups.
+    inject lora into model, and returns the registry of injected modules (also attached to ``model'').
+    With ``num_adapters'' > 1 each batch element gets its own adapter, see ``BatchedLoraInjected''.
     """
 
     require_grad_params = []
     names = []
+    registry = get_lora_registry(model)
+    if registry is None:
+        registry = LoraRegistry()
+        model._lora_registry = registry
 
     for _module, name, _child_module in _find_modules(
         _include_blocks_in_model(model, include_blocks), target_replace_module, search_class=[nn.Conv1d, nn.Conv2d, nn.Linear]
     ):
 
-        if _child_module.__class__ == nn.Linear:
+        bias = _child_module.bias
+        if num_adapters > 1:
+            assert not _child_module.weight.requires_grad
+            _tmp = BatchedLoraInjected(_child_module, r=r, num_adapters=num_adapters)
+        elif _child_module.__class__ == nn.Linear:
             weight = _child_module.weight
             bias = _child_module.bias
             _tmp = LoraInjectedLinear(
@@ -355,3 +629,6 @@ def inject_trainable_lora_extended(
         _module._modules[name] = _tmp
         _module._modules[name].lora_up.weight.requires_grad = True
         _module._modules[name].lora_down.weight.requires_grad = True
+        registry.register(_tmp)
+
+    return registry
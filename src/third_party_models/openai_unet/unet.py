@@ -6,6 +6,7 @@ import numpy as np
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from .nn_utils import (
     conv_nd,
@@ -144,8 +145,9 @@ class Concat(nn.Module):
         inputs_shapes2 = [x.shape[2] for x in inputs]
         inputs_shapes3 = [x.shape[3] for x in inputs]
 
-        if (np.all(np.array(inputs_shapes2) == min(inputs_shapes2)) and
-                np.all(np.array(inputs_shapes3) == min(inputs_shapes3))):
+        # plain comparisons of the shapes (no numpy), which ``torch.compile'' traces without a graph break
+        if (all([shape == min(inputs_shapes2) for shape in inputs_shapes2]) and
+                all([shape == min(inputs_shapes3) for shape in inputs_shapes3])):
             inputs_ = inputs
         else:
             target_shape2 = min(inputs_shapes2)
@@ -172,6 +174,7 @@ class ResBlock(TimestepBlock):
     :param dims: determines if the signal is 1D, 2D, or 3D.
     :param up: if True, use this block for upsampling.
     :param down: if True, use this block for downsampling.
+    :param use_checkpoint: if True, use gradient checkpointing on this module.
     """
 
     def __init__(
@@ -184,10 +187,12 @@ class ResBlock(TimestepBlock):
         dims=2,
         up=False,
         down=False,
+        use_checkpoint=False,
     ):
         super().__init__()
         self.channels = channels
         self.emb_channels = emb_channels
+        self.use_checkpoint = use_checkpoint
         self.out_channels = out_channels or channels
         self.use_conv = use_conv
         self.use_scale_shift_norm = use_scale_shift_norm
@@ -235,6 +240,11 @@ class ResBlock(TimestepBlock):
             self.skip_connection = conv_nd(dims, channels, self.out_channels, 1)
 
     def forward(self, x, emb):
+        if self.use_checkpoint and th.is_grad_enabled():
+            return checkpoint(self._forward, x, emb, use_reentrant=False)
+        return self._forward(x, emb)
+
+    def _forward(self, x, emb):
         if self.updown:
             in_rest, in_conv = self.in_layers[:-1], self.in_layers[-1]
             h = in_rest(x)
@@ -270,9 +280,11 @@ class AttentionBlock(nn.Module):
         num_heads=1,
         num_head_channels=-1,
         use_new_attention_order=False,
+        use_checkpoint=False,
     ):
         super().__init__()
         self.channels = channels
+        self.use_checkpoint = use_checkpoint
         if num_head_channels == -1:
             self.num_heads = num_heads
         else:
@@ -292,6 +304,11 @@ class AttentionBlock(nn.Module):
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
+        if self.use_checkpoint and th.is_grad_enabled():
+            return checkpoint(self._forward, x, use_reentrant=False)
+        return self._forward(x)
+
+    def _forward(self, x):
         b, c, *spatial = x.shape
         x = x.reshape(b, c, -1)
         qkv = self.qkv(self.norm(x))
@@ -580,6 +597,16 @@ class OpenAiUNetModel(nn.Module):
         :return: an [N x C x ...] Tensor of outputs.
         """
 
+        h, hs, emb = self.forward_encoder(x, timesteps)
+        return self.forward_decoder(h, hs, emb, timesteps, dtype=x.dtype)
+
+    def forward_encoder(self, x, timesteps):
+        """
+        Apply the timestep embedding, the input blocks and the middle block.
+        :return: the middle block output, the skip activations of the input blocks
+            and the timestep embedding, i.e. the inputs of ``forward_decoder''.
+        """
+
         hs = []
         emb = self.time_embed(timestep_embedding(timesteps, self.model_channels, self.max_period))
 
@@ -588,14 +615,46 @@ class OpenAiUNetModel(nn.Module):
             h = module(h, emb)
             hs.append(h)
         h = self.middle_block(h, emb)
+
+        return h, hs, emb
+
+    def forward_decoder(self, h, hs, emb, timesteps, dtype=None):
+        """
+        Apply the output blocks to the output of ``forward_encoder''.
+        ``hs'' is not consumed, i.e. cached encoder activations can be decoded repeatedly.
+        :param dtype: dtype of the outputs, defaults to the model dtype.
+        """
+
+        hs = list(hs)
         for module in self.output_blocks:
             #h = th.cat([h, hs.pop()], dim=1)
             h = self.concat(h, hs.pop())
             h = module(h, emb)
-        h = h.type(x.dtype)
+        h = h.type(dtype if dtype is not None else self.dtype)
         h = self.out(h)
 
         if not self.marginal_prob_std == None:
             h = h / self.marginal_prob_std(timesteps)[:, None, None, None]
 
-        return h
\ No newline at end of file
+        return h
+
+    def encoder_is_frozen(self):
+        """
+        True if no parameter of the timestep embedding, the input blocks or the middle block is trained,
+        e.g. for decoder-only adaptation or LoRA restricted to ``output_blocks'' and ``out''.
+        """
+
+        return not any([param.requires_grad for name, param in self.named_parameters()
+            if not name.startswith(('output_blocks.', 'out.'))])
+
+    def enable_checkpointing(self, blocks=('input_blocks', 'middle_block', 'output_blocks'), flag=True):
+        """
+        (Dis)ables gradient checkpointing of the ResBlocks and AttentionBlocks in ``blocks'': their activations 
+        are recomputed in the backward pass instead of being stored, e.g. for DPS, adaptation or training on 
+        large images. Only takes effect when gradients are enabled.
+        """
+
+        for name in blocks:
+            for module in getattr(self, name).modules():
+                if isinstance(module, (ResBlock, AttentionBlock)):
+                    module.use_checkpoint = flag
@@ -1,9 +1,16 @@
-from .sde import SDE, VESDE, VPSDE, DDPM, _EPSILON_PRED_CLASSES, _SCORE_PRED_CLASSES
+from .sde import (SDE, VESDE, VPSDE, DDPM, _EPSILON_PRED_CLASSES, _SCORE_PRED_CLASSES, 
+    NoiseSchedule, StepCoeffs, get_step_coeffs, get_logsnr_time_steps)
 from .ema import ExponentialMovingAverage
-from .losses import score_based_loss_fn, epsilon_based_loss_fn
-from .metrics import PSNR, SSIM
-from .trainer import score_model_simple_trainer
+from .losses import score_based_loss_fn, epsilon_based_loss_fn, distillation_loss_fn
+from .metrics import PSNR, SSIM, PSNR_on_device
+from .sync import SyncCounter
+from .async_writer import AsyncSummaryWriter
+from .checkpoint import (get_rng_state, set_rng_state, get_trainable_state, load_trainable_state, 
+    save_sampling_state, load_sampling_state)
+from .trainer import score_model_simple_trainer, score_model_distillation_trainer
 from .cg import cg 
 from .exp_utils import (get_standard_dataset, get_data_from_ground_truth, get_standard_score, 
     get_standard_sampler, get_standard_ray_trafo, get_standard_path, get_standard_configs, 
-    get_standard_sde, get_standard_train_dataset, get_standard_adapted_sampler, get_standard_dataset_configs)
\ No newline at end of file
+    get_standard_sde, get_standard_train_dataset, get_standard_adapted_sampler, get_standard_dataset_configs, 
+    get_standard_adaptation_session, get_standard_adapter_key, get_standard_calibrated_adapter, 
+    load_score_checkpoint)
\ No newline at end of file
@@ -0,0 +1,72 @@
+import queue
+import threading
+import torchvision
+import numpy as np
+
+from torch import Tensor
+from torch.utils.tensorboard import SummaryWriter
+
+from .metrics import PSNR
+
+class AsyncSummaryWriter:
+    """
+    ``SummaryWriter'' running in a background thread. Events are put on a bounded queue and
+    dropped (counted in ``dropped'') if it is full, so the caller never blocks on TensorBoard I/O.
+    Device-to-host copies, ``make_grid'' and PSNR are computed in the background thread as well.
+    """
+    def __init__(self, log_dir: str, max_queue: int = 100):
+        self.log_dir = log_dir
+        self.dropped = 0
+        self.latest = {} # last value written per scalar tag, e.g. for progress bars
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        writer = SummaryWriter(log_dir=self.log_dir)
+        while True:
+            event = self._queue.get()
+            if event is None:
+                break
+            fn, args = event
+            try:
+                fn(writer, *args)
+            except Exception as e: # logging must never take the chain down
+                print(f'logging failed: {e}')
+        writer.close()
+
+    def _submit(self, fn: callable, *args, block: bool = False) -> None:
+        try:
+            self._queue.put((fn, args), block=block)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_scalar(self, writer: SummaryWriter, tag: str, value, global_step: int) -> None:
+        value = value.item() if isinstance(value, Tensor) else float(value)
+        writer.add_scalar(tag, value, global_step)
+        self.latest[tag] = value
+
+    def _write_image_grid(self, writer: SummaryWriter, tag: str, images: Tensor, global_step: int) -> None:
+        writer.add_image(tag, torchvision.utils.make_grid(images.cpu(),
+            normalize=True, scale_each=True), global_step=global_step)
+
+    def _write_psnr(self, writer: SummaryWriter, tag: str, reconstruction: Tensor, ground_truth: Tensor, global_step: int) -> None:
+        reconstruction, ground_truth = reconstruction.cpu().numpy(), ground_truth.cpu().numpy()
+        # mean PSNR over the (possibly batched) observations
+        psnr = np.mean([PSNR(reconstruction[j, 0], ground_truth[j, 0]) for j in range(reconstruction.shape[0])])
+        self._write_scalar(writer, tag, psnr, global_step)
+
+    def add_scalar(self, tag: str, value, global_step: int, block: bool = False) -> None:
+        self._submit(self._write_scalar, tag, value, global_step, block=block)
+
+    def add_image_grid(self, tag: str, images: Tensor, global_step: int, block: bool = False) -> None:
+        self._submit(self._write_image_grid, tag, images.detach(), global_step, block=block)
+
+    def add_psnr(self, tag: str, reconstruction: Tensor, ground_truth: Tensor, global_step: int, block: bool = False) -> None:
+        self._submit(self._write_psnr, tag, reconstruction.detach(), ground_truth.detach(), global_step, block=block)
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        if self.dropped > 0:
+            print(f'logging dropped {self.dropped} events.')
@@ -0,0 +1,44 @@
+from typing import Dict, Optional, Any
+
+import os
+import torch
+import torch.nn as nn
+
+def get_rng_state() -> Dict:
+
+    state = {'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state: Dict) -> None:
+
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def get_trainable_state(model: nn.Module) -> Dict:
+    """only parameters with ``requires_grad'' (e.g. LoRA weights and biases), the frozen base weights are not stored"""
+
+    return {name: param.detach().cpu().clone() for name, param in model.named_parameters() if param.requires_grad}
+
+def load_trainable_state(model: nn.Module, state: Dict) -> None:
+
+    params = dict(model.named_parameters())
+    with torch.no_grad():
+        for name, value in state.items():
+            params[name].copy_(value)
+
+def save_sampling_state(path: str, state: Dict) -> None:
+    """
+    Saves ``state'' atomically, i.e. a job pre-empted while saving leaves the previous snapshot intact.
+    """
+    tmp_path = f'{path}.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_sampling_state(path: str, device: Optional[Any] = None) -> Optional[Dict]:
+
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, map_location=device)
@@ -4,6 +4,7 @@ import torch
 import functools
 import yaml
 import argparse
+import copy
 
 from omegaconf import OmegaConf
 from math import ceil
@@ -12,13 +13,16 @@ from torch.utils.data import TensorDataset
 
 from .sde import VESDE, VPSDE, DDPM, _SCORE_PRED_CLASSES, _EPSILON_PRED_CLASSES
 from .ema import ExponentialMovingAverage
-from ..third_party_models import OpenAiUNetModel, UNetModel
+from .checkpoint import get_trainable_state
+from ..third_party_models import OpenAiUNetModel, UNetModel, get_lora_registry
 from ..dataset import (LoDoPabDatasetFromDival, EllipseDatasetFromDival, MayoDataset,  SubsetLoDoPab, 
     get_disk_dist_ellipses_dataset, get_one_ellipses_dataset, get_walnut_data, AAPMDataset)
 from ..physics import SimpleTrafo, get_walnut_2d_ray_trafo, simulate
 from ..samplers import (BaseSampler, Euler_Maruyama_sde_predictor, Langevin_sde_corrector, 
     chain_simple_init, decomposed_diffusion_sampling_sde_predictor, 
-    adapted_ddim_sde_predictor, tv_loss, _adapt, _score_model_adpt, Ancestral_Sampling)
+    adapted_ddim_sde_predictor, tv_loss, _adapt, _score_model_adpt, Ancestral_Sampling, dpm_solver_sde_predictor, 
+    AdaptationSession, AdapterBank, AdaptationScheduler, LoraRankPruner, 
+    _get_adaptation_optimizer, CompiledPredictor, PicardSampler)
 
 def get_standard_score(model_type, config, sde, use_ema, load_model=True):
 
@@ -120,9 +124,24 @@ def get_standard_score_openai_unet(config, sde, use_ema, load_model=True):
 
     if config.sampling.load_model_from_path is not None and config.sampling.model_name is not None and load_model: 
         print(f'load score model from path: {config.sampling.load_model_from_path}')
+        load_score_checkpoint(score, load_path=config.sampling.load_model_from_path, 
+            model_name=config.sampling.model_name, use_ema=use_ema)
          
     return score
 
+def load_score_checkpoint(score, load_path, model_name='model.pt', use_ema=False):
+    """
+    Loads ``model.pt'' (or, with ``use_ema'', the shadow parameters stored in ``ema_model.pt'') as written by 
+    ``score_model_simple_trainer'' and ``score_model_distillation_trainer''.
+    """
+    state = torch.load(os.path.join(load_path, f'ema_{model_name}' if use_ema else model_name), map_location='cpu')
+    if use_ema:
+        ema = ExponentialMovingAverage(score.parameters(), decay=state['decay'])
+        ema.load_state_dict(state)
+        ema.copy_to(score.parameters())
+    else:
+        score.load_state_dict(state)
+
 def get_standard_sde(config):
 
     _sde_classname = config.sde.type.lower()
@@ -147,20 +166,54 @@ def get_standard_sde(config):
 
     return sde
 
+def _get_early_stopping_kwargs(args, ray_trafo, observation=None):
+
+    if getattr(args, 'es_tol', None) is None:
+        return None
+    residual_fn = None
+    if getattr(args, 'es_criterion', 'xhat0') == 'residual':
+        residual_fn = lambda x: torch.linalg.norm((ray_trafo(x) - observation).flatten(1), dim=1)
+
+    return {
+        'tol': float(args.es_tol),
+        'patience': int(getattr(args, 'es_patience', 5)),
+        'check_freq': int(getattr(args, 'es_check_freq', 1)),
+        'residual_fn': residual_fn
+        }
+
+def _get_init_chain_fn(sample_kwargs, sde, filtbackproj, device=None):
+    """truncated chains (``start_time_step'' > 0) start from the FBP diffused to the starting noise level"""
+    if sample_kwargs['start_time_step'] == 0:
+        return None
+    assert filtbackproj is not None, 'a truncated chain (``pct_chain_elapsed'' > 0) is initialised from the FBP'
+
+    return functools.partial(
+        chain_simple_init,
+        sde=sde,
+        filtbackproj=filtbackproj,
+        start_time_step=sample_kwargs['start_time_step'],
+        im_shape=sample_kwargs['im_shape'],
+        batch_size=sample_kwargs['batch_size'],
+        device=device
+        )
+
 def get_standard_sampler(args, config, score, sde, ray_trafo, observation=None, filtbackproj=None, device=None):
 
     _sampler_funame = args.method.lower()
     _shape = ray_trafo.im_shape if not hasattr(ray_trafo, 'resize') else ray_trafo.resize.shape
+    # a batch of observations runs through one chain, each sample with its own data-fit term
+    _batch_size = config.sampling.batch_size if observation is None else observation.shape[0]
+    nloglik = lambda x: torch.linalg.norm((observation - ray_trafo(x)).flatten(1), dim=1)
     if any([isinstance(sde, classname) for classname in _SCORE_PRED_CLASSES]):
         if _sampler_funame == 'naive':
             predictor = functools.partial(
                 Euler_Maruyama_sde_predictor,
-                nloglik = lambda x: torch.linalg.norm(observation - ray_trafo(x)))
+                nloglik=nloglik)
             sample_kwargs = {
                 'num_steps': int(args.num_steps),
                 'start_time_step': ceil(float(args.pct_chain_elapsed) * int(args.num_steps)),
-                'batch_size': config.sampling.batch_size,
-                'im_shape': [1, _shape],
+                'batch_size': _batch_size,
+                'im_shape': [1, *_shape],
                 'eps': config.sampling.eps,
                 'predictor': {'aTweedy': False, 'penalty': float(args.penalty)},
                 'corrector': {}
@@ -168,22 +221,23 @@ def get_standard_sampler(args, config, score, sde, ray_trafo, observation=None,
         elif _sampler_funame == 'dps':
             predictor = functools.partial(
                 Euler_Maruyama_sde_predictor,
-                nloglik = lambda x: torch.linalg.norm(observation - ray_trafo(x)))
+                nloglik=nloglik)
             sample_kwargs = {
                 'num_steps': int(args.num_steps),
-                'batch_size': config.sampling.batch_size,
+                'batch_size': _batch_size,
                 'start_time_step': ceil(float(args.pct_chain_elapsed) * int(args.num_steps)),
-                'im_shape': [1, _shape],
+                'im_shape': [1, *_shape],
                 'eps': config.sampling.eps,
-                'predictor': {'aTweedy': True, 'penalty': float(args.penalty)},
+                'predictor': {'aTweedy': True, 'penalty': float(args.penalty), 
+                    'jacobian_free': getattr(args, 'jacobian_free', False)},
                 'corrector': {}
                 }
         elif _sampler_funame == 'dds':
             sample_kwargs = {
                 'num_steps': int(args.num_steps),
-                'batch_size': config.sampling.batch_size,
+                'batch_size': _batch_size,
                 'start_time_step': ceil(float(args.pct_chain_elapsed) * int(args.num_steps)),
-                'im_shape': [1, _shape],
+                'im_shape': [1, *_shape],
                 'eps': config.sampling.eps,
                 'predictor': {'eta': float(args.eta), 'gamma': float(args.gamma), 'use_simplified_eqn': True, 'ray_trafo': ray_trafo},
                 'corrector': {}
@@ -195,43 +249,49 @@ def get_standard_sampler(args, config, score, sde, ray_trafo, observation=None,
                 rhs=ray_trafo.trafo_adjoint(observation),
                 cg_kwargs={'max_iter': int(args.cg_iter)}
             )
+        elif _sampler_funame == 'dpms':
+            sample_kwargs = {
+                'num_steps': int(args.num_steps),
+                'batch_size': _batch_size,
+                'start_time_step': ceil(float(args.pct_chain_elapsed) * int(args.num_steps)),
+                'im_shape': [1, *_shape],
+                'eps': config.sampling.eps,
+                'time_grid': 'logsnr',
+                'predictor': {'gamma': float(args.gamma), 'order': int(args.solver_order), 'history': [], 'ray_trafo': ray_trafo},
+                'corrector': {}
+                }
+            predictor = functools.partial(
+                dpm_solver_sde_predictor,
+                score=score,
+                sde=sde,
+                rhs=ray_trafo.trafo_adjoint(observation),
+                cg_kwargs={'max_iter': int(args.cg_iter)}
+            )
         else:
             raise NotImplementedError(_sampler_funame)
 
         corrector = None
         if args.add_corrector_step:
-            corrector = functools.partial(  Langevin_sde_corrector,
-                nloglik = lambda x: torch.linalg.norm(observation - ray_trafo(x))   )
+            corrector = functools.partial(Langevin_sde_corrector, nloglik=nloglik)
             sample_kwargs['corrector']['corrector_steps'] = 5
             sample_kwargs['corrector']['penalty'] = float(args.penalty)
 
-        init_chain_fn = None
-        if sample_kwargs['start_time_step'] > 0:
-            init_chain_fn = functools.partial(  
-            chain_simple_init,
-            sde=sde,
-            filtbackproj=filtbackproj,
-            start_time_step=sample_kwargs['start_time_step'],
-            im_shape=_shape,
-            batch_size=sample_kwargs['batch_size'],
-            device=device
-            )
-    
+
     elif any([isinstance(sde, classname) for classname in _EPSILON_PRED_CLASSES]):
         if _sampler_funame == 'naive':
             raise NotImplementedError(_sampler_funame)
         elif _sampler_funame == 'dps':
             predictor = functools.partial(
                 Ancestral_Sampling,
-                nloglik = lambda x: torch.linalg.norm(observation - ray_trafo(x))) 
+                nloglik=nloglik) 
             sample_kwargs = {
                 'num_steps': int(args.num_steps),
-                'batch_size': config.sampling.batch_size,
+                'batch_size': _batch_size,
                 'start_time_step': ceil(float(args.pct_chain_elapsed) * int(args.num_steps)),
                 'travel_length': config.sampling.travel_length,
                 'travel_repeat': config.sampling.travel_repeat,
                 'im_shape': [1, *_shape],
-                'predictor': {'penalty': float(args.penalty)},
+                'predictor': {'penalty': float(args.penalty), 'jacobian_free': getattr(args, 'jacobian_free', False)},
                 'corrector': {},
                 'early_stopping_pct': float(args.early_stopping_pct)
                 }
@@ -239,7 +299,7 @@ def get_standard_sampler(args, config, score, sde, ray_trafo, observation=None,
         elif _sampler_funame == 'dds':
             sample_kwargs = {
                 'num_steps': int(args.num_steps),
-                'batch_size': config.sampling.batch_size,
+                'batch_size': _batch_size,
                 'start_time_step': ceil(float(args.pct_chain_elapsed) * int(args.num_steps)),
                 'im_shape': [config.model.in_channels, *_shape],
                 'eps': config.sampling.eps,
@@ -255,12 +315,59 @@ def get_standard_sampler(args, config, score, sde, ray_trafo, observation=None,
                 rhs=ray_trafo.trafo_adjoint(observation),
                 cg_kwargs={'max_iter': int(args.cg_iter)}
             )
+        elif _sampler_funame == 'dpms':
+            # the multistep solver assumes a monotone time grid, i.e. no time-travel
+            assert config.sampling.travel_repeat == 1
+            sample_kwargs = {
+                'num_steps': int(args.num_steps),
+                'batch_size': _batch_size,
+                'start_time_step': ceil(float(args.pct_chain_elapsed) * int(args.num_steps)),
+                'im_shape': [config.model.in_channels, *_shape],
+                'eps': config.sampling.eps,
+                'travel_length': config.sampling.travel_length,
+                'travel_repeat': config.sampling.travel_repeat, 
+                'predictor': {'gamma': float(args.gamma), 'order': int(args.solver_order), 'history': [], 'ray_trafo': ray_trafo},
+                'corrector': {}
+                }
+            predictor = functools.partial(
+                dpm_solver_sde_predictor,
+                score=score,
+                sde=sde,
+                rhs=ray_trafo.trafo_adjoint(observation),
+                cg_kwargs={'max_iter': int(args.cg_iter)}
+            )
         else:
             raise NotImplementedError(_sampler_funame)
 
-        assert ceil(float(args.pct_chain_elapsed) * int(args.num_steps)) == 0
-        corrector, init_chain_fn = None, None
+        corrector = None
 
+    sample_kwargs.update({
+        'sync_free': getattr(args, 'sync_free', False),
+        'count_syncs': getattr(args, 'count_syncs', False),
+        'early_stopping': _get_early_stopping_kwargs(args, ray_trafo=ray_trafo, observation=observation),
+        'checkpoint_freq': int(args.checkpoint_freq) if getattr(args, 'checkpoint_freq', None) is not None else None
+        })
+    sample_kwargs.setdefault('early_stopping_pct', float(args.early_stopping_pct))
+    sample_kwargs.setdefault('time_grid', getattr(args, 'time_grid', 'linear')) # ``dpms'' keeps its log-SNR grid
+    init_chain_fn = _get_init_chain_fn(sample_kwargs, sde=sde, filtbackproj=filtbackproj, device=device)
+    if getattr(args, 'compile', False):
+        predictor = CompiledPredictor(predictor, score, 
+            mode=getattr(args, 'compile_mode', None), cache_dir=getattr(args, 'compile_cache_dir', None))
+    if getattr(args, 'picard_window', None) is not None:
+        # parallel-in-time sampling needs a predictor taking pre-sampled ``noise'' and a single step per time step
+        assert _sampler_funame == 'dds' and corrector is None
+        assert sample_kwargs['early_stopping'] is None and sample_kwargs['checkpoint_freq'] is None
+        return PicardSampler(
+            score=score,
+            sde=sde,
+            predictor=predictor,
+            sample_kwargs=sample_kwargs,
+            window=int(args.picard_window),
+            tol=float(getattr(args, 'picard_tol', 1e-3)),
+            per_sample_kwargs={'rhs': ray_trafo.trafo_adjoint(observation)},
+            init_chain_fn=init_chain_fn,
+            device=config.device
+            )
     sampler = BaseSampler(
         score=score,
         sde=sde,
@@ -273,7 +380,102 @@ def get_standard_sampler(args, config, score, sde, ray_trafo, observation=None,
     
     return sampler
 
-def get_standard_adapted_sampler(args, config, score, sde, ray_trafo, observation=None, device=None, complex_y=False):
+def _get_adpt_kwargs(args):
+
+    adpt_kwargs = None
+    if args.adaptation == 'lora':
+        adpt_kwargs = {
+        'include_blocks': args.lora_include_blocks, 
+        'r': int(args.lora_rank),
+        'num_adapters': int(getattr(args, 'batch_size', 1)), # one adapter per observation in the batch
+        'biases_in_blocks_only': getattr(args, 'lora_biases_in_blocks_only', False)
+        }
+    return adpt_kwargs
+
+def _get_adaptation_scheduler(args):
+
+    window = getattr(args, 'adapt_window', None)
+    scheduler_kwargs = {
+        'rel_tol': getattr(args, 'adapt_rel_tol', None),
+        'skip_tol': getattr(args, 'adapt_skip_tol', None),
+        'window': [float(t) for t in window] if window is not None else None,
+        'max_skip': getattr(args, 'adapt_max_skip', None)
+        }
+    if all([value is None for value in scheduler_kwargs.values()]):
+        return None
+    return AdaptationScheduler(
+        rel_tol=float(scheduler_kwargs['rel_tol']) if scheduler_kwargs['rel_tol'] is not None else None,
+        skip_tol=float(scheduler_kwargs['skip_tol']) if scheduler_kwargs['skip_tol'] is not None else None,
+        window=scheduler_kwargs['window'],
+        max_skip=int(scheduler_kwargs['max_skip']) if scheduler_kwargs['max_skip'] is not None else None
+        )
+
+def _get_lora_rank_pruner(args, score, optim=None):
+
+    if args.adaptation != 'lora' or getattr(args, 'lora_target_rank', None) is None:
+        return None
+    assert int(getattr(args, 'batch_size', 1)) == 1, 'per-sample adapters cannot be pruned'
+    return LoraRankPruner(score, target_rank=float(args.lora_target_rank), 
+        prune_freq=int(getattr(args, 'lora_prune_freq', 1)), prune_pct=float(getattr(args, 'lora_prune_pct', 0.25)), optim=optim)
+
+def get_standard_adaptation_session(args, score, warm_start=None):
+
+    # only LoRA keeps the adaptation of batched observations independent
+    assert args.adaptation == 'lora' or int(getattr(args, 'batch_size', 1)) == 1
+
+    return AdaptationSession(score, impl=args.adaptation, adpt_kwargs=_get_adpt_kwargs(args), warm_start=warm_start)
+
+def get_standard_adapter_key(args, config, extra=None):
+
+    if args.model == 'dds_unet':
+        base_ckpt = config.ckpt_path
+    else:
+        base_ckpt = os.path.join(str(config.sampling.load_model_from_path), str(config.sampling.model_name))
+    adpt_kwargs = _get_adpt_kwargs(args) or {}
+    return AdapterBank.key(
+        base_ckpt=f'{base_ckpt}_ema' if args.ema else base_ckpt, 
+        domain=args.adapter_domain if getattr(args, 'adapter_domain', None) is not None else args.dataset,
+        impl=args.adaptation,
+        rank=adpt_kwargs.get('r', None),
+        include_blocks=adpt_kwargs.get('include_blocks', None),
+        # only set if given, i.e. keys of adapters retraining all biases are unchanged
+        extra={**(extra or {}), 'biases_in_blocks_only': True} if adpt_kwargs.get('biases_in_blocks_only', False) else extra
+        )
+
+def get_standard_calibrated_adapter(args, config, score, sde, ray_trafo, observation, bank=None, extra=None, device=None):
+    """
+    Amortised adaptation pre-pass: one adapted chain over a calibration batch of observations (sharing the 
+    forward operator) with a single shared adapter, i.e. the ``_adapt'' objective summed over the batch. 
+    Per-sample adaptation then warm-starts from the returned adapter. It is cached in ``bank'' (if given), 
+    keyed by the adaptation setting and ``extra'' (e.g. dataset, forward operator).
+    """
+    calib_args = argparse.Namespace(**{**vars(args), 
+        'batch_size': 1, # one shared adapter
+        'num_steps': getattr(args, 'calib_num_steps', None) or args.num_steps,
+        'num_optim_step': getattr(args, 'calib_num_optim_step', None) or args.num_optim_step,
+        'keep_optim_state': True, 
+        'checkpoint_freq': None, 
+        'es_tol': None
+        })
+    key = get_standard_adapter_key(calib_args, config, extra={'calibration': observation.shape[0], 
+        'num_steps': calib_args.num_steps, 'num_optim_step': calib_args.num_optim_step, **(extra or {})})
+    if bank is not None and key in bank:
+        print(f'load calibrated adapter {key}')
+        return bank.load(key)
+
+    calib_score = copy.deepcopy(score) # ``score'' itself is adapted later on
+    session = get_standard_adaptation_session(calib_args, calib_score)
+    sampler = get_standard_adapted_sampler(calib_args, config, calib_score, sde, ray_trafo, observation=observation, 
+        filtbackproj=ray_trafo.fbp(observation) if float(getattr(args, 'pct_chain_elapsed', 0)) > 0 else None, 
+        device=device, session=session)
+    sampler.sample(logging=False)
+    if bank is not None:
+        bank.save(key, calib_score, meta={'calibration': observation.shape[0]})
+
+    return get_trainable_state(calib_score)
+
+def get_standard_adapted_sampler(args, config, score, sde, ray_trafo, observation=None, filtbackproj=None, device=None, 
+        complex_y=False, session=None):
 
     if args.method.lower() == 'dds':
         try:
@@ -283,8 +485,8 @@ def get_standard_adapted_sampler(args, config, score, sde, ray_trafo, observatio
         _shape = ray_trafo.im_shape if not hasattr(ray_trafo, 'resize') else ray_trafo.resize.shape
         sample_kwargs = {
             'num_steps': int(args.num_steps),
-            'batch_size': config.sampling.batch_size,
-            'start_time_step': 0,
+            'batch_size': config.sampling.batch_size if observation is None else observation.shape[0],
+            'start_time_step': ceil(float(getattr(args, 'pct_chain_elapsed', 0)) * int(args.num_steps)),
             'im_shape': [config.model.in_channels, *_shape],
             'eps': eps,
             'adapt_freq': int(args.adapt_freq), 
@@ -292,26 +494,45 @@ def get_standard_adapted_sampler(args, config, score, sde, ray_trafo, observatio
                 'eta': float(args.eta), 
                 'use_simplified_eqn': True, 
                 'gamma': float(args.gamma),
-                'ray_trafo': ray_trafo 
+                'ray_trafo': ray_trafo,
+                'use_merged_lora': getattr(args, 'merge_lora', False)
                 },
             'corrector': {},
             'early_stopping_pct': float(args.early_stopping_pct)
             }
-        adpt_kwargs = None
-        if args.adaptation == 'lora':
-            adpt_kwargs = {
-            'include_blocks': args.lora_include_blocks, 
-            'r': int(args.lora_rank)
-            }
-        _score_model_adpt(score, impl=args.adaptation, adpt_kwargs=adpt_kwargs)
+        if session is None:
+            _score_model_adpt(score, impl=args.adaptation, adpt_kwargs=_get_adpt_kwargs(args))
+        else: # undo the adaptation to the previous sample in place
+            assert session.score is score
+            session.reset()
+        registry = get_lora_registry(score)
+        if registry is not None: # the last batch may hold fewer observations than there are adapters
+            registry.num_active = sample_kwargs['batch_size']
+        # one loss per observation, summed by ``_adapt'', i.e. each (per-sample) adapter sees the gradient 
+        # of its own observation and the scheduler tracks each of them
         if complex_y:
-            lloss_fn = lambda x: torch.mean(
-            torch.view_as_real(ray_trafo(x) - observation).pow(2))  + float(args.tv_penalty) * tv_loss(torch.abs(x))
+            lloss_fn = lambda x: torch.view_as_real(ray_trafo(x) - observation).pow(2).flatten(1).mean(dim=1
+            ) + float(args.tv_penalty) * tv_loss(torch.abs(x), per_sample=True)
         else:
-            lloss_fn = lambda x: torch.mean(
-            (ray_trafo(x) - observation).pow(2))  + float(args.tv_penalty) * tv_loss(x)
+            lloss_fn = lambda x: (ray_trafo(x) - observation).pow(2).flatten(1).mean(dim=1
+            ) + float(args.tv_penalty) * tv_loss(x, per_sample=True)
+        optim_kwargs = {
+            'name': getattr(args, 'adapt_optim', 'adam'), 
+            'step_in_backward': getattr(args, 'adapt_step_in_backward', False)
+            }
+        optim = None
+        if getattr(args, 'keep_optim_state', False): # one optimiser for the whole chain
+            optim = _get_adaptation_optimizer(score=score, lr=float(args.lr), **optim_kwargs)
+        pruner = _get_lora_rank_pruner(args, score, optim=optim)
+        # the pruner reads the gradients after the backward pass, these are gone if stepped within it
+        assert pruner is None or not optim_kwargs['step_in_backward']
+        scheduler = _get_adaptation_scheduler(args)
+        # on resume the pruner re-creates the pruned LoRA factors before the optimiser state is restored
+        stateful = {'pruner': pruner, 'optim': optim, 'scheduler': scheduler}
+        sample_kwargs['stateful'] = {name: obj for name, obj in stateful.items() if obj is not None}
         adapt_fn = functools.partial(
-            _adapt, score=score, sde=sde, loss_fn=lloss_fn, num_steps=int(args.num_optim_step), lr=float(args.lr))
+            _adapt, score=score, sde=sde, loss_fn=lloss_fn, num_steps=int(args.num_optim_step), lr=float(args.lr), optim=optim, 
+            scheduler=scheduler, pruner=pruner, optim_kwargs=optim_kwargs)
         predictor = functools.partial(
         adapted_ddim_sde_predictor, score=score, 
                 sde=sde, 
@@ -344,7 +565,18 @@ def get_standard_adapted_sampler(args, config, score, sde, ray_trafo, observatio
             }
         )
 
-    init_chain_fn = None
+    sample_kwargs.update({
+        'sync_free': getattr(args, 'sync_free', False),
+        'count_syncs': getattr(args, 'count_syncs', False),
+        'early_stopping': _get_early_stopping_kwargs(args, ray_trafo=ray_trafo, observation=observation),
+        'checkpoint_freq': int(args.checkpoint_freq) if getattr(args, 'checkpoint_freq', None) is not None else None,
+        'time_grid': getattr(args, 'time_grid', 'linear')
+        })
+
+    init_chain_fn = _get_init_chain_fn(sample_kwargs, sde=sde, filtbackproj=filtbackproj, device=device)
+    if getattr(args, 'compile', False): # the adaptation itself is not captured, only the score model is compiled
+        predictor = CompiledPredictor(predictor, score, whole_step=False, 
+            mode=getattr(args, 'compile_mode', None), cache_dir=getattr(args, 'compile_cache_dir', None))
     sampler = BaseSampler(
         score=score, 
         sde=sde,
@@ -549,7 +781,7 @@ def get_standard_path(args,
                     'num_steps=' + str(args.num_steps),
                     'num_optim_step=' + str(args.num_optim_step),
                     'tv_penalty' + str(args.tv_penalty))
-    elif run_type == 'dds':
+    elif run_type in ['dds', 'dpms']:
         path = os.path.join(path, 
                     run_type,
                     'num_steps=' + str(args.num_steps), 
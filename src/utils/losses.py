@@ -1,5 +1,7 @@
 import torch 
 
+from .sde import get_step_coeffs
+
 def score_based_loss_fn(x, model, sde, eps=1e-5):
 
     """
@@ -39,3 +41,49 @@ def epsilon_based_loss_fn(x, model, sde):
     loss = torch.mean(torch.sum((z - zhat)**2, dim=(1,2,3)))
 
     return loss
+
+def distillation_loss_fn(x, student, teacher, sde, time_steps):
+
+    """
+    The loss function of progressive distillation, see 
+        @inproceedings{salimans2022progressive,
+            title={Progressive Distillation for Fast Sampling of Diffusion Models},
+            author={Salimans, Tim and Ho, Jonathan},
+            booktitle={International Conference on Learning Representations},
+            year={2022}
+        }, available at https://arxiv.org/pdf/2202.00512.pdf.
+    One deterministic DDIM step of the student from ``t'' to ``tminus1'' matches two of the teacher 
+    (via the teacher's grid point ``tmid'' in between), i.e. the student regresses the denoised estimate that 
+    lands on the teacher's two-step target, weighted by the truncated SNR ``max(mean_t^2/std_t^2, 1)''.
+    Args:
+        x: A mini-batch of training data.
+        student: The model being distilled (initialised as the teacher).
+        teacher: The frozen model sampled with twice the steps of the student.
+        sde: the forward sde
+        time_steps: the ``2N + 1'' points of the teacher's ``2N''-step grid, the student steps over every other 
+            point (e.g. the ``uniform'' grids of ``BaseSampler'', which are nested this way).
+    """
+    from ..samplers import apTweedy, ddim # avoids a circular import
+
+    def ddim_step(model, x, t, tminus1):
+        coeffs = get_step_coeffs(sde=sde, t=t, tminus1=tminus1)
+        s = model(x, t)
+        xhat0 = apTweedy(s=s, x=x, sde=sde, time_step=t, coeffs=coeffs)
+        return ddim(sde=sde, s=s, xhat=xhat0, time_step=(t, tminus1), step_size=None, eta=0., coeffs=coeffs)
+
+    time_steps = torch.as_tensor(time_steps, dtype=torch.float32, device=x.device)
+    assert len(time_steps) % 2 == 1
+    idx = 2 * torch.randint((len(time_steps) - 1) // 2, (x.shape[0],), device=x.device)
+    t, tmid, tminus1 = time_steps[idx], time_steps[idx + 1], time_steps[idx + 2]
+    coeffs = get_step_coeffs(sde=sde, t=t, tminus1=tminus1)
+    perturbed_x = coeffs.mean_t * x + coeffs.std_t * torch.randn_like(x)
+    with torch.no_grad():
+        target_x = ddim_step(teacher, ddim_step(teacher, perturbed_x, t, tmid), tmid, tminus1)
+        # the denoised estimate for which one DDIM step from ``perturbed_x'' lands on ``target_x''
+        ratio = coeffs.std_tminus1 / coeffs.std_t
+        target = (target_x - ratio * perturbed_x) / (coeffs.mean_tminus1 - ratio * coeffs.mean_t)
+    xhat0 = apTweedy(s=student(perturbed_x, t), x=perturbed_x, sde=sde, time_step=t, coeffs=coeffs)
+    weight = (coeffs.mean_t / coeffs.std_t).pow(2).clamp(min=1.)
+    loss = torch.mean(torch.sum(weight * (xhat0 - target)**2, dim=(1,2,3)))
+
+    return loss
@@ -1,3 +1,4 @@
+import torch
 import numpy as np
 from skimage.metrics import structural_similarity
 
@@ -15,3 +16,13 @@ def SSIM(reconstruction, ground_truth, data_range=None):
     if data_range is None:
         data_range = np.max(gt) - np.min(gt)
     return structural_similarity(reconstruction, gt, data_range=data_range)
+
+def PSNR_on_device(reconstruction, ground_truth, data_range=None):
+    """
+    PSNR of each sample of a batch [N x ...], computed without leaving the device.
+    """
+    reconstruction, ground_truth = reconstruction.flatten(1), ground_truth.flatten(1)
+    mse = torch.mean((reconstruction - ground_truth)**2, dim=1)
+    if data_range is None:
+        data_range = ground_truth.max(dim=1)[0] - ground_truth.min(dim=1)[0]
+    return 20*torch.log10(data_range) - 10*torch.log10(mse)
@@ -7,6 +7,9 @@ import torch
 import numpy as np 
 import abc
 
+from typing import NamedTuple, Optional, Sequence, Tuple
+from torch import Tensor
+
 
 class SDE(abc.ABC):
 	"""
@@ -128,12 +131,15 @@ class VPSDE(SDE):
 		diffusion = self.diffusion_coeff(t)
 		return drift, diffusion
 
+	def _log_mean_coeff(self, t):
+		return -0.25 * t ** 2 * (self.beta_max - self.beta_min) - 0.5 * t * self.beta_min
+
 	def marginal_prob(self, x, t):
 		"""
 		mean and standard deviation of p_{0t}(x(t) | x(0))
 		"""
-		std = self.marginal_prob_std(t)
-		log_mean_coeff = -0.25 * t ** 2 * (self.beta_max - self.beta_min) - 0.5 * t * self.beta_min
+		log_mean_coeff = self._log_mean_coeff(t)
+		std = torch.sqrt(1. - torch.exp(2. * log_mean_coeff))
 		mean = torch.exp(log_mean_coeff[:, None, None, None]) * x		
 		return mean, std
 
@@ -142,12 +148,12 @@ class VPSDE(SDE):
 		standard deviation of p_{0t}(x(t) | x(0)) is used:
 			- in the UNET as a scaling of the output 
 		"""
-		log_mean_coeff = -0.25 * t ** 2 * (self.beta_max - self.beta_min) - 0.5 * t * self.beta_min
+		log_mean_coeff = self._log_mean_coeff(t)
 		std = torch.sqrt(1. - torch.exp(2. * log_mean_coeff))
 		return std
 
 	def marginal_prob_mean(self, t):
-		log_mean_coeff = -0.25 * t ** 2 * (self.beta_max - self.beta_min) - 0.5 * t * self.beta_min
+		log_mean_coeff = self._log_mean_coeff(t)
 		mean = torch.exp(log_mean_coeff)
 
 		return mean 
@@ -168,10 +174,14 @@ class DDPM(SDE):
 		assert len(self.betas.shape) == 1, 'betas must be 1-D'
 		assert (self.betas > 0).all() and (self.betas <= 1).all()
 		self.alphas = 1.0 - self.betas
+		# cumulative product computed once, prepended with 1. for ``t = -1''
+		self.alphas_cumprod = torch.cat([torch.ones(1, dtype=torch.float64), self.alphas.cumprod(dim=0)], dim=0)
+		self._alphas_cumprod_on_device = {}
 
 	def _compute_alpha_cumprod(self, t):
-		betas = torch.cat([torch.zeros(1), self.betas], dim=0)
-		return (1 - betas.to(t.device)).cumprod(dim=0).index_select(0, t.long() + 1).to(torch.float32)
+		if t.device not in self._alphas_cumprod_on_device:
+			self._alphas_cumprod_on_device[t.device] = self.alphas_cumprod.to(t.device)
+		return self._alphas_cumprod_on_device[t.device].index_select(0, t.long() + 1).to(torch.float32)
 	
 	def diffusion_coeff(self, ):
 		raise NotImplementedError
@@ -194,4 +204,72 @@ class DDPM(SDE):
 		return torch.randn(*shape) 
 
 _EPSILON_PRED_CLASSES = [DDPM]
-_SCORE_PRED_CLASSES = [VPSDE, VESDE]
\ No newline at end of file
+_SCORE_PRED_CLASSES = [VPSDE, VESDE]
+
+
+class StepCoeffs(NamedTuple):
+	"""
+	Coefficients of one (or several) steps from ``t'' to ``tminus1'', shaped as [N x 1 x 1 x 1].
+	"""
+	mean_t: Tensor
+	std_t: Tensor
+	mean_tminus1: Tensor
+	std_tminus1: Tensor
+	tbeta: Tensor # DDIM coefficient (without ``eta'')
+	diffusion_t: Optional[Tensor] = None # only for VE/VP-SDE
+	alpha_t: Optional[Tensor] = None # only for DDPM
+
+
+def get_step_coeffs(sde: SDE, t: Tensor, tminus1: Tensor) -> StepCoeffs:
+	"""
+	Computes the coefficients of the steps from ``t'' to ``tminus1'' (1-D tensors).
+	"""
+	mean_t, std_t = sde.marginal_prob_mean(t), sde.marginal_prob_std(t)
+	mean_tminus1, std_tminus1 = sde.marginal_prob_mean(tminus1), sde.marginal_prob_std(tminus1)
+	if isinstance(sde, VESDE):
+		tbeta = 1 - std_tminus1.pow(2) * std_t.pow(-2)
+	else:
+		tbeta = ((1 - mean_tminus1.pow(2)) / (1 - mean_t.pow(2))).pow(.5) * (1 - mean_t.pow(2) * mean_tminus1.pow(-2)).pow(.5)
+		tbeta = torch.where(tbeta.isnan(), torch.zeros_like(tbeta), tbeta)
+	diffusion_t = sde.diffusion_coeff(t) if not isinstance(sde, DDPM) else None
+	alpha_t = sde.alphas.to(t.device).index_select(0, t.long()).to(torch.float32) if isinstance(sde, DDPM) else None
+
+	return StepCoeffs(*[coeff[:, None, None, None] if coeff is not None else None 
+		for coeff in (mean_t, std_t, mean_tminus1, std_tminus1, tbeta, diffusion_t, alpha_t)])
+
+
+class NoiseSchedule:
+	"""
+	Precomputed coefficients of an SDE on a fixed grid of steps, kept on the sampling device. 
+	``schedule[i]'' returns the ``StepCoeffs'' of the i-th step, which broadcast against [N x C x H x W].
+	"""
+	def __init__(self, sde: SDE, time_pairs: Sequence[Tuple[float, float]], device=None):
+		"""
+		Args:
+			sde: the SDE.
+			time_pairs: the ``(t, tminus1)'' of each step, in the order they are taken.
+			device: the device the coefficients are moved to.
+		"""
+		self.sde = sde
+		self.time_pairs = list(time_pairs)
+		t = torch.tensor([pair[0] for pair in self.time_pairs], dtype=torch.float32, device=device)
+		tminus1 = torch.tensor([pair[1] for pair in self.time_pairs], dtype=torch.float32, device=device)
+		self.coeffs = get_step_coeffs(sde=sde, t=t, tminus1=tminus1)
+
+	def __len__(self):
+		return len(self.time_pairs)
+
+	def __getitem__(self, idx) -> StepCoeffs:
+		idx = slice(idx, idx + 1) if isinstance(idx, int) else idx
+		return StepCoeffs(*[coeff[idx] if coeff is not None else None for coeff in self.coeffs])
+
+
+def get_logsnr_time_steps(sde: SDE, num_steps: int, t_min: float = 1e-3, t_max: float = 1., num_grid: int = 10000):
+	"""
+	``num_steps + 1'' time steps from ``t_max'' to ``t_min'', uniformly spaced in log-SNR (VE/VP-SDE).
+	High-order solvers need it: for VP-SDE a uniform grid in ``t'' gives very uneven log-SNR steps.
+	"""
+	t = torch.linspace(t_min, t_max, num_grid, dtype=torch.float64)
+	logsnr = (torch.log(sde.marginal_prob_mean(t)) - torch.log(sde.marginal_prob_std(t))).numpy()
+	# log-SNR decreases with ``t''
+	return np.interp(np.linspace(logsnr[-1], logsnr[0], num_steps + 1), logsnr[::-1], t.numpy()[::-1])
@@ -0,0 +1,44 @@
+from typing import Optional
+
+import warnings
+import torch
+
+class SyncCounter:
+    """
+    Counts the device-to-host synchronisations triggered between ``start'' and ``stop''.
+    It relies on ``torch.cuda.set_sync_debug_mode'', so it only counts on CUDA; without CUDA 
+    host reads are not seen and ``stop'' returns ``None'' instead of a count.
+    """
+    def __init__(self):
+        self.count = None
+        self._catcher = None
+        self._records = None
+        self._debug_mode = None
+
+    def start(self) -> 'SyncCounter':
+        self._catcher = warnings.catch_warnings(record=True)
+        self._records = self._catcher.__enter__()
+        warnings.simplefilter('always')
+        if torch.cuda.is_available():
+            self._debug_mode = torch.cuda.get_sync_debug_mode()
+            torch.cuda.set_sync_debug_mode('warn')
+        return self
+
+    def stop(self) -> Optional[int]:
+        counting = self._debug_mode is not None
+        if counting:
+            torch.cuda.set_sync_debug_mode(self._debug_mode)
+            self._debug_mode = None
+        self._catcher.__exit__(None, None, None)
+        self.count = sum(['synchroniz' in str(record.message) for record in self._records]) if counting else None
+        for record in self._records:
+            if not 'synchroniz' in str(record.message): # re-emit unrelated warnings
+                warnings.warn_explicit(record.message, record.category, record.filename, record.lineno)
+        self._catcher, self._records = None, None
+        return self.count
+
+    def __enter__(self) -> 'SyncCounter':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
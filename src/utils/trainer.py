@@ -1,15 +1,16 @@
-from typing import Optional, Any, Dict, Tuple
+from typing import Optional, Any, Dict, Tuple, Sequence
 import os 
 import torch 
 import torchvision
 import numpy as np 
 import functools 
+import copy
 
 from tqdm import tqdm 
 from torch.utils.tensorboard import SummaryWriter
 from torch.optim import Adam
 from torch.utils.data import DataLoader
-from .losses import score_based_loss_fn, epsilon_based_loss_fn
+from .losses import score_based_loss_fn, epsilon_based_loss_fn, distillation_loss_fn
 from .ema import ExponentialMovingAverage
 from .sde import SDE, _SCORE_PRED_CLASSES, _EPSILON_PRED_CLASSES
 
@@ -23,9 +24,12 @@ def score_model_simple_trainer(
 	optim_kwargs: Dict,
 	val_kwargs: Dict,
 	device: Optional[Any] = None, 
-	log_dir: str ='./'
+	log_dir: str ='./',
+	grad_checkpoint_blocks: Optional[Sequence[str]] = None
 	) -> None:
 
+	if grad_checkpoint_blocks is not None: # recompute activations of these blocks in the backward pass
+		score.enable_checkpointing(blocks=grad_checkpoint_blocks)
 	writer = SummaryWriter(log_dir=log_dir, comment='training-score-model')
 	optimizer = Adam(score.parameters(), lr=optim_kwargs['lr'])
 	if any([isinstance(sde, classname) for classname in _SCORE_PRED_CLASSES]):
@@ -110,4 +114,78 @@ def score_model_simple_trainer(
 
 	# always save last model 
 	torch.save(score.state_dict(), os.path.join(log_dir, 'model.pt'))
-	torch.save(ema.state_dict(), os.path.join(log_dir, 'ema_model.pt'))
\ No newline at end of file
+	torch.save(ema.state_dict(), os.path.join(log_dir, 'ema_model.pt'))
+
+def score_model_distillation_trainer(
+	teacher: OpenAiUNetModel,
+	sde: SDE, 
+	train_dl: DataLoader, 
+	optim_kwargs: Dict,
+	distill_kwargs: Dict,
+	device: Optional[Any] = None, 
+	log_dir: str ='./',
+	grad_checkpoint_blocks: Optional[Sequence[str]] = None
+	) -> OpenAiUNetModel:
+
+	"""
+	Progressive distillation: starting from ``distill_kwargs['num_steps']'' the student of each round 
+	samples with one (deterministic DDIM) step what its teacher samples with two, and is the teacher of the 
+	next round, until ``distill_kwargs['final_num_steps']'' are reached. All rounds share one nested grid, the 
+	``uniform'' time grid of ``BaseSampler'', i.e. the student of ``N'' steps is meant to be sampled with 
+	``num_steps'' set to ``N'' and ``time_grid'' to ``uniform'' (e.g. by the DDS and adapted predictors). 
+	Students are saved as ``model.pt''/``ema_model.pt'' in ``{log_dir}/{N}_steps'', the final one in ``log_dir'' 
+	as well, and load via ``get_standard_score''.
+	"""
+	writer = SummaryWriter(log_dir=log_dir, comment='distilling-score-model')
+	num_steps = distill_kwargs['num_steps']
+	# the grid of the first teacher, the student of ``N'' steps steps over every ``2 * num_steps / N''-th point
+	_, time_pairs, _ = BaseSampler(score=None, sde=sde, predictor=None, sample_kwargs={
+		'num_steps': 2 * num_steps, 'eps': distill_kwargs['eps'], 'time_grid': 'uniform'}, device=device)._time_grid()
+	grid = [t for t, _ in time_pairs] + [time_pairs[-1][1]]
+	global_step = 0
+	while num_steps >= distill_kwargs['final_num_steps']:
+		teacher.eval()
+		for p in teacher.parameters():
+			p.requires_grad_(False)
+		student = copy.deepcopy(teacher)
+		for p in student.parameters():
+			p.requires_grad_(True)
+		if grad_checkpoint_blocks is not None: # recompute activations of these blocks in the backward pass
+			student.enable_checkpointing(blocks=grad_checkpoint_blocks)
+		assert distill_kwargs['num_steps'] % num_steps == 0, 'the num. of steps has to halve evenly in every round'
+		time_steps = grid[::distill_kwargs['num_steps'] // num_steps] # the grid of the teacher
+		optimizer = Adam(student.parameters(), lr=optim_kwargs['lr'])
+		ema = ExponentialMovingAverage(student.parameters(), decay=optim_kwargs['ema_decay'])
+		student.train()
+		avg_loss, num_items = 0, 0
+		train_iter = iter(train_dl)
+		for idx in tqdm(range(distill_kwargs['num_iters']), desc=f'distill {2*num_steps} -> {num_steps} steps'):
+			try:
+				batch = next(train_iter)
+			except StopIteration:
+				train_iter = iter(train_dl)
+				batch = next(train_iter)
+			x = batch.to(device)
+			loss = distillation_loss_fn(x, student=student, teacher=teacher, sde=sde, time_steps=time_steps)
+			optimizer.zero_grad()
+			loss.backward()
+			optimizer.step()
+			ema.update(student.parameters())
+
+			avg_loss += loss.item() * x.shape[0]
+			num_items += x.shape[0]
+			if idx % optim_kwargs['log_freq'] == 0:
+				writer.add_scalar(f'distill/loss_{num_steps}_steps', loss.item(), global_step)
+			global_step += 1
+
+		print('Average Loss ({} steps): {:5f}'.format(num_steps, avg_loss / num_items))
+		student_dir = os.path.join(log_dir, f'{num_steps}_steps')
+		os.makedirs(student_dir, exist_ok=True)
+		for path in [student_dir] + ([log_dir] if num_steps // 2 < distill_kwargs['final_num_steps'] else []):
+			torch.save(student.state_dict(), os.path.join(path, 'model.pt'))
+			torch.save(ema.state_dict(), os.path.join(path, 'ema_model.pt'))
+		# the next round distills the averaged student
+		ema.copy_to(student.parameters())
+		teacher, num_steps = student, num_steps // 2
+
+	return teacher
@@ -0,0 +1,53 @@
+import torch
+
+from src.samplers import AdaptationSession, AdapterBank
+from src.third_party_models import get_lora_registry
+from .utils import get_toy_sde, get_toy_score
+
+_ADPT_KWARGS = {'r': 4, 'include_blocks': ['input_blocks', 'middle_block', 'output_blocks', 'out']}
+
+def _perturb_trainable(score, seed=1):
+	g = torch.Generator().manual_seed(seed)
+	with torch.no_grad():
+		for param in score.parameters():
+			if param.requires_grad:
+				param.add_(torch.randn(param.shape, generator=g) * 0.05)
+
+def test_swap_restores_a_banked_adapter(tmp_path):
+	torch.manual_seed(0)
+	score = get_toy_score(get_toy_sde('vesde')).eval()
+	session = AdaptationSession(score, impl='lora', adpt_kwargs=_ADPT_KWARGS, verbose=False)
+	x, t = torch.randn(2, 1, 16, 16), torch.ones(2) * 0.5
+	_perturb_trainable(score)
+	bank = AdapterBank(str(tmp_path))
+	key = AdapterBank.key(base_ckpt='toy', domain='test', rank=4, include_blocks=_ADPT_KWARGS['include_blocks'])
+	bank.save(key, score)
+	with torch.no_grad():
+		s_adapted = score(x, t)
+		session.reset()
+		assert not torch.allclose(score(x, t), s_adapted)
+		AdapterBank.swap(score, bank.load(key))
+		assert torch.allclose(score(x, t), s_adapted)
+
+def test_swap_into_batched_lora_leaves_base_weights_untouched():
+	torch.manual_seed(0)
+	single = get_toy_score(get_toy_sde('vesde')).eval()
+	base_state = {name: value.clone() for name, value in single.state_dict().items()}
+	AdaptationSession(single, impl='lora', adpt_kwargs=_ADPT_KWARGS, verbose=False)
+	_perturb_trainable(single)
+	adapter = {name: param.detach().clone() for name, param in single.named_parameters() if param.requires_grad}
+
+	score = get_toy_score(get_toy_sde('vesde')).eval()
+	score.load_state_dict(base_state)
+	session = AdaptationSession(score, impl='lora', adpt_kwargs={**_ADPT_KWARGS, 'num_adapters': 2}, verbose=False)
+	frozen = {name: param.detach().clone() for name, param in score.named_parameters() if not param.requires_grad}
+	AdapterBank.swap(score, adapter)
+	for name, param in score.named_parameters():
+		if name in frozen:
+			assert torch.equal(param, frozen[name]), name
+	for module in get_lora_registry(score).modules: # broadcast to both adapters
+		assert torch.equal(module.lora_up.weight[0], module.lora_up.weight[1])
+	session.reset()
+	for name, param in score.named_parameters():
+		if name in frozen:
+			assert torch.equal(param, frozen[name]), name
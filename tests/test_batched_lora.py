@@ -0,0 +1,72 @@
+import copy
+import torch
+
+from src.samplers import AdaptationScheduler, AdapterBank, _score_model_adpt
+from src.third_party_models import get_lora_registry
+from .utils import get_toy_sde, get_toy_score
+
+_ADPT_KWARGS = {'r': 4, 'include_blocks': ['input_blocks', 'middle_block', 'output_blocks', 'out']}
+
+def _adapt(score, x, t, num_steps=3):
+	# plain SGD, Adam normalises vanishing gradients, i.e. amplifies their round-off
+	optim = torch.optim.SGD([param for param in score.parameters() if param.requires_grad], lr=1e-2)
+	for _ in range(num_steps):
+		optim.zero_grad()
+		# one loss per sample, summed as in ``_adapt''
+		(score(x, t) - 1.).pow(2).flatten(1).mean(dim=1).sum().backward()
+		optim.step()
+
+def _get_batched_and_single_scores(num_adapters):
+	torch.manual_seed(0)
+	base = get_toy_score(get_toy_sde('vesde')).eval()
+	with torch.no_grad(): # the output layer is initialised to zero
+		base.out[-1].weight.normal_(std=0.05)
+	batched = copy.deepcopy(base)
+	_score_model_adpt(batched, impl='lora', adpt_kwargs={**_ADPT_KWARGS, 'num_adapters': num_adapters}, verbose=False)
+	batched.eval() # as in ``_adapt'', the injected modules come with dropout
+	singles = []
+	for k in range(num_adapters): # same initial factors as the k-th adapter
+		single = copy.deepcopy(base)
+		_score_model_adpt(single, impl='lora', adpt_kwargs=_ADPT_KWARGS, verbose=False)
+		single.eval()
+		with torch.no_grad():
+			for module, module_batched in zip(get_lora_registry(single).modules, get_lora_registry(batched).modules):
+				module.lora_down.weight.copy_(module_batched.lora_down.weight[k])
+				module.lora_up.weight.copy_(module_batched.lora_up.weight[k])
+		singles.append(single)
+	return base, batched, singles
+
+def test_batched_adaptation_matches_sequential_adaptation():
+	base, batched, singles = _get_batched_and_single_scores(num_adapters=2)
+	x, t = torch.randn(2, 1, 16, 16), torch.ones(2) * 0.5
+	frozen = {name: param.detach().clone() for name, param in batched.named_parameters() if not param.requires_grad}
+	_adapt(batched, x, t)
+	for k, single in enumerate(singles):
+		_adapt(single, x[k:k + 1], t[k:k + 1])
+	with torch.no_grad():
+		s_batched = batched(x, t)
+		s_singles = torch.cat([single(x[k:k + 1], t[k:k + 1]) for k, single in enumerate(singles)])
+		assert not torch.allclose(s_batched, base(x, t), atol=1e-4) # biases and LoRA factors were adapted
+		assert torch.allclose(s_batched, s_singles, rtol=1e-4, atol=1e-5)
+	# the shared base weights (biases included) stay frozen
+	for name, param in batched.named_parameters():
+		if name in frozen:
+			assert torch.equal(param, frozen[name]), name
+	assert any(['bias' in name for name in frozen])
+
+def test_single_adapter_swaps_into_batched_lora():
+	base, batched, (single, _) = _get_batched_and_single_scores(num_adapters=2)
+	x, t = torch.randn(1, 1, 16, 16), torch.ones(1) * 0.5
+	_adapt(single, x, t)
+	AdapterBank.swap(batched, {name: param.detach() for name, param in single.named_parameters() if param.requires_grad})
+	with torch.no_grad():
+		assert torch.allclose(batched(torch.cat([x, x]), torch.cat([t, t])), single(x, t).repeat(2, 1, 1, 1), atol=1e-5)
+
+def test_scheduler_decides_per_adapter():
+	scheduler = AdaptationScheduler(rel_tol=0.1, skip_tol=0.1)
+	# the summed loss barely improves, the first adapter still does
+	assert not scheduler.converged([0.5, 99.9], [1., 100.])
+	assert scheduler.converged([0.95, 99.9], [1., 100.])
+	scheduler.update([1., 100.], num_optim_steps=1)
+	assert not scheduler.skip([0.5, 100.])
+	assert scheduler.skip([0.95, 100.5])
@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from src.utils import get_standard_sampler
+from .utils import get_toy_sde, get_toy_score, get_toy_args, get_toy_config, ToyRayTrafo
+
+def _sample(sde_name, ground_truth):
+	torch.manual_seed(0)
+	sde, ray_trafo = get_toy_sde(sde_name), ToyRayTrafo()
+	score = get_toy_score(sde).eval()
+	with torch.no_grad(): # the output layer is initialised to zero
+		score.out[-1].weight.normal_(std=0.05)
+	sampler = get_standard_sampler(get_toy_args(eta=0.), get_toy_config(batch_size=ground_truth.shape[0]), 
+		score, sde, ray_trafo, observation=ray_trafo(ground_truth), filtbackproj=ground_truth, device='cpu')
+	torch.manual_seed(5)
+	return sampler.sample(logging=False)
+
+@pytest.mark.parametrize('sde_name', ['vpsde', 'ddpm'])
+def test_batched_chain_matches_chain_per_observation(sde_name):
+	ground_truth = torch.rand(2, 1, 16, 16, generator=torch.Generator().manual_seed(1))
+	x = _sample(sde_name, ground_truth)
+	# the first sample starts from the same prior sample, the deterministic (``eta = 0'') chain must not 
+	# depend on the other observation in the batch, e.g. through the CG step sizes
+	x_single = _sample(sde_name, ground_truth[:1])
+	assert torch.allclose(x[:1], x_single, rtol=1e-4, atol=1e-4 * x_single.abs().max().item())
+	assert not torch.allclose(x[1:], x_single, atol=1e-2)
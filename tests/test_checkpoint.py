@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+from src.utils import get_standard_sampler, get_standard_adapted_sampler
+from .utils import get_toy_sde, get_toy_score, get_toy_args, get_toy_config, ToyRayTrafo
+
+class _Preempted(Exception):
+	pass
+
+def _get_sampler(sde_name, adapted, seed=0):
+	torch.manual_seed(0) # same (pretrained) base weights
+	sde, ray_trafo = get_toy_sde(sde_name), ToyRayTrafo()
+	score = get_toy_score(sde).eval()
+	with torch.no_grad(): # the output layer is initialised to zero
+		score.out[-1].weight.normal_(std=0.05)
+	ground_truth = torch.rand(1, 1, 16, 16, generator=torch.Generator().manual_seed(1))
+	args = get_toy_args(checkpoint_freq=3, eta=0.8)
+	torch.manual_seed(seed)
+	if adapted:
+		return get_standard_adapted_sampler(args, get_toy_config(), score, sde, ray_trafo, 
+			observation=ray_trafo(ground_truth), device='cpu')
+	return get_standard_sampler(args, get_toy_config(), score, sde, ray_trafo, 
+		observation=ray_trafo(ground_truth), filtbackproj=ground_truth, device='cpu')
+
+def _preempt_at(sampler, step):
+	predictor, num_calls = sampler.predictor, [0]
+	def _predictor(**kwargs):
+		num_calls[0] += 1
+		if num_calls[0] == step:
+			raise _Preempted
+		return predictor(**kwargs)
+	sampler.predictor = _predictor
+
+@pytest.mark.parametrize('sde_name,adapted', [('vesde', False), ('vesde', True), ('ddpm', True)])
+def test_resumed_chain_matches_uninterrupted_chain(sde_name, adapted, tmp_path):
+	sampler = _get_sampler(sde_name, adapted)
+	torch.manual_seed(5)
+	x = sampler.sample(logging=False)
+	checkpoint_path = str(tmp_path / 'chain.pt')
+	sampler = _get_sampler(sde_name, adapted)
+	_preempt_at(sampler, step=8)
+	torch.manual_seed(5)
+	with pytest.raises(_Preempted):
+		sampler.sample(logging=False, checkpoint_path=checkpoint_path)
+	# a fresh process, i.e. freshly injected (and initialised) adapters and another seed
+	sampler = _get_sampler(sde_name, adapted, seed=1)
+	torch.manual_seed(123)
+	x_resumed = sampler.sample(logging=False, checkpoint_path=checkpoint_path)
+	assert torch.allclose(x_resumed, x, atol=1e-5)
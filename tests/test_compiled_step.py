@@ -0,0 +1,52 @@
+import functools
+import os
+import warnings
+import pytest
+import torch
+
+from src.samplers.compiled_step import CompiledPredictor
+from .utils import get_toy_sde, get_toy_score
+
+def _failing_backend(gm, example_inputs):
+	raise NotImplementedError('backend not available')
+
+def _predictor(score, x, time_step, adapt_fn=None):
+	if adapt_fn is not None:
+		adapt_fn(x=x, time_step=time_step)
+	return score(x, time_step)
+
+def _adapt(score, x, time_step, seen):
+	seen.append(score)
+
+def test_compile_cache_is_configured(tmp_path, monkeypatch):
+	from torch._inductor import config as inductor_config
+	monkeypatch.setenv('TORCHINDUCTOR_CACHE_DIR', '')
+	monkeypatch.setattr(inductor_config, 'fx_graph_cache', False)
+	score = get_toy_score(get_toy_sde('vesde'))
+	CompiledPredictor(_predictor, score=score, cache_dir=str(tmp_path / 'cache'))
+	assert os.environ['TORCHINDUCTOR_CACHE_DIR'] == str(tmp_path / 'cache') and inductor_config.fx_graph_cache
+
+def test_score_falls_back_to_eager_if_compiling_fails(monkeypatch):
+	torch.manual_seed(0)
+	score = get_toy_score(get_toy_sde('vesde')).eval()
+	x, t = torch.randn(2, 1, 16, 16), torch.ones(2) * 0.5
+	seen = []
+	predictor = functools.partial(_predictor, adapt_fn=functools.partial(_adapt, score=score, seen=seen))
+	compiled = CompiledPredictor(predictor, score=score, whole_step=False)
+	torch._dynamo.reset()
+	monkeypatch.setattr(torch, 'compile', functools.partial(torch.compile, backend=_failing_backend))
+	with torch.no_grad(), pytest.warns(UserWarning, match='runs eagerly'):
+		s = compiled(score=score, x=x, time_step=t)
+	assert torch.equal(s, score(x, t))
+	# callables bound to the score model get the compiled one as well
+	assert seen[0] is not score and seen[0].out is score.out
+	torch._dynamo.reset()
+
+def test_runtime_errors_are_not_swallowed():
+	score = get_toy_score(get_toy_sde('vesde')).eval()
+	compiled = CompiledPredictor(_predictor, score=score, whole_step=True)
+	with torch.no_grad(), pytest.raises(RuntimeError) as e, warnings.catch_warnings():
+		warnings.simplefilter('error') # raised as is, without falling back to eager
+		compiled(score=score, x=torch.randn(2, 3, 16, 16), time_step=torch.ones(2))
+	assert 'channels' in str(e.value)
+	torch._dynamo.reset()
@@ -0,0 +1,35 @@
+import copy
+import pytest
+import torch
+
+from src.samplers import BaseSampler
+from src.utils import distillation_loss_fn
+from .utils import get_toy_sde, get_toy_score
+
+def _grid(sde, num_steps, eps=1e-3):
+	_, time_pairs, _ = BaseSampler(score=None, sde=sde, predictor=None, sample_kwargs={
+		'num_steps': num_steps, 'eps': eps, 'time_grid': 'uniform'})._time_grid()
+	return [t for t, _ in time_pairs] + [time_pairs[-1][1]]
+
+@pytest.mark.parametrize('sde_name', ['vesde', 'vpsde', 'ddpm'])
+def test_uniform_time_grids_are_nested(sde_name):
+	sde = get_toy_sde(sde_name)
+	for num_steps in [32, 16, 8, 4]:
+		teacher_grid, student_grid = _grid(sde, 2 * num_steps), _grid(sde, num_steps)
+		assert len(student_grid) == num_steps + 1 and student_grid == teacher_grid[::2]
+	# the last step lands on ``eps'' (``-1'', i.e. the denoised estimate, for DDPM) instead of overshooting it
+	assert student_grid[-1] == (-1 if sde_name == 'ddpm' else 1e-3)
+
+@pytest.mark.parametrize('sde_name,num_steps', [('vpsde', 256), ('vpsde', 64), ('vesde', 256), ('ddpm', 8)])
+def test_distillation_loss_is_finite(sde_name, num_steps):
+	torch.manual_seed(0)
+	sde = get_toy_sde(sde_name)
+	student = get_toy_score(sde)
+	teacher = copy.deepcopy(student).requires_grad_(False)
+	grid = _grid(sde, 2 * num_steps)
+	# the last steps (towards ``t = 0'' for VE/VP-SDE) are the ones that used to yield NaNs
+	loss = distillation_loss_fn(torch.rand(4, 1, 16, 16), student=student, teacher=teacher,
+		sde=sde, time_steps=grid[-5:])
+	loss.backward()
+	assert torch.isfinite(loss)
+	assert all(torch.isfinite(p.grad).all() for p in student.parameters() if p.grad is not None)
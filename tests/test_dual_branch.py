@@ -0,0 +1,31 @@
+import pytest
+import torch
+
+from src.samplers import _score_model_adpt
+from src.samplers.utils import _dual_branch_score, _tune_lora_scale
+from src.third_party_models import get_lora_registry
+from .utils import get_toy_sde, get_toy_score
+
+@pytest.mark.parametrize('num_adapters', [1, 2])
+def test_dual_branch_matches_two_forward_passes(num_adapters):
+	torch.manual_seed(0)
+	score = get_toy_score(get_toy_sde('vesde')).eval()
+	with torch.no_grad(): # the output layer is initialised to zero
+		score.out[-1].weight.normal_(std=0.05)
+	_score_model_adpt(score, impl='lora', adpt_kwargs={'r': 4, 'num_adapters': num_adapters,
+		'include_blocks': ['input_blocks', 'middle_block', 'output_blocks', 'out']}, verbose=False)
+	score.eval()
+	with torch.no_grad():
+		for module in get_lora_registry(score).modules:
+			module.lora_up.weight.normal_(std=0.05) # LoRA is the identity at initialisation
+	x, t = torch.randn(2, 1, 16, 16), torch.ones(2) * 0.5
+	with torch.no_grad():
+		s, s_base = _dual_branch_score(score=score, x=x, time_step=t)
+		s_ref = score(x, t)
+		_tune_lora_scale(score=score, scale=0.)
+		s_base_ref = score(x, t)
+		_tune_lora_scale(score=score, scale=1.)
+		assert not torch.allclose(s_ref, s_base_ref, atol=1e-4)
+		assert torch.allclose(s, s_ref, atol=1e-5) and torch.allclose(s_base, s_base_ref, atol=1e-5)
+		# the scale is reset afterwards
+		assert torch.allclose(score(x, t), s_ref, atol=1e-6)
@@ -0,0 +1,55 @@
+import copy
+import torch
+
+from src.samplers import _score_model_adpt
+from src.samplers.utils import _dual_branch_score, _tune_lora_scale
+from src.third_party_models import get_lora_registry, merge_lora, unmerge_lora
+from .utils import get_toy_sde, get_toy_score
+
+def _get_adapted_score():
+	torch.manual_seed(0)
+	score = get_toy_score(get_toy_sde('vesde')).eval()
+	_score_model_adpt(score, impl='lora', adpt_kwargs={'r': 4,
+		'include_blocks': ['input_blocks', 'middle_block', 'output_blocks', 'out']}, verbose=False)
+	with torch.no_grad():
+		for module in get_lora_registry(score).modules:
+			module.lora_up.weight.normal_(std=0.05) # LoRA is the identity at initialisation
+	return score
+
+def _base_weights(score):
+	return {name: param.detach().clone() for name, param in score.named_parameters() if not param.requires_grad}
+
+def test_merged_forward_matches_lora_forward():
+	score = _get_adapted_score()
+	x, t = torch.randn(2, 1, 16, 16), torch.ones(2) * 0.5
+	with torch.no_grad():
+		s_ref, s_base_ref = score(x, t), _dual_branch_score(score=score, x=x, time_step=t)[1]
+		weights = _base_weights(score)
+		ptrs = {name: param.data_ptr() for name, param in score.named_parameters()}
+		for _ in range(3): # as ``adapted_ddim_sde_predictor'' on steps without adaptation
+			merge_lora(score)
+			s = score(x, t)
+			_tune_lora_scale(score=score, scale=0)
+			s_base = score(x, t)
+			_tune_lora_scale(score=score, scale=1.)
+			assert torch.allclose(s, s_ref, atol=1e-5) and torch.allclose(s_base, s_base_ref, atol=1e-5)
+	# folded in place, no copy of the base weights is made
+	assert ptrs == {name: param.data_ptr() for name, param in score.named_parameters()}
+	unmerge_lora(score)
+	for name, value in _base_weights(score).items():
+		assert torch.allclose(value, weights[name], atol=1e-6), name
+
+def test_merged_weights_are_unfolded_for_adaptation():
+	score = _get_adapted_score()
+	x, t = torch.randn(2, 1, 16, 16), torch.ones(2) * 0.5
+	weights = _base_weights(score)
+	reference = copy.deepcopy(score)
+	with torch.no_grad():
+		merge_lora(score)
+		score(x, t)
+	score(x, t).pow(2).mean().backward()
+	reference(x, t).pow(2).mean().backward()
+	for param, param_ref in zip(get_lora_registry(score).parameters(), get_lora_registry(reference).parameters()):
+		assert torch.allclose(param.grad, param_ref.grad, atol=1e-6)
+	for name, value in _base_weights(score).items():
+		assert torch.allclose(value, weights[name], atol=1e-6), name
@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from src.samplers import LoraRankPruner, _score_model_adpt, _get_adaptation_optimizer
+from .utils import get_toy_sde, get_toy_score
+
+@pytest.mark.parametrize('optim_name', ['adam', 'adafactor'])
+def test_pruning_keeps_optimizer_state_consistent(optim_name):
+	if optim_name == 'adafactor' and not hasattr(torch.optim, 'Adafactor'):
+		pytest.skip('Adafactor requires torch >= 2.5')
+	torch.manual_seed(0)
+	sde = get_toy_sde('vesde')
+	score = get_toy_score(sde).eval()
+	_score_model_adpt(score, impl='lora', adpt_kwargs={'r': 4, 
+		'include_blocks': ['input_blocks', 'middle_block', 'output_blocks', 'out']}, verbose=False)
+	# one optimiser kept over the whole chain (``--keep_optim_state'')
+	optim = _get_adaptation_optimizer(score=score, lr=1e-3, name=optim_name)
+	pruner = LoraRankPruner(score, target_rank=1, prune_freq=1, prune_pct=0.5, optim=optim)
+	x, t = torch.randn(2, 1, 16, 16), torch.ones(2) * 0.5
+	ranks = []
+	for _ in range(4): # an adaptation call with two optimisation steps each, pruning after every call
+		for _ in range(2):
+			optim.zero_grad()
+			score(x, t).pow(2).mean().backward()
+			pruner.accumulate()
+			optim.step()
+		pruner.step()
+		ranks.append(sum([module.r for module in pruner.registry.modules]))
+	assert ranks[-1] < ranks[0]
+	for module in pruner.registry.modules:
+		for param in [module.lora_down.weight, module.lora_up.weight]:
+			for value in optim.state.get(param, {}).values():
+				if isinstance(value, torch.Tensor) and value.ndim == param.ndim:
+					assert all([v in (1, p) for v, p in zip(value.shape, param.shape)])
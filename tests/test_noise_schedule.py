@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from src.samplers import BaseSampler
+from src.utils import NoiseSchedule, VESDE, DDPM
+from .utils import get_toy_sde
+
+def _reference_coeffs(sde, t, tminus1):
+	# the coefficients as the predictors computed them per step
+	std_t, std_tminus1 = sde.marginal_prob_std(t=t), sde.marginal_prob_std(t=tminus1)
+	mean_t, mean_tminus1 = sde.marginal_prob_mean(t=t), sde.marginal_prob_mean(t=tminus1)
+	if isinstance(sde, VESDE):
+		tbeta = 1 - (std_tminus1.pow(2) * std_t.pow(-2))
+	else:
+		tbeta = ((1 - mean_tminus1.pow(2)) / (1 - mean_t.pow(2))).pow(.5) * (1 - mean_t.pow(2) * mean_tminus1.pow(-2)).pow(.5)
+		if any(tbeta.isnan()): tbeta = torch.zeros(*tbeta.shape)
+	return {'mean_t': mean_t, 'std_t': std_t, 'mean_tminus1': mean_tminus1, 'std_tminus1': std_tminus1, 'tbeta': tbeta}
+
+@pytest.mark.parametrize('sde_name', ['vesde', 'vpsde', 'ddpm'])
+def test_schedule_matches_per_step_coefficients(sde_name):
+	sde = get_toy_sde(sde_name)
+	_, time_pairs, _ = BaseSampler(score=None, sde=sde, predictor=None, sample_kwargs={'num_steps': 10, 'eps': 1e-3, 
+		'travel_length': 1, 'travel_repeat': 1})._time_grid()
+	schedule = NoiseSchedule(sde=sde, time_pairs=time_pairs)
+	assert len(schedule) == len(time_pairs)
+	for i, (t, tminus1) in enumerate(time_pairs):
+		coeffs = schedule[i]
+		t, tminus1 = torch.tensor([t], dtype=torch.float32), torch.tensor([tminus1], dtype=torch.float32)
+		for name, value in _reference_coeffs(sde, t, tminus1).items():
+			assert getattr(coeffs, name).shape == (1, 1, 1, 1)
+			assert torch.allclose(getattr(coeffs, name).flatten(), value.float(), rtol=1e-5, atol=1e-7), (i, name)
+		if isinstance(sde, DDPM):
+			assert torch.allclose(coeffs.alpha_t.flatten(), sde.alphas[int(t.item())].float())
+		else:
+			assert torch.allclose(coeffs.diffusion_t.flatten(), sde.diffusion_coeff(t))
@@ -0,0 +1,32 @@
+import pytest
+import torch
+
+from src.samplers import PicardSampler
+from src.utils import get_standard_sampler
+from .utils import get_toy_sde, get_toy_score, get_toy_args, get_toy_config, ToyRayTrafo
+
+def _sample(sde_name, eta, **kwargs):
+	torch.manual_seed(0)
+	sde, ray_trafo = get_toy_sde(sde_name), ToyRayTrafo()
+	score = get_toy_score(sde).eval()
+	with torch.no_grad(): # the output layer is initialised to zero
+		score.out[-1].weight.normal_(std=0.05)
+	ground_truth = torch.rand(2, 1, 16, 16, generator=torch.Generator().manual_seed(1))
+	sampler = get_standard_sampler(get_toy_args(num_steps=20, eta=eta, **kwargs), get_toy_config(batch_size=2), 
+		score, sde, ray_trafo, observation=ray_trafo(ground_truth), filtbackproj=ground_truth, device='cpu')
+	torch.manual_seed(5)
+	return sampler.sample(logging=False), sampler
+
+@pytest.mark.parametrize('sde_name,eta,window', [('vesde', 0.15, 8), ('vpsde', 0., 4), ('ddpm', 0.15, 8)])
+def test_picard_converges_to_the_sequential_chain(sde_name, eta, window):
+	x, _ = _sample(sde_name, eta)
+	x_picard, sampler = _sample(sde_name, eta, picard_window=window, picard_tol=1e-6)
+	assert isinstance(sampler, PicardSampler) and sampler.num_sweeps <= 20
+	# same noise, hence the fixed point is the sequential trajectory
+	assert torch.allclose(x_picard, x, rtol=1e-4, atol=1e-4 * x.abs().max().item())
+
+def test_loose_tolerance_takes_fewer_sweeps():
+	x, _ = _sample('vesde', 0.15)
+	x_picard, sampler = _sample('vesde', 0.15, picard_window=10, picard_tol=1e-3)
+	assert sampler.num_sweeps < 20
+	assert (x_picard - x).abs().max() < 1e-2 * x.abs().max()
@@ -0,0 +1,21 @@
+import pytest
+import torch
+
+from src.utils import SyncCounter
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='syncs are only counted on CUDA')
+def test_sync_counter_counts_host_reads():
+	x = torch.randn(8, device='cuda')
+	with SyncCounter() as counter:
+		x.sum().item()
+		float(x.max())
+	assert counter.count == 2
+	with SyncCounter() as counter:
+		(x * 2.).sum()
+	assert counter.count == 0
+
+@pytest.mark.skipif(torch.cuda.is_available(), reason='CUDA syncs are counted')
+def test_sync_counter_does_not_report_a_count_on_cpu():
+	with SyncCounter() as counter:
+		torch.randn(8).sum().item()
+	assert counter.count is None
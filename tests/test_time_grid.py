@@ -0,0 +1,19 @@
+import pytest
+
+from src.samplers import BaseSampler
+from .utils import get_toy_sde
+
+def _time_grid(sde, **kwargs):
+	return BaseSampler(score=None, sde=sde, predictor=None, sample_kwargs={'num_steps': 10, 'eps': 1e-3, 
+		'travel_length': 1, 'travel_repeat': 1, **kwargs})._time_grid()
+
+@pytest.mark.parametrize('sde_name', ['vesde', 'ddpm'])
+def test_early_stopping_pct_only_truncates_below_one(sde_name, capsys):
+	sde = get_toy_sde(sde_name)
+	_, time_pairs, __iter__ = _time_grid(sde)
+	_, time_pairs_full, __iter__full = _time_grid(sde, early_stopping_pct=1.)
+	assert len(time_pairs) == len(time_pairs_full) == len(__iter__full) == 10
+	assert 'early stopping' not in capsys.readouterr().out
+	_, time_pairs, __iter__ = _time_grid(sde, early_stopping_pct=0.5)
+	assert len(time_pairs) == len(__iter__) == 5 and list(time_pairs) == list(time_pairs_full[:5])
+	assert 'early stopping' in capsys.readouterr().out
@@ -0,0 +1,46 @@
+import argparse
+import torch
+
+from omegaconf import OmegaConf
+from src.physics import BaseRayTrafo
+from src.third_party_models import OpenAiUNetModel
+from src.utils import VESDE, VPSDE, DDPM, _SCORE_PRED_CLASSES
+
+def get_toy_sde(sde_name: str):
+	return {'vesde': VESDE(sigma_min=0.01, sigma_max=10.), 'vpsde': VPSDE(beta_min=0.1, beta_max=10.), 
+		'ddpm': DDPM(num_steps=100)}[sde_name]
+
+def get_toy_score(sde, im_size: int = 16) -> OpenAiUNetModel:
+	""" a small ``OpenAiUNetModel'' matching ``sde'', as built by ``get_standard_score_openai_unet'' """
+	score_pred = any([isinstance(sde, classname) for classname in _SCORE_PRED_CLASSES])
+	return OpenAiUNetModel(image_size=im_size, in_channels=1, model_channels=32, out_channels=1, 
+		num_res_blocks=1, attention_resolutions=[4], marginal_prob_std=sde.marginal_prob_std if score_pred else None,
+		channel_mult=(1, 2), num_heads=2, use_scale_shift_norm=True, max_period=0.005 if score_pred else 1e4)
+
+class ToyRayTrafo(BaseRayTrafo):
+	""" a dense random matrix, its adjoint serves as ``fbp'' """
+	def __init__(self, im_size: int = 16, num_obs: int = 40) -> None:
+		super().__init__(im_shape=(im_size, im_size), obs_shape=(num_obs, 1))
+		self.register_buffer('matrix', torch.randn(num_obs, im_size**2, 
+			generator=torch.Generator().manual_seed(0)) / im_size)
+
+	def trafo_flat(self, x):
+		return self.matrix @ x
+
+	def trafo_adjoint_flat(self, observation):
+		return self.matrix.T @ observation
+
+	trafo = BaseRayTrafo._trafo_via_trafo_flat
+	trafo_adjoint = BaseRayTrafo._trafo_adjoint_via_trafo_adjoint_flat
+	fbp = trafo_adjoint
+
+def get_toy_config(batch_size: int = 1) -> OmegaConf:
+	return OmegaConf.create({'device': 'cpu', 'seed': 1, 'model': {'in_channels': 1},
+		'sampling': {'batch_size': batch_size, 'eps': 1e-3, 'travel_length': 1, 'travel_repeat': 1}})
+
+def get_toy_args(**kwargs) -> argparse.Namespace:
+	""" the arguments of ``run_adapted_sampling.py'' needed by ``get_standard_(adapted_)sampler'' """
+	return argparse.Namespace(**{'method': 'dds', 'num_steps': 10, 'pct_chain_elapsed': 0, 'penalty': 1, 
+		'eta': 0.15, 'gamma': 0.01, 'cg_iter': 2, 'add_corrector_step': False, 'early_stopping_pct': 1., 
+		'adaptation': 'lora', 'lora_rank': 4, 'lora_include_blocks': ['input_blocks', 'middle_block', 'output_blocks', 'out'],
+		'tv_penalty': 1e-6, 'num_optim_step': 2, 'adapt_freq': 1, 'lr': 1e-3, 'add_cg': True, 'dc_type': 'cg', **kwargs})